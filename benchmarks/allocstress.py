@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+'''stress uid allocation with many concurrent workers against a mock directory
+
+Each worker thread gets its own connection and allocator, like separate
+provisioning processes, and creates accounts as fast as it can.  Every uid
+handed out is checked against the others and the accounts that already
+existed, and the duplicates and accounts per second are printed as JSON.
+
+    ./benchmarks/allocstress.py --workers 16 --accounts 50
+    ./benchmarks/allocstress.py --mode genuid      # the racy genuid + mkaccount path
+
+The exit status is 1 if the counter or block modes produced a duplicate.
+'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from threading import Barrier
+from time import perf_counter
+from json import dumps
+from benchmarks.mockdir import mockserver, mockconn
+from bin.genuid import genuid
+from bin.mkaccount import mkaccount
+from ldaptools.allocator import UidAllocator, initcounter
+
+BASE='ou=People,dc=company,dc=com'
+COUNTER='cn=uidNext,dc=company,dc=com'
+
+def stress(mode, workers, accounts, size=1000, density=0.5, block_size=20):
+    '''run workers threads that each create accounts accounts, returns the results dict
+
+    Parameters:
+    mode(string): 'genuid', 'counter' (one uid per claim) or 'block' (block_size per claim)
+    workers(int): the number of concurrent workers
+    accounts(int): the accounts each worker creates
+    size(int): the accounts already in the mock directory
+    density(float): the fraction of the existing uid range in use
+    block_size(int): the uids claimed at once in block mode
+    '''
+    server, uids, uidmax = mockserver(size, BASE, density=density)
+    limit=uidmax+workers*accounts*2
+    if(mode != 'genuid'):
+        # start the counter at the bottom of the range, so the allocators
+        # have to skip the uids the existing accounts hold
+        initcounter(mockconn(server), COUNTER, 1000)
+    start=Barrier(workers)
+
+    def worker(n):
+        conn=mockconn(server)
+        allocator=None
+        if(mode != 'genuid'):
+            allocator=UidAllocator(conn, COUNTER, limit, block_size if mode == 'block' else 1, BASE)
+        made=[]
+        start.wait()
+        for i in range(accounts):
+            if(allocator == None):
+                uid=genuid(conn, 1000, limit, BASE, 10)
+            else:
+                uid=allocator.next()
+            created, _ = mkaccount(conn, 'stress%03d%05d'%(n, i), uid, BASE)
+            if(created):
+                made.append(uid)
+        return made
+
+    started=perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        made=[uid for uids_made in executor.map(worker, range(workers)) for uid in uids_made]
+    elapsed=perf_counter()-started
+
+    counts=Counter(made+uids)
+    return {
+        'mode': mode,
+        'workers': workers,
+        'accounts': len(made),
+        'duplicates': sum(c-1 for c in counts.values() if c > 1),
+        'accounts_per_sec': len(made)/elapsed if elapsed else 0.0,
+        }
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='stress concurrent uid allocation against a mock directory')
+    parser.add_argument('--mode',
+            choices=['genuid','counter','block','all'],
+            default='all',
+            help='allocation mode to stress')
+    parser.add_argument('--workers',
+            type=int,
+            default=16,
+            help='concurrent workers')
+    parser.add_argument('--accounts',
+            type=int,
+            default=25,
+            help='accounts created per worker')
+    parser.add_argument('--size',
+            type=int,
+            default=1000,
+            help='accounts already in the mock directory')
+    parser.add_argument('--block-size',
+            type=int,
+            default=20,
+            help='uids claimed at once in block mode')
+    args = parser.parse_args()
+
+    failed=False
+    for mode in (['genuid','counter','block'] if args.mode == 'all' else [args.mode]):
+        result=stress(mode, args.workers, args.accounts, args.size, block_size=args.block_size)
+        print(dumps(result))
+        failed=failed or (mode != 'genuid' and result['duplicates'] > 0)
+    if(failed):
+        exit(1)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''measure how long each tool takes to import, with python -X importtime
+
+Each module is imported in a fresh interpreter several times, and the
+median of the total import time, the interpreter's own startup (python -c
+pass) and the modules with the highest self time are written as JSON.
+Pass a previous results file with --compare to fail on regressions, and
+raise --top to see what a module pulls in:
+
+    ./benchmarks/importtime.py --output imports.json
+    ./benchmarks/importtime.py --compare imports.json
+    ./benchmarks/importtime.py --only bin.getuser --top 20
+'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, executable, path, version
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from argparse import ArgumentParser
+from statistics import median
+from subprocess import run
+from time import perf_counter, time
+from json import dumps, loads
+from ldaptools.__main__ import COMMANDS
+
+# the modules every tool loads, besides the commands themselves
+MODULES=['ldaptools', 'ldaptools.daemon']+sorted(set(COMMANDS.values()))
+
+def importtime(module):
+    '''import a module in a new interpreter and parse the -X importtime report
+
+    Returns two values in a tuple:
+    the wall clock seconds of the whole run
+    a dict of every module imported to its (self, cumulative) microseconds
+    '''
+    started=perf_counter()
+    result=run([executable, '-X', 'importtime', '-c', 'import %s'%module], cwd=project, capture_output=True, text=True)
+    elapsed=perf_counter()-started
+    if(result.returncode != 0):
+        raise Exception('importing %s failed: %s'%(module, result.stderr.strip().splitlines()[-1]))
+
+    times={}
+    for line in result.stderr.splitlines():
+        if(not line.startswith('import time:') or 'self [us]' in line):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()]=(int(own), int(cumulative))
+    return (elapsed, times)
+
+def measure(module, runs=5, top=5):
+    '''returns the median import and wall clock time of a module over runs, and its heaviest imports'''
+    totals=[]
+    walls=[]
+    heaviest={}
+    for i in range(runs):
+        elapsed, times = importtime(module)
+        walls.append(elapsed)
+        totals.append(times.get(module, (0, 0))[1])
+        for name, (own, _) in times.items():
+            heaviest[name]=heaviest.get(name, 0)+own
+    return {
+        'import_ms': median(totals)/1000,
+        'wall_ms': median(walls)*1000,
+        'modules': len(heaviest),
+        'heaviest': [{'module': name, 'self_ms': own/runs/1000}
+                for name, own in sorted(heaviest.items(), key=lambda item: -item[1])[:top]],
+        }
+
+def compare(current, previous, tolerance):
+    '''returns a list of the modules that got slower to import than tolerance allows'''
+    regressions=[]
+    for module, result in current['results'].items():
+        if(module not in previous['results']):
+            continue
+        before=previous['results'][module]['import_ms']
+        # a few milliseconds either way is noise, whatever the ratio
+        if(result['import_ms'] > before*(1+tolerance) and result['import_ms']-before > 5):
+            regressions.append('%s: %.1fms, was %.1fms'%(module, result['import_ms'], before))
+    return regressions
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='measure the import time of the ldaptools modules and scripts')
+    parser.add_argument('--runs',
+            type=int,
+            default=5,
+            help='fresh interpreters per module, the median is reported')
+    parser.add_argument('--top',
+            type=int,
+            default=5,
+            help='heaviest imports to list per module')
+    parser.add_argument('--only',
+            default=None,
+            help='comma separated modules to measure (ex: bin.getuser)')
+    parser.add_argument('--output',
+            default=None,
+            help='file to write the JSON results to (default stdout)')
+    parser.add_argument('--compare',
+            default=None,
+            help='previous results file to check for regressions')
+    parser.add_argument('--tolerance',
+            type=float,
+            default=0.2,
+            help='allowed slowdown before --compare reports a regression')
+    args = parser.parse_args()
+
+    startup=median(importtime('sys')[0] for i in range(args.runs))
+    results={
+        'meta': {
+            'time': time(),
+            'python': version.split()[0],
+            'runs': args.runs,
+            'startup_ms': startup*1000,
+            },
+        'results': {module: measure(module, args.runs, args.top) for module in (args.only.split(',') if args.only else MODULES)},
+        }
+
+    if(args.output):
+        Path(args.output).write_text(dumps(results, indent=2))
+    else:
+        print(dumps(results, indent=2))
+
+    if(args.compare):
+        regressions=compare(results, loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print('regression: %s'%regression)
+        if(regressions):
+            exit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+'''build a synthetic in-memory directory on ldap3's mock strategies'''
+
+from random import Random
+from math import ceil
+from ldap3 import Server, Connection, MOCK_SYNC, NONE
+from ldap3.protocol.rfc4512 import DsaInfo
+from ldap3.protocol.schemas.slapd24 import slapd_2_4_dsa_info
+from ldaptools.snapshot import atomic
+
+ADMIN='cn=admin,dc=company,dc=com'
+PASSWORD='benchmark'
+
+def mockserver(size, base='ou=People,dc=company,dc=com', uidmin=1000, density=0.5, seed=0, groups=0, group_base='ou=Group,dc=company,dc=com'):
+    '''build a mock server holding size posixAccounts under base
+
+    The uidNumbers are a random sample of uidmin..uidmin+size/density, so
+    density controls how full that range is (1.0 leaves no gaps).
+
+    Parameters:
+    size(int): the number of posixAccounts to create
+    base(string): the OU to create them in
+    uidmin(int): the lowest uidNumber to use
+    density(float): the fraction of the uid range that is used, between 0 and 1
+    seed(int): the random seed, so runs are reproducible
+    groups(int): the number of posixGroups to create under group_base, each
+        with up to 20 memberUids, and every fourth one also holding the two
+        groups before it as members (nested)
+    group_base(string): the OU to create the groups in
+
+    Returns three values in a tuple:
+    a ldap3 Server object holding the entries (connect to it with mockconn)
+    the list of uidNumbers used, in the order of the usernames
+    the end of the uid range the accounts were drawn from (exclusive)
+    '''
+    if(not 0 < density <= 1):
+        raise ValueError('density must be between 0 and 1')
+    span=max(ceil(size/density), size)
+    uids=Random(seed).sample(range(uidmin, uidmin+span), size)
+
+    # no schema, like connect() before serverinfo() is called, but the
+    # rootDSE lists the extended operations the mock can answer (whoami)
+    server=Server('mock', get_info=NONE)
+    server.attach_dsa_info(DsaInfo.from_json(slapd_2_4_dsa_info))
+    conn=Connection(server, ADMIN, PASSWORD, client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(ADMIN, {'objectClass': 'person', 'sn': 'admin', 'userPassword': PASSWORD})
+    conn.strategy.add_entry(base, {'objectClass': 'organizationalUnit', 'ou': base.split(',')[0].split('=')[1]})
+    conn.strategy.add_entry('cn=state', {'objectClass': 'device', 'cn': 'state',
+            'dsaIsActive': 'TRUE', 'dsaEnv': 'bench', 'dsaSite': 'mock', 'dsaRole': 'provider', 'dsaFQDN': 'mock'})
+    for i, uid in enumerate(uids):
+        username='user%07d'%i
+        conn.strategy.add_entry('uid=%s,%s'%(username, base), {
+                'objectClass': ['account', 'posixAccount'],
+                'uid': username,
+                'uidNumber': uid,
+                'gidNumber': 100,
+                'cn': username,
+                'homeDirectory': '/home/%s'%username,
+                'loginShell': '/bin/bash',
+                })
+
+    if(groups):
+        random=Random(seed+1)
+        conn.strategy.add_entry(group_base, {'objectClass': 'organizationalUnit', 'ou': group_base.split(',')[0].split('=')[1]})
+        conn.strategy.add_entry('cn=users,%s'%group_base, {'objectClass': 'posixGroup', 'cn': 'users', 'gidNumber': 100})
+        for j in range(groups):
+            attributes={
+                    'objectClass': ['posixGroup', 'groupOfNames'],
+                    'cn': 'group%05d'%j,
+                    'gidNumber': 10000+j,
+                    'memberUid': ['user%07d'%i for i in random.sample(range(size), min(size, 20))],
+                    }
+            if(j >= 2 and j%4 == 0):
+                attributes['member']=['cn=group%05d,%s'%(j-k, group_base) for k in (1, 2)]
+            conn.strategy.add_entry('cn=group%05d,%s'%(j, group_base), attributes)
+    return (server, uids, uidmin+span)
+
+def mockconn(server, client_strategy=MOCK_SYNC):
+    '''returns a bound connection to a mock server built by mockserver
+
+    MOCK_SYNC connections are switched to return SAFE_SYNC style
+    (status, result, response, request) tuples, like connect() does.
+    Connections to the same server share its entries, so give each thread
+    its own connection.
+    '''
+    conn=Connection(server, ADMIN, PASSWORD, client_strategy=client_strategy, collect_usage=True)
+    conn.bind()
+    if(client_strategy == MOCK_SYNC):
+        conn.strategy.thread_safe=True
+    atomic(conn, server)
+    return conn
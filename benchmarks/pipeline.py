@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''measure pipelined operations against a server with a simulated round trip
+
+A local server answers every search, add, modify and compare after
+--latency milliseconds, without TLS and without looking at the request,
+the way a distant provider would look from here.  The same operations are
+run on a SAFE_SYNC connection, one at a time, and through an
+ldaptools.pipeline.Pipeline with several windows, and the operations per
+second and p50/p99 latency are written as JSON.
+
+    ./benchmarks/pipeline.py --latency 50 --calls 200
+    ./benchmarks/pipeline.py --latency 50 --windows 1,16,64,256 --output wan.json
+'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import path, version
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from argparse import ArgumentParser
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from threading import Condition, Thread
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic, perf_counter, time
+from json import dumps
+from ldap3 import Server, Connection, ASYNC, SAFE_SYNC, NONE
+from ldaptools.pipeline import Pipeline, getuser, isuidfree, mkaccount
+from benchmarks.tlsconnect import success, readmessage
+from benchmarks.run import summarize
+from bin.getuser import getuser as syncgetuser
+from bin.isuidfree import isuidfree as syncisuidfree
+from bin.mkaccount import mkaccount as syncmkaccount
+
+BASE='ou=People,dc=company,dc=com'
+
+# request protocolOp tag -> the response's tag and resultCode
+ANSWERS={
+    0x60: (0x61, 0),    # bind
+    0x63: (0x65, 0),    # search, searchResDone with no entries
+    0x66: (0x67, 0),    # modify
+    0x68: (0x69, 0),    # add
+    0x6e: (0x6f, 5),    # compare, compareFalse
+    }
+
+class DelayedHandler(BaseRequestHandler):
+    '''answers each request latency seconds after it arrives, in any number at once'''
+
+    def handle(self):
+        sock=self.request
+        queue=[]
+        ready=Condition()
+        order=count()
+        done=[]
+
+        def send():
+            with ready:
+                while(not done or queue):
+                    if(not queue):
+                        ready.wait()
+                        continue
+                    wait=queue[0][0]-monotonic()
+                    if(wait > 0):
+                        ready.wait(wait)
+                        continue
+                    _, _, reply = heappop(queue)
+                    sock.sendall(reply)
+
+        sender=Thread(target=send, daemon=True)
+        sender.start()
+        try:
+            while(True):
+                message=readmessage(sock)
+                if(message == None or message[1] == 0x42):
+                    break
+                messageid, op = message
+                if(op not in ANSWERS):
+                    continue
+                tag, code = ANSWERS[op]
+                reply=success(messageid, tag)
+                if(code):
+                    reply=reply.replace(b'\x0a\x01\x00', b'\x0a\x01'+bytes([code]), 1)
+                with ready:
+                    heappush(queue, (monotonic()+self.server.latency, next(order), reply))
+                    ready.notify()
+        except OSError:
+            pass
+        finally:
+            with ready:
+                done.append(True)
+                queue.clear()
+                ready.notify()
+
+def delayedserver(latency):
+    '''start the server on a free local port, returns the server'''
+    ThreadingTCPServer.allow_reuse_address=True
+    ThreadingTCPServer.daemon_threads=True
+    server=ThreadingTCPServer(('127.0.0.1', 0), DelayedHandler)
+    server.latency=latency
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def plainconn(host, client_strategy):
+    '''an anonymous connection without TLS, unlike connect()'''
+    conn=Connection(Server(host, get_info=NONE), client_strategy=client_strategy)
+    conn.open()
+    conn.bind()
+    return conn
+
+def operations(sync):
+    '''returns benchmark name -> function(target, i), a connection when sync else a Pipeline'''
+    if(sync):
+        return {
+            'getuser': lambda conn, i: syncgetuser(conn, 'user%07d'%i, BASE),
+            'isuidfree': lambda conn, i: syncisuidfree(conn, 10000+i, BASE),
+            'mkaccount': lambda conn, i: syncmkaccount(conn, 'bench%07d'%i, 10000+i, BASE),
+            }
+    return {
+        'getuser': lambda pipeline, i: getuser(pipeline, 'user%07d'%i, BASE),
+        'isuidfree': lambda pipeline, i: isuidfree(pipeline, 10000+i, BASE),
+        'mkaccount': lambda pipeline, i: mkaccount(pipeline, 'bench%07d'%i, 10000+i, BASE),
+        }
+
+def measure_sync(function, conn, calls):
+    '''run calls one after the other, returns the summary'''
+    latencies=[]
+    started=perf_counter()
+    for i in range(calls):
+        before=perf_counter()
+        function(conn, i)
+        latencies.append(perf_counter()-before)
+    return summarize(latencies, perf_counter()-started, 0)
+
+def measure_pipeline(function, pipeline, calls):
+    '''submit every call as fast as the window allows, returns the summary'''
+    latencies=[0.0]*calls
+    futures=[]
+    started=perf_counter()
+    for i in range(calls):
+        before=perf_counter()
+        future=function(pipeline, i)
+        future.add_done_callback(lambda finished, i=i, before=before: latencies.__setitem__(i, perf_counter()-before))
+        futures.append(future)
+    for future in futures:
+        future.result()
+    return summarize(latencies, perf_counter()-started, 0)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='measure pipelined operations against a server with a simulated round trip')
+    parser.add_argument('--latency',
+            type=float,
+            default=50,
+            help='milliseconds the server waits before answering')
+    parser.add_argument('--calls',
+            type=int,
+            default=200,
+            help='calls per benchmark and mode')
+    parser.add_argument('--windows',
+            default='16,64,256',
+            help='comma separated pipeline windows to measure')
+    parser.add_argument('--connections',
+            type=int,
+            default=1,
+            help='connections per pipeline')
+    parser.add_argument('--output',
+            default=None,
+            help='file to write the JSON results to (default stdout)')
+    args = parser.parse_args()
+
+    server=delayedserver(args.latency/1000)
+    host='127.0.0.1:%d'%server.server_address[1]
+    results={}
+    conn=plainconn(host, SAFE_SYNC)
+    for name, function in operations(True).items():
+        # serial calls are slow by design, a tenth of them tells the story
+        results.setdefault(name, {})['safe_sync']=measure_sync(function, conn, max(args.calls//10, 1))
+    conn.unbind()
+
+    for window in [int(w) for w in args.windows.split(',')]:
+        with Pipeline(window=window, conns=[plainconn(host, ASYNC) for i in range(args.connections)]) as pipeline:
+            for name, function in operations(False).items():
+                results[name]['pipeline_%d'%window]=measure_pipeline(function, pipeline, args.calls)
+            for conn in pipeline.conns:
+                conn.unbind()
+    server.shutdown()
+
+    for modes in results.values():
+        for result in modes.values():
+            del result['peak_kib']
+    output=dumps({
+        'meta': {
+            'time': time(),
+            'python': version.split()[0],
+            'latency_ms': args.latency,
+            'calls': args.calls,
+            'connections': args.connections,
+            },
+        'results': results,
+        }, indent=2)
+    if(args.output):
+        Path(args.output).write_text(output)
+    else:
+        print(output)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''benchmark the bin/ helpers against an in-memory mock directory
+
+Every helper is run serially and from several threads at once against a
+synthetic directory built by benchmarks/mockdir.py, and the operations per
+second, p50/p99 latency and peak traced memory are written as JSON.  Pass
+a previous results file with --compare to fail on regressions.
+
+    ./benchmarks/run.py --size 5000 --output results.json
+    ./benchmarks/run.py --size 5000 --compare results.json
+
+ldap3's mock strategies scan every entry on each search, so absolute
+numbers are much lower than against a real server and grow with --size;
+compare runs made with the same options.
+'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, version
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from itertools import count
+from time import perf_counter, time
+from json import dumps, loads
+import asyncio
+import tracemalloc
+import ldap3
+from ldap3 import MOCK_ASYNC
+from benchmarks.mockdir import mockserver, mockconn
+from bin.getuser import getuser, getuid, getusers, userexists
+from bin.isuidfree import isuidfree
+from bin.genuid import genuid, genuids
+from bin.mkaccount import mkaccount
+from bin.pingstate import pingstate
+from bin.whoami import whoami
+from ldaptools import aio
+from ldaptools.replica import Replica
+from ldaptools.groups import GroupIndex
+
+BASE='ou=People,dc=company,dc=com'
+GROUP_BASE='ou=Group,dc=company,dc=com'
+
+# groups in the mock directory, per account
+GROUPS_PER_ACCOUNT=0.1
+
+# calls made with tracemalloc running to find the peak memory
+MEMORY_CALLS=5
+
+def benchmarks(uids, uidmax, replica, groups):
+    '''returns a dict of benchmark name to a function taking (conn, i)
+
+    i is a unique number per call, used to pick a different key each time.
+    The *_replica benchmarks answer from replica, a loaded ldaptools.replica.Replica,
+    and the getgroups ones from groups, a loaded ldaptools.groups.GroupIndex.
+    '''
+    size=len(uids)
+    newuids=count(uidmax)
+    newusers=count()
+    return {
+        'getuser': lambda conn, i: getuser(conn, 'user%07d'%(i%size), BASE),
+        'getuser_missing': lambda conn, i: getuser(conn, 'nobody%07d'%i, BASE),
+        'userexists': lambda conn, i: userexists(conn, 'user%07d'%(i%size), BASE),
+        'userexists_dn': lambda conn, i: userexists(conn, 'user%07d'%(i%size), BASE, dn='uid=user%07d,%s'%(i%size, BASE)),
+        'getuid': lambda conn, i: getuid(conn, uids[i%size], BASE),
+        'getusers_100': lambda conn, i: getusers(conn, ['user%07d'%((i*100+j)%size) for j in range(100)], BASE),
+        'isuidfree': lambda conn, i: isuidfree(conn, uids[i%size], BASE),
+        'isuidfree_exists': lambda conn, i: isuidfree(conn, uids[i%size], BASE, exists_only=True),
+        'genuid': lambda conn, i: genuid(conn, 1000, uidmax, BASE, 10),
+        'genuids_100': lambda conn, i: genuids(conn, 1000, uidmax, BASE, count=100),
+        'mkaccount': lambda conn, i: mkaccount(conn, 'bench%07d'%next(newusers), next(newuids), BASE),
+        'pingstate': lambda conn, i: pingstate(conn),
+        'whoami': lambda conn, i: whoami(conn),
+        'getuser_replica': lambda conn, i: getuser(conn, 'user%07d'%(i%size), BASE, cache=replica),
+        'isuidfree_replica': lambda conn, i: isuidfree(conn, uids[i%size], BASE, cache=replica),
+        'genuid_replica': lambda conn, i: genuid(conn, 1000, uidmax, BASE, 10, replica=replica),
+        'getgroups_search': lambda conn, i: conn.search(GROUP_BASE, '(memberUid=user%07d)'%(i%size), attributes=['cn', 'gidNumber']),
+        'getgroups': lambda conn, i: groups.getgroups('user%07d'%(i%size), 100),
+        'getgroups_many_100': lambda conn, i: groups.getgroups_many(['user%07d'%((i*100+j)%size) for j in range(100)]),
+        }
+
+def measure(function, calls, threads, connection):
+    '''run function calls times over threads threads, returns the latencies in seconds'''
+    latencies=[0.0]*calls
+
+    def one(i):
+        conn=connection()
+        started=perf_counter()
+        function(conn, i)
+        latencies[i]=perf_counter()-started
+
+    started=perf_counter()
+    if(threads > 1):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(one, range(calls)))
+    else:
+        for i in range(calls):
+            one(i)
+    return (latencies, perf_counter()-started)
+
+def summarize(latencies, elapsed, peak):
+    '''returns ops/sec, p50 and p99 latency in ms and peak memory in KiB'''
+    ordered=sorted(latencies)
+    return {
+        'calls': len(ordered),
+        'ops_per_sec': len(ordered)/elapsed if elapsed else 0.0,
+        'p50_ms': ordered[int(0.50*(len(ordered)-1))]*1000,
+        'p99_ms': ordered[int(0.99*(len(ordered)-1))]*1000,
+        'peak_kib': peak/1024,
+        }
+
+def run(size, density, calls, threads, only=None):
+    '''run every benchmark serially and with threads, returns the results dict'''
+    server, uids, uidmax = mockserver(size, BASE, density=density, groups=max(int(size*GROUPS_PER_ACCOUNT), 1), group_base=GROUP_BASE)
+
+    # each thread gets its own connection, they share the server's entries
+    connections=local()
+    def connection():
+        if(not hasattr(connections, 'conn')):
+            connections.conn=mockconn(server)
+        return connections.conn
+
+    replica=Replica(BASE)
+    replica.load(connection())
+    groups=GroupIndex(GROUP_BASE)
+    groups.load(connection())
+
+    results={}
+    for name, function in benchmarks(uids, uidmax, replica, groups).items():
+        if(only and name not in only):
+            continue
+        results[name]={}
+        for mode, workers in (('serial', 1), ('concurrent', threads)):
+            connection()
+            latencies, elapsed = measure(function, calls, workers, connection)
+
+            # tracing slows every allocation down, so memory gets its own short pass
+            tracemalloc.start()
+            measure(function, min(calls, MEMORY_CALLS), workers, connection)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name][mode]=summarize(latencies, elapsed, peak)
+
+    if(not only or 'aio_getuser' in only):
+        results['aio_getuser']={'concurrent': asyncio.run(runaio(server, size, calls))}
+    return results
+
+async def runaio(server, size, calls):
+    '''run getuser from ldaptools.aio with every call in flight at once'''
+    conn=aio.AsyncConnection(mockconn(server, MOCK_ASYNC))
+    latencies=[]
+
+    async def one(i):
+        started=perf_counter()
+        await aio.getuser(conn, 'user%07d'%(i%size), BASE)
+        latencies.append(perf_counter()-started)
+
+    started=perf_counter()
+    await asyncio.gather(*[one(i) for i in range(calls)])
+    elapsed=perf_counter()-started
+    timed=list(latencies)
+
+    tracemalloc.start()
+    await asyncio.gather(*[one(i) for i in range(min(calls, MEMORY_CALLS))])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(timed, elapsed, peak)
+
+def compare(results, baseline, tolerance):
+    '''returns a list of regressions of results against a baseline results dict'''
+    regressions=[]
+    for name, modes in results['results'].items():
+        for mode, current in modes.items():
+            previous=baseline.get('results', {}).get(name, {}).get(mode)
+            if(previous == None):
+                continue
+            if(current['ops_per_sec'] < previous['ops_per_sec']*(1-tolerance)):
+                regressions.append('%s %s: %.1f ops/s, was %.1f'%(name, mode, current['ops_per_sec'], previous['ops_per_sec']))
+            if(current['p99_ms'] > previous['p99_ms']*(1+tolerance)):
+                regressions.append('%s %s: p99 %.2fms, was %.2fms'%(name, mode, current['p99_ms'], previous['p99_ms']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='benchmark the ldaptools helpers against a mock directory')
+    parser.add_argument('--size',
+            type=int,
+            default=1000,
+            help='number of posixAccounts in the mock directory')
+    parser.add_argument('--density',
+            type=float,
+            default=0.5,
+            help='fraction of the uid range that is in use')
+    parser.add_argument('--calls',
+            type=int,
+            default=20,
+            help='calls per benchmark and mode')
+    parser.add_argument('--threads',
+            type=int,
+            default=4,
+            help='threads for the concurrent mode')
+    parser.add_argument('--only',
+            default=None,
+            help='comma separated benchmark names to run')
+    parser.add_argument('--output',
+            default=None,
+            help='file to write the JSON results to (default stdout)')
+    parser.add_argument('--compare',
+            default=None,
+            help='previous results file to check for regressions')
+    parser.add_argument('--tolerance',
+            type=float,
+            default=0.2,
+            help='allowed slowdown before --compare reports a regression')
+    args = parser.parse_args()
+
+    results={
+        'meta': {
+            'time': time(),
+            'python': version.split()[0],
+            'ldap3': ldap3.__version__,
+            'size': args.size,
+            'density': args.density,
+            'calls': args.calls,
+            'threads': args.threads,
+            },
+        'results': run(args.size, args.density, args.calls, args.threads, args.only.split(',') if args.only else None),
+        }
+
+    if(args.output):
+        Path(args.output).write_text(dumps(results, indent=2))
+    else:
+        print(dumps(results, indent=2))
+
+    if(args.compare):
+        regressions=compare(results, loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print('regression: %s'%regression)
+        if(regressions):
+            exit(1)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''measure what connect() spends on START_TLS, with and without resumption
+
+A throwaway certificate is made with openssl, and a local server that only
+answers START_TLS, bind and unbind is started on 127.0.0.1.  connect() is
+then timed with SASL EXTERNAL cert auth in three ways:
+
+    new_context  ldap3.Tls, which builds a new SSLContext on every connect
+    full         ldaptools.tls with a shared SSLContext, but no resumption
+    resumed      ldaptools.tls as connect() uses it, resuming the last session
+
+and the connects per second, p50/p99 latency and the share of resumed
+handshakes are written as JSON.
+
+    ./benchmarks/tlsconnect.py --calls 200
+    ./benchmarks/tlsconnect.py --calls 200 --tls13 --output tls13.json
+'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import path, version
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from argparse import ArgumentParser
+from socket import IPPROTO_TCP, TCP_NODELAY
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from ssl import SSLContext, PROTOCOL_TLS_SERVER, CERT_OPTIONAL, CERT_REQUIRED, PROTOCOL_TLSv1_2, OPENSSL_VERSION, TLSVersion
+from subprocess import run as execute
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, time
+from json import dumps
+from ldap3 import Server, Connection, Tls, AUTO_BIND_TLS_BEFORE_BIND, NONE, SAFE_SYNC, EXTERNAL, SASL
+from ldaptools import connect
+from ldaptools.tls import gettls
+from benchmarks.run import summarize
+
+# OID of the StartTLS extended operation (RFC 4511)
+STARTTLS=b'1.3.6.1.4.1.1466.20037'
+
+# the protocolOp tags of the requests the server answers, and of the replies
+BIND_REQUEST=0x60
+BIND_RESPONSE=0x61
+UNBIND_REQUEST=0x42
+EXTENDED_REQUEST=0x77
+EXTENDED_RESPONSE=0x78
+
+def certificate(directory):
+    '''make a self signed key and certificate for localhost, returns their paths'''
+    key=str(Path(directory, 'key.pem'))
+    cert=str(Path(directory, 'cert.pem'))
+    execute(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+            check=True, capture_output=True)
+    return (key, cert)
+
+def ber(tag, content):
+    '''returns a BER element with a definite length'''
+    if(len(content) < 0x80):
+        return bytes([tag, len(content)])+content
+    length=len(content).to_bytes((len(content).bit_length()+7)//8, 'big')
+    return bytes([tag, 0x80|len(length)])+length+content
+
+def success(messageid, op, extra=b''):
+    '''returns an LDAPMessage with a successful LDAPResult for op'''
+    # resultCode success, empty matchedDN and diagnosticMessage
+    result=b'\x0a\x01\x00\x04\x00\x04\x00'+extra
+    messageid=messageid.to_bytes(messageid.bit_length()//8+1, 'big')
+    return ber(0x30, ber(0x02, messageid)+ber(op, result))
+
+def readmessage(sock):
+    '''read one LDAPMessage, returns (messageID, protocolOp tag) or None at the end'''
+    def read(count):
+        data=b''
+        while(len(data) < count):
+            chunk=sock.recv(count-len(data))
+            if(not chunk):
+                return None
+            data+=chunk
+        return data
+
+    header=read(2)
+    if(header == None):
+        return None
+    length=header[1]
+    if(length & 0x80):
+        length=int.from_bytes(read(length & 0x7f), 'big')
+    content=read(length)
+    # content is the messageID INTEGER followed by the protocolOp
+    idlength=content[1]
+    return (int.from_bytes(content[2:2+idlength], 'big'), content[2+idlength])
+
+class StartTlsHandler(BaseRequestHandler):
+    '''answers START_TLS, then any bind, until the client unbinds'''
+
+    def handle(self):
+        sock=self.request
+        # the session tickets and the reply to the bind are separate writes
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        try:
+            while(True):
+                message=readmessage(sock)
+                if(message == None):
+                    return
+                messageid, op = message
+                if(op == EXTENDED_REQUEST):
+                    sock.sendall(success(messageid, EXTENDED_RESPONSE, ber(0x8a, STARTTLS)))
+                    sock=self.server.context.wrap_socket(sock, server_side=True)
+                elif(op == BIND_REQUEST):
+                    sock.sendall(success(messageid, BIND_RESPONSE))
+                elif(op == UNBIND_REQUEST):
+                    return
+        except OSError:
+            return
+
+def tlsserver(key, cert, tls13):
+    '''start the START_TLS server on a free local port, returns the server'''
+    context=SSLContext(PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    context.load_verify_locations(cert)
+    context.verify_mode=CERT_OPTIONAL
+    if(not tls13):
+        context.maximum_version=TLSVersion.TLSv1_2
+
+    ThreadingTCPServer.allow_reuse_address=True
+    ThreadingTCPServer.daemon_threads=True
+    server=ThreadingTCPServer(('127.0.0.1', 0), StartTlsHandler)
+    server.context=context
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def newcontext(host, key, cert, tls13):
+    '''connect the way connect() used to, with a new ldap3.Tls each time'''
+    ldaptls=Tls(local_private_key_file=key,
+            local_certificate_file=cert,
+            ca_certs_file=cert,
+            validate=CERT_REQUIRED,
+            version=None if tls13 else PROTOCOL_TLSv1_2)
+    return Connection(Server(host, use_ssl=False, tls=ldaptls, get_info=NONE),
+            sasl_mechanism=EXTERNAL,
+            authentication=SASL,
+            auto_bind=AUTO_BIND_TLS_BEFORE_BIND,
+            client_strategy=SAFE_SYNC)
+
+def measure(mode, host, key, cert, calls, tls13):
+    '''connect and unbind calls times, returns the summary and resumed share'''
+    shared=gettls(key, cert, cert, tls13)
+    shared.forget()
+    latencies=[]
+    resumed=0
+    started=perf_counter()
+    for i in range(calls):
+        before=perf_counter()
+        if(mode == 'new_context'):
+            conn=newcontext(host, key, cert, tls13)
+        else:
+            if(mode == 'full'):
+                shared.forget()
+            conn=connect(server=host, auth_key=key, auth_cert=cert, ca_certs=cert, tls13=tls13)
+        latencies.append(perf_counter()-before)
+        resumed+=getattr(conn.socket, 'session_reused', False) == True
+        conn.unbind()
+    result=summarize(latencies, perf_counter()-started, 0)
+    del result['peak_kib']
+    result['resumed']=resumed/calls
+    return result
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='measure START_TLS connect time against a local server')
+    parser.add_argument('--calls',
+            type=int,
+            default=100,
+            help='connects per mode')
+    parser.add_argument('--tls13',
+            action='store_true',
+            help='allow TLS 1.3 on both ends')
+    parser.add_argument('--output',
+            default=None,
+            help='file to write the JSON results to (default stdout)')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        key, cert = certificate(directory)
+        server=tlsserver(key, cert, args.tls13)
+        host='localhost:%d'%server.server_address[1]
+        results={
+            'meta': {
+                'time': time(),
+                'python': version.split()[0],
+                'openssl': OPENSSL_VERSION,
+                'calls': args.calls,
+                'tls13': args.tls13,
+                },
+            'results': {mode: measure(mode, host, key, cert, args.calls, args.tls13)
+                    for mode in ('new_context', 'full', 'resumed')},
+            }
+        server.shutdown()
+
+    if(args.output):
+        Path(args.output).write_text(dumps(results, indent=2))
+    else:
+        print(dumps(results, indent=2))
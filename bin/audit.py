@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+'''check every posixAccount and posixGroup for uid and gid problems in one pass'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, stderr
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import connect, argparser, iter_entries
+from ldaptools.metrics import helper
+from ldap3.utils.conv import escape_filter_chars
+from time import monotonic
+from json import dumps
+
+# the checks an audit reports on, in report order
+CHECKS=(
+    'duplicate_uid',
+    'duplicate_uidNumber',
+    'duplicate_homeDirectory',
+    'duplicate_gidNumber',
+    'missing_uidNumber',
+    'missing_gidNumber',
+    'out_of_range_uidNumber',
+    'out_of_range_gidNumber',
+    'dangling_gidNumber',
+    )
+
+def _values(entry, attribute):
+    '''returns the values of an attribute as a list, [] if it is missing'''
+    value=entry['attributes'].get(attribute)
+    if(value == None):
+        return []
+    return value if isinstance(value, list) else [value]
+
+def _numbers(entry, attribute):
+    '''returns the values of a numeric attribute as integers, None for ones that are not numeric'''
+    numbers=[]
+    for value in _values(entry, attribute):
+        try:
+            numbers.append(int(value))
+        except (TypeError, ValueError):
+            numbers.append(None)
+    return numbers
+
+class Numbers:
+    '''the numbers seen so far, a byte per number within a range and a set outside it
+
+    Returns True from add() the second time a number is added, once.
+    '''
+
+    def __init__(self, low, high):
+        self.low=low
+        self.seen=bytearray(max(high-low, 0))
+        self.outside={}
+
+    def add(self, number):
+        index=number-self.low
+        if(0 <= index < len(self.seen)):
+            count=self.seen[index]
+            self.seen[index]=min(count+1, 2)
+        else:
+            count=self.outside.get(number, 0)
+            self.outside[number]=min(count+1, 2)
+        return count == 1
+
+    def __contains__(self, number):
+        index=number-self.low
+        if(0 <= index < len(self.seen)):
+            return self.seen[index] != 0
+        return number in self.outside
+
+def fragmentation(used, low):
+    '''describe the free space of a range from a map of used numbers
+
+    Parameters:
+    used(bytearray): a byte per number, 0 if free
+    low(int): the number that used[0] represents
+
+    Returns:
+    a dict with the used and free counts, the number of free runs, the
+    largest free run as [start, end) and the fraction of the free numbers
+    outside the largest run (0 when the free space is one block)
+    '''
+    free=0
+    runs=0
+    largest=(low, low)
+    start=None
+    for index in range(len(used)+1):
+        if(index < len(used) and not used[index]):
+            if(start == None):
+                start=index
+            continue
+        if(start != None):
+            runs+=1
+            free+=index-start
+            if(index-start > largest[1]-largest[0]):
+                largest=(low+start, low+index)
+            start=None
+    return {
+        'used': len(used)-free,
+        'free': free,
+        'free_runs': runs,
+        'largest_free_run': list(largest),
+        'fragmentation': round(1-(largest[1]-largest[0])/free, 4) if free else 0.0,
+        }
+
+@helper('audit')
+def audit(conn, base, group_base=None, uidmin=1000, uidmax=8500, gidmin=None, gidmax=None, page_size=1000, limit=100, progress=None):
+    '''check posixAccounts and posixGroups for duplicate, missing and out of range ids
+
+    The groups and then the accounts are each read once with a paged search
+    for the few attributes checked, and nothing is kept per entry but a byte
+    per id in the ranges and a hash per uid and home directory.  Duplicates
+    are found by hash, then a search per duplicated value lists the entries
+    holding it (and drops hash collisions), so only the first limit findings
+    of each check cost a search.
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    base(string): the basedn of the posixAccounts
+    group_base(string): the basedn of the posixGroups, None to skip the group checks
+    uidmin(int): the minimum valid uidNumber (inclusive), as for genuid
+    uidmax(int): the maximum valid uidNumber (exclusive), as for genuid
+    gidmin(int): the minimum valid gidNumber (inclusive), None to skip the check
+    gidmax(int): the maximum valid gidNumber (exclusive), None to skip the check
+    page_size(int): the number of entries to request per page
+    limit(int): the maximum number of findings listed per check (all are counted)
+    progress(callable): called with (entries, seconds) every page_size entries
+
+    Returns:
+    a dict with the number of accounts and groups, a list of findings and
+    a count per check in CHECKS, and the fragmentation of the uid range
+
+    Raises:
+    Exception if a search fails
+    '''
+    started=monotonic()
+    report={'accounts': 0, 'groups': 0, 'counts': {check: 0 for check in CHECKS}}
+    for check in CHECKS:
+        report[check]=[]
+    scanned=[0]
+
+    def finding(check, item):
+        report['counts'][check]+=1
+        if(len(report[check]) < limit):
+            report[check].append(item)
+
+    def tick():
+        scanned[0]+=1
+        if(progress != None and scanned[0]%page_size == 0):
+            progress(scanned[0], monotonic()-started)
+
+    gids=None
+    if(group_base != None):
+        gids=Numbers(gidmin or 0, gidmax or 0)
+        duplicates=[]
+        for entry in iter_entries(conn, group_base, '(objectClass=posixGroup)', ['gidNumber'], page_size):
+            report['groups']+=1
+            tick()
+            numbers=_numbers(entry, 'gidNumber')
+            if(not numbers or None in numbers):
+                finding('missing_gidNumber', {'dn': entry['dn']})
+                continue
+            for gid in numbers:
+                if(gidmin != None and gidmax != None and not gidmin <= gid < gidmax):
+                    finding('out_of_range_gidNumber', {'dn': entry['dn'], 'gidNumber': gid})
+                if(gids.add(gid)):
+                    duplicates.append(gid)
+        for gid in duplicates:
+            dns=_holders(conn, group_base, '(&(objectClass=posixGroup)(gidNumber=%s))'%gid, page_size)
+            finding('duplicate_gidNumber', {'gidNumber': gid, 'dns': dns})
+
+    uids=Numbers(uidmin, uidmax)
+    names=set()
+    homes=set()
+    duplicated={'uid': [], 'uidNumber': [], 'homeDirectory': []}
+    for entry in iter_entries(conn, base, '(objectClass=posixAccount)', ['uid', 'uidNumber', 'gidNumber', 'homeDirectory'], page_size):
+        report['accounts']+=1
+        tick()
+        dn=entry['dn']
+
+        for uid in _values(entry, 'uid'):
+            key=hash(str(uid).lower())
+            if(key in names):
+                duplicated['uid'].append(str(uid))
+            names.add(key)
+
+        for home in _values(entry, 'homeDirectory'):
+            key=hash(str(home))
+            if(key in homes):
+                duplicated['homeDirectory'].append(str(home))
+            homes.add(key)
+
+        numbers=_numbers(entry, 'uidNumber')
+        if(not numbers or None in numbers):
+            finding('missing_uidNumber', {'dn': dn})
+        for number in numbers:
+            if(number == None):
+                continue
+            if(not uidmin <= number < uidmax):
+                finding('out_of_range_uidNumber', {'dn': dn, 'uidNumber': number})
+            if(uids.add(number)):
+                duplicated['uidNumber'].append(number)
+
+        numbers=_numbers(entry, 'gidNumber')
+        if(not numbers or None in numbers):
+            finding('missing_gidNumber', {'dn': dn})
+        elif(gids != None):
+            for gid in numbers:
+                if(gid not in gids):
+                    finding('dangling_gidNumber', {'dn': dn, 'gidNumber': gid})
+
+    # list the entries behind each duplicate, dropping hash collisions
+    for attribute, values in duplicated.items():
+        seen=set()
+        for value in values:
+            if(value in seen or len(report['duplicate_'+attribute]) >= limit):
+                continue
+            seen.add(value)
+            dns=_holders(conn, base, '(&(objectClass=posixAccount)(%s=%s))'%(attribute, escape_filter_chars(str(value))), page_size)
+            if(len(dns) > 1):
+                report['counts']['duplicate_'+attribute]+=1
+                report['duplicate_'+attribute].append({attribute: value, 'dns': dns})
+        # past the limit, count the distinct values without checking them
+        report['counts']['duplicate_'+attribute]+=len(set(values)-seen)
+
+    report['uid_range']=dict(fragmentation(uids.seen, uidmin), uidmin=uidmin, uidmax=uidmax)
+    return report
+
+def _holders(conn, base, search_filter, page_size):
+    '''returns the dns of the entries matching a filter'''
+    return [entry['dn'] for entry in iter_entries(conn, base, search_filter, ['1.1'], page_size)]
+
+def problems(report):
+    '''returns the total number of findings in an audit report'''
+    return sum(report['counts'].values())
+
+if __name__ == '__main__':
+    parser = argparser('check posixAccounts and posixGroups for uid and gid problems, as JSON')
+    parser.add_argument('--base',
+            default='ou=People,dc=company,dc=com',
+            help='OU holding the accounts (ex: ou=People,dc=company,dc=com)')
+    parser.add_argument('--group-base',
+            default=None,
+            help='OU holding the posixGroups, checks account gidNumbers against them (ex: ou=Group,dc=company,dc=com)')
+    parser.add_argument('--uidmin',
+            type=int,
+            default=1000,
+            help='minimum valid uid(inclusive)')
+    parser.add_argument('--uidmax',
+            type=int,
+            default=8500,
+            help='maximum valid uid(exclusive)')
+    parser.add_argument('--gidmin',
+            type=int,
+            default=None,
+            help='minimum valid gid(inclusive)')
+    parser.add_argument('--gidmax',
+            type=int,
+            default=None,
+            help='maximum valid gid(exclusive)')
+    parser.add_argument('--page-size',
+            type=int,
+            default=1000,
+            help='entries to request per page')
+    parser.add_argument('--limit',
+            type=int,
+            default=100,
+            help='maximum findings listed per check')
+    args = parser.parse_args()
+
+    def report(entries, seconds):
+        if(args.verbose):
+            print('%s entries in %.1fs (%.0f entries/s)'%(entries, seconds, entries/seconds if seconds else 0), file=stderr)
+
+    result = audit(connect(args=args), args.base, args.group_base,
+            uidmin=args.uidmin,
+            uidmax=args.uidmax,
+            gidmin=args.gidmin,
+            gidmax=args.gidmax,
+            page_size=args.page_size,
+            limit=args.limit,
+            progress=report)
+    print(dumps(result, indent=2))
+    if(problems(result)):
+        exit(1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+'''stream every entry under a basedn to stdout as LDIF or JSON lines'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, stdout, stderr
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import connect, argparser, iter_entries, CookieRejected
+from ldaptools.metrics import helper
+from ldap3.protocol.rfc2849 import search_response_to_ldif
+from time import monotonic
+from json import dumps
+
+@helper('export')
+def export(conn, base, search_filter='(objectClass=*)', attributes=['*'], output=stdout, format='ldif', page_size=500, cookie=None, on_page=None, progress=None):
+    '''write every entry matching a search to a file as it arrives
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    base(string): the basedn to search
+    search_filter(string): the ldap filter to match
+    attributes(list): the attributes to export
+    output(file): where to write the entries
+    format(string): 'ldif' or 'json' (one JSON object per line)
+    page_size(int): the number of entries to request per page
+    cookie(bytes): a paged search cookie to resume from (see ldaptools.iter_entries)
+    on_page(callable): called with the cookie for the next page
+    progress(callable): called with (entries, seconds) after every page
+
+    Returns:
+    the number of entries written
+    '''
+    started=monotonic()
+    count=0
+
+    def page(next_cookie):
+        output.flush()
+        if(on_page != None):
+            on_page(next_cookie)
+        if(progress != None):
+            progress(count, monotonic()-started)
+
+    if(format == 'ldif' and cookie == None):
+        output.write('version: 1\n\n')
+
+    for entry in iter_entries(conn, base, search_filter, attributes, page_size, cookie, page):
+        if(format == 'ldif'):
+            # the last line is a '# total number of entries' comment
+            output.write('\n'.join(search_response_to_ldif([entry], False)[:-1])+'\n')
+        else:
+            output.write(dumps({'dn': entry['dn'], 'attributes': dict(entry['attributes'])}, default=str)+'\n')
+        count+=1
+
+    return count
+
+if __name__ == '__main__':
+    parser = argparser('stream entries under a basedn as LDIF or JSON lines')
+    parser.add_argument('--base',
+            default='ou=People,dc=company,dc=com',
+            help='OU to export (ex: ou=People,dc=company,dc=com)')
+    parser.add_argument('--filter',
+            default='(objectClass=*)',
+            help='ldap filter to match')
+    parser.add_argument('--attributes',
+            default='*',
+            help='comma separated attributes to export')
+    parser.add_argument('--format',
+            choices=['ldif','json'],
+            default='ldif',
+            help='output format')
+    parser.add_argument('--page-size',
+            type=int,
+            default=500,
+            help='entries to request per page')
+    parser.add_argument('--cookie-file',
+            default=None,
+            help='file to save the paged search cookie to, and resume from if it exists (only servers that accept a cookie on a new connection can resume)')
+    args = parser.parse_args()
+    conn = connect(args=args)
+
+    cookie=None
+    if(args.cookie_file and Path(args.cookie_file).exists()):
+        cookie=bytes.fromhex(Path(args.cookie_file).read_text().strip()) or None
+
+    def save(next_cookie):
+        if(args.cookie_file):
+            Path(args.cookie_file).write_text(next_cookie.hex() if next_cookie else '')
+
+    def report(entries, seconds):
+        if(args.verbose):
+            print('%s entries in %.1fs (%.0f entries/s)'%(entries, seconds, entries/seconds if seconds else 0), file=stderr)
+
+    started=monotonic()
+    try:
+        count = export(conn, args.base, args.filter, args.attributes.split(','),
+                format=args.format,
+                page_size=args.page_size,
+                cookie=cookie,
+                on_page=save,
+                progress=report)
+    except CookieRejected as e:
+        print('%s; this server can not resume an export, remove %s and export from the start'%(e, args.cookie_file), file=stderr)
+        exit(1)
+    seconds=monotonic()-started
+    print('exported %s entries in %.1fs (%.0f entries/s)'%(count, seconds, count/seconds if seconds else 0), file=stderr)
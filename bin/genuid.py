@@ -9,11 +9,158 @@ from sys import exit, path
 project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
-from ldaptools import connect, argparser
+from ldaptools import connect, argparser, iter_entries
+from ldaptools.metrics import helper
+from ldaptools.daemon import forward
 from bin.isuidfree import isuidfree
-from random import randint
+from ldaptools.allocator import UidAllocator
+from random import sample
 
-def genuid(conn, uidmin, uidmax, base, attempts):
+def uidnumbers(response):
+    '''return the uidNumbers found in a search response as integers
+
+    Values that are not numeric are skipped.
+    '''
+    found=[]
+    for entry in response:
+        if(entry.get('type') != 'searchResEntry'):
+            continue
+        values=entry['attributes'].get('uidNumber')
+        if(not isinstance(values, list)):
+            values=[values]
+        for value in values:
+            try:
+                found.append(int(value))
+            except (TypeError, ValueError):
+                continue
+    return found
+
+@helper('useduids')
+def useduids(conn, uidmin, uidmax, base, page_size=1000, replica=None):
+    '''build a map of the uids that are already in use within the specified base
+
+    Every uidNumber in the base is pulled with a paged search that only
+    requests the uidNumber attribute, so the whole range costs a handful of
+    round-trips no matter how full it is.
+
+    Example:
+    used = useduids(conn, 100, 110, 'ou=People,dc=company,dc=com')
+    used[0] is 1 if uid 100 is taken, 0 if it is free
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    uidmin(int): the minimum uid to consider(inclusive)
+    uidmax(int): the maximum uid to consider(exclusive)
+    base(string): the basedn to search
+    page_size(int): the number of entries to request per page
+    replica(object): a ldaptools.replica.Replica of base to build the map from instead
+
+    Returns:
+    bytearray with one byte per uid in the range, 1 if used and 0 if free
+
+    Raises:
+    Exception if the search fails
+    '''
+    if(replica != None):
+        return replica.useduids(uidmin, uidmax)
+
+    used=bytearray(max(uidmax-uidmin,0))
+    entries=iter_entries(conn, base, '(uidNumber=*)', ['uidNumber'], page_size)
+    for uid in uidnumbers(entries):
+        if(uidmin <= uid < uidmax):
+            used[uid-uidmin]=1
+
+    return used
+
+def freeuids(used, uidmin, count=1, strategy='lowest'):
+    '''pick free uids out of a map built by useduids
+
+    Parameters:
+    used(bytearray): a map of used uids as returned by useduids
+    uidmin(int): the uid that used[0] represents
+    count(int): the number of free uids to return
+    strategy(string): 'lowest' for the lowest free uids, 'random' for a random sample
+
+    Returns:
+    list of free uids, sorted ascending for 'lowest'
+
+    Raises:
+    ValueError if there are not enough free uids or the strategy is unknown
+    '''
+    if(strategy == 'lowest'):
+        found=[]
+        index=used.find(0)
+        while(index != -1 and len(found) < count):
+            found.append(uidmin+index)
+            index=used.find(0, index+1)
+    elif(strategy == 'random'):
+        free=[uidmin+index for index, value in enumerate(used) if not value]
+        found=sample(free, min(count, len(free)))
+    else:
+        raise ValueError('unknown strategy %s'%strategy)
+
+    if(len(found) < count):
+        raise ValueError('only %s free uids are available, %s requested'%(len(found), count))
+
+    return found
+
+@helper('genuids')
+def genuids(conn, uidmin, uidmax, base, count=1, strategy='lowest', attempts=10, page_size=1000, used=None, replica=None):
+    '''generate a number of uids between uidmin and uidmax within the specified base
+
+    A single snapshot of the used uids is taken with useduids, the candidates
+    are picked locally, and only the chosen uids are confirmed with isuidfree.
+    Any uid that was taken since the snapshot is marked used and replaced.
+
+    Example:
+    genuids(conn, 1000, 8500, 'ou=People,dc=company,dc=com', count=500)
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    uidmin(int): the minimum uid to consider(inclusive)
+    uidmax(int): the maximum uid to consider(exclusive)
+    base(string): the basedn to search
+    count(int): the number of uids to generate
+    strategy(string): 'lowest' or 'random', see freeuids
+    attempts(int): the maximum number of confirmation rounds before raising an error
+    page_size(int): the number of entries to request per page
+    used(bytearray): a map from useduids to reuse instead of taking a new snapshot,
+        the returned uids are marked used in it
+    replica(object): a ldaptools.replica.Replica of base to pick and confirm the uids from,
+        without searching the directory
+
+    Returns:
+    list of available uids
+
+    Raises:
+    ValueError if enough valid ids cannot be found within the specified number of attempts
+    '''
+    if(used == None):
+        used=useduids(conn, uidmin, uidmax, base, page_size, replica)
+
+    founduids=[]
+    for i in range(attempts):
+        proposed=freeuids(used, uidmin, count-len(founduids), strategy)
+        for uid in proposed:
+            used[uid-uidmin]=1
+
+        free, response = isuidfree(conn, proposed, base, cache=replica)
+        if(free):
+            founduids.extend(proposed)
+        else:
+            taken=set(uidnumbers(response))
+            founduids.extend(uid for uid in proposed if uid not in taken)
+
+        if(len(founduids) >= count):
+            break
+
+    if(len(founduids) < count):
+        raise ValueError('unable to find %s valid uids in %s attempts'%(count, attempts))
+
+    return sorted(founduids) if strategy == 'lowest' else founduids
+
+@helper('genuid')
+def genuid(conn, uidmin, uidmax, base, attempts, replica=None):
     '''generate a uid between uidmin and uidmax within the specified base
 
     Example:
@@ -27,6 +174,7 @@ def genuid(conn, uidmin, uidmax, base, attempts):
     uidmax(int): the maximum uid to consider(exclusive)
     base(string): the basedn to search
     attempts(int): the maximum number of attempts before raising an error
+    replica(object): a ldaptools.replica.Replica of base to answer from
 
     Returns:
     integer of the available uid
@@ -34,18 +182,7 @@ def genuid(conn, uidmin, uidmax, base, attempts):
     Raises:
     ValueError if a valid id cannot be found within the specified number of attempts
     '''
-
-    founduid=None
-    for i in range(attempts):
-        proposed=randint(uidmin,uidmax)
-        if(isuidfree(conn,proposed,base)):
-            founduid=proposed
-            break
-    
-    if(founduid==None):
-        raise ValueError('unable to find valid uid in %s attempts'%attempts)
-
-    return founduid
+    return genuids(conn, uidmin, uidmax, base, count=1, strategy='random', attempts=attempts, replica=replica)[0]
 
 if __name__ == '__main__':
     parser = argparser('generate a free uid')
@@ -61,12 +198,36 @@ if __name__ == '__main__':
             type=int,
             default=10,
             help='number of attempts to try and find a free uid')
+    parser.add_argument('--count',
+            type=int,
+            default=1,
+            help='number of free uids to generate')
+    parser.add_argument('--strategy',
+            choices=['lowest','random'],
+            default='random',
+            help='pick the lowest free uids or a random sample')
+    parser.add_argument('--counter',
+            default=None,
+            help='claim the uids from this counter entry, safe with concurrent workers (see ldaptools.allocator)')
     parser.add_argument('--base',
             default='ou=People,dc=company,dc=com',
             help='OU to search (ex: ou=People,dc=company,dc=com)')
     args = parser.parse_args()
-    conn = connect(args=args)
 
-    uid = genuid(conn, args.uidmin, args.uidmax, args.base, args.attempts)
-    print(uid)
+    if(args.counter):
+        allocator = UidAllocator(connect(args=args, write=True), args.counter, args.uidmax, args.count, args.base, uidmin=args.uidmin)
+        for uid in allocator.take(args.count):
+            print(uid)
+        exit(0)
 
+    forwarded, uids = forward(args, 'genuids', uidmin=args.uidmin, uidmax=args.uidmax, base=args.base,
+            count=args.count,
+            strategy=args.strategy,
+            attempts=args.attempts)
+    if(not forwarded):
+        uids = genuids(connect(args=args), args.uidmin, args.uidmax, args.base,
+                count=args.count,
+                strategy=args.strategy,
+                attempts=args.attempts)
+    for uid in uids:
+        print(uid)
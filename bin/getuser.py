@@ -5,20 +5,37 @@
 # the ldaptools module has not been "installed". This inserts the 
 # project directory into python's path, so the module can be found
 from pathlib import Path
-from sys import exit, path
+from sys import exit, path, stdin, stderr
 project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
 from ldaptools import connect, argparser
-from pprint import pprint
+from ldaptools.metrics import helper
+from ldaptools.daemon import forward
+from ldaptools.pool import ConnectionPool
+from ldaptools.account import PosixAccount
+from ldaptools.fanout import fanout, connectall, FanoutTimeout
+from itertools import islice
+from json import dumps
 
-def getuser(conn, username, base):
+# ldap result codes
+RESULT_COMPARE_FALSE=5
+RESULT_COMPARE_TRUE=6
+RESULT_NO_SUCH_OBJECT=32
+
+@helper('getuser')
+def getuser(conn, username, base, cache=None, attributes=['*'], compact=False, timeout=None):
     '''returns a user from within the specified base
 
     Parameters:
-    conn(object): a ldap3 connection object
+    conn(object): a ldap3 connection object, or a list of them to search every server
     username(string): the posix username to search for (called uid in ldap)
-    base(string): the basedn to search
+    base(string): the basedn to search, or a list of them to search all at once
+    cache(object): a ldaptools.cache.UserCache or ldaptools.replica.Replica to answer from and fill
+    attributes(list): the attributes to fetch (ex: ldaptools.account.ATTRIBUTES),
+        only entries fetched with '*' are added to the cache
+    compact(bool): return a ldaptools.account.PosixAccount instead of the search response
+    timeout(float): seconds to wait for every base and server to answer (see ldaptools.fanout)
 
     Returns two values in a tuple:
     True/False depending on whether a single matching user was found
@@ -27,30 +44,43 @@ def getuser(conn, username, base):
     Raises:
     Exception if an unexpected state occurs
     ValueError if multiple objects match the query
+    FanoutTimeout if the bases and servers did not answer within timeout
     '''
-    status, _, response, _ = conn.search(
-            search_base=base,
-            search_filter='(uid=%s)'%username,
-            attributes=['*'])
+    if(cache != None):
+        known, entry = cache.lookup('uid', username)
+        if(known):
+            return (entry != None, _shaped(entry, attributes, compact))
+
+    from ldap3.utils.conv import escape_filter_chars
+    status, response = _search(conn, base, '(uid=%s)'%escape_filter_chars(str(username)), attributes, timeout)
 
     if(status): #we think we found something
         if(len(response)<1):
             raise Exception('for some reason status is false and response is 0... that should not happen')
         elif(len(response)>1):
             raise ValueError('too many responses were found (duplicate uid?)')
-        return (status, response[0])
+        if(cache != None and '*' in attributes):
+            cache.put(response[0])
+        return (status, _shaped(response[0], attributes, compact))
 
     # we did not find anything
+    if(cache != None):
+        cache.putmissing('uid', username)
     return (status, None)
 
 
-def getuid(conn, uid, base):
+@helper('getuid')
+def getuid(conn, uid, base, cache=None, attributes=['*'], compact=False, timeout=None):
     '''returns a user from within the specified base
  
     Parameters:
-    conn(object): a ldap3 connection object
+    conn(object): a ldap3 connection object, or a list of them to search every server
     uid(int): the posix uid to search for (called uiNumberd in ldap)
-    base(string): the basedn to search
+    base(string): the basedn to search, or a list of them to search all at once
+    cache(object): a ldaptools.cache.UserCache or ldaptools.replica.Replica to answer from and fill
+    attributes(list): the attributes to fetch, see getuser
+    compact(bool): return a ldaptools.account.PosixAccount instead of the search response
+    timeout(float): seconds to wait for every base and server to answer (see ldaptools.fanout)
  
     Returns two values in a tuple:
     True/False depending on whether a single matching user was found
@@ -59,22 +89,244 @@ def getuid(conn, uid, base):
     Raises:
     Exception if an unexpected state occurs
     ValueError if multiple objects match the query
+    FanoutTimeout if the bases and servers did not answer within timeout
     '''
-    status, _, response, _ = conn.search(
-            search_base=base,
-            search_filter='(uidNumber=%s)'%uid,
-            attributes=['*'])
+    if(cache != None):
+        known, entry = cache.lookup('uidNumber', uid)
+        if(known):
+            return (entry != None, _shaped(entry, attributes, compact))
+
+    from ldap3.utils.conv import escape_filter_chars
+    status, response = _search(conn, base, '(uidNumber=%s)'%escape_filter_chars(str(uid)), attributes, timeout)
 
     if(status): #we think we found something
         if(len(response)<1):
             raise Exception('for some reason status is false and response is 0... that should not happen')
         elif(len(response)>1):
             raise ValueError('too many responses were found (duplicate uid?)')
-        return (status, response[0])
+        if(cache != None and '*' in attributes):
+            cache.put(response[0])
+        return (status, _shaped(response[0], attributes, compact))
  
     # we did not find anything
+    if(cache != None):
+        cache.putmissing('uidNumber', uid)
     return (status, None)
 
+@helper('userexists')
+def userexists(conn, username, base, dn=None, cache=None, time_limit=None):
+    '''check whether a user exists, without fetching it
+
+    If the user's dn is known, it is checked with a compare of its uid,
+    which the server answers from that one entry.  Otherwise the base is
+    searched for no attributes (1.1) with a size limit of 2, enough to tell
+    a single match from a duplicate.
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    username(string): the posix username to look for (called uid in ldap)
+    base(string): the basedn to search
+    dn(string): the dn the user would have, to compare instead of searching
+    cache(object): a ldaptools.cache.UserCache or ldaptools.replica.Replica to answer from
+    time_limit(int): seconds the server may spend on the search (default the server's limit)
+
+    Returns two values in a tuple:
+    True/False depending on whether the user exists
+    the dn of the user, or None if not found
+
+    Raises:
+    ValueError if multiple objects match the query
+    Exception if the compare fails for another reason than a missing entry
+    '''
+    if(cache != None):
+        known, entry = cache.lookup('uid', username)
+        if(known):
+            return (entry != None, None if entry == None else entry['dn'])
+
+    if(dn != None):
+        status, result, _, _ = conn.compare(dn, 'uid', username)
+        if(status or result['result'] == RESULT_COMPARE_TRUE):
+            return (True, dn)
+        if(result['result'] in (RESULT_COMPARE_FALSE, RESULT_NO_SUCH_OBJECT)):
+            return (False, None)
+        raise Exception('compare failed: %s'%result['description'])
+
+    from ldap3.utils.conv import escape_filter_chars
+    _, _, response, _ = conn.search(
+            search_base=base,
+            search_filter='(uid=%s)'%escape_filter_chars(str(username)),
+            attributes=['1.1'],
+            size_limit=2,
+            time_limit=time_limit or 0)
+    # a second entry makes the search end with sizeLimitExceeded
+    response=[entry for entry in response if entry.get('type') == 'searchResEntry']
+    if(len(response) > 1):
+        raise ValueError('too many responses were found (duplicate uid?)')
+    if(response):
+        return (True, response[0]['dn'])
+    return (False, None)
+
+@helper('getusers')
+def getusers(conn, usernames, base, attributes=['*'], chunk_size=100, workers=4, compact=False):
+    '''returns many users from within the specified base
+
+    The usernames are split into (|(uid=a)(uid=b)...) filters of at most
+    chunk_size names.  If conn is a ConnectionPool, up to workers chunks are
+    searched at once, each on its own borrowed connection.
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    usernames(list): the posix usernames to search for (called uid in ldap)
+    base(string): the basedn to search
+    attributes(list): the attributes to return (uid is always added)
+    chunk_size(int): the maximum number of usernames per search
+    workers(int): the maximum number of concurrent searches when conn is a pool
+    compact(bool): return ldaptools.account.PosixAccount objects instead of search responses
+
+    Returns three values in a tuple:
+    a dict of username to user object for every username found exactly once
+    a list of usernames that were not found
+    a dict of username to a list of user objects for usernames found more than once
+
+    Raises:
+    Exception if a search fails
+    '''
+    return _getmany(conn, 'uid', [str(u) for u in usernames], base, attributes, chunk_size, workers, compact)
+
+@helper('getuids')
+def getuids(conn, uids, base, attributes=['*'], chunk_size=100, workers=4, compact=False):
+    '''returns many users by uid from within the specified base
+
+    See getusers, this searches by uidNumber instead of uid.
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    uids(list): the posix uids to search for (called uidNumber in ldap)
+    base(string): the basedn to search
+    attributes(list): the attributes to return (uidNumber is always added)
+    chunk_size(int): the maximum number of uids per search
+    workers(int): the maximum number of concurrent searches when conn is a pool
+    compact(bool): return ldaptools.account.PosixAccount objects instead of search responses
+
+    Returns three values in a tuple:
+    a dict of uid to user object for every uid found exactly once
+    a list of uids that were not found
+    a dict of uid to a list of user objects for uids found more than once
+
+    Raises:
+    Exception if a search fails
+    '''
+    return _getmany(conn, 'uidNumber', [int(u) for u in uids], base, attributes, chunk_size, workers, compact)
+
+def _search(conn, base, search_filter, attributes, timeout):
+    '''search one base on one connection, or fan out over several
+
+    A fan-out stops as soon as a second entry shows the key is duplicated.
+
+    Returns two values in a tuple:
+    True if something was found
+    the list of entries
+    '''
+    if(isinstance(conn, (list, tuple)) or not isinstance(base, str)):
+        response, errors, complete = fanout(conn, base, search_filter, attributes, timeout, stop=lambda entries: len(entries) > 1)
+        if(len(response) < 2 and errors):
+            raise Exception('unable to search %s'%'; '.join('%s: %s'%(target, error) for target, error in errors.items()))
+        if(len(response) < 2 and not complete):
+            raise FanoutTimeout('the search did not finish within %ss'%timeout)
+        return (bool(response), response)
+
+    status, _, response, _ = conn.search(
+            search_base=base,
+            search_filter=search_filter,
+            attributes=attributes)
+    return (status, response)
+
+def _shaped(entry, attributes, compact):
+    '''returns entry as a PosixAccount if compact was asked for'''
+    if(not compact or entry == None):
+        return entry
+    return PosixAccount.fromentry(entry, attributes)
+
+def _getmany(conn, attribute, keys, base, attributes, chunk_size, workers, compact=False):
+    '''search for entries matching any of keys on attribute, in chunks'''
+    from ldap3.utils.conv import escape_filter_chars
+    from concurrent.futures import ThreadPoolExecutor
+    from contextvars import copy_context
+    attributes=list(attributes)
+    if('*' not in attributes and attribute not in attributes):
+        attributes.append(attribute)
+
+    # uid matching is case-insensitive, so index on the folded value
+    fold=(lambda key: key.lower()) if attribute == 'uid' else int
+    wanted={}
+    for key in keys:
+        wanted.setdefault(fold(key), key)
+    unique=list(wanted.values())
+
+    chunks=[unique[i:i+chunk_size] for i in range(0, len(unique), chunk_size)]
+
+    def search(chunk):
+        search_filter=''.join('(%s=%s)'%(attribute, escape_filter_chars(str(key))) for key in chunk)
+        if(len(chunk) > 1):
+            search_filter='(|%s)'%search_filter
+        if(isinstance(conn, ConnectionPool)):
+            with conn.connection() as pooled:
+                status, result, response, _ = pooled.search(base, search_filter, attributes=attributes)
+        else:
+            status, result, response, _ = conn.search(base, search_filter, attributes=attributes)
+        if(not status and result['result'] != 0):
+            raise Exception('search failed: %s'%result['description'])
+        entries=[entry for entry in response if entry.get('type') == 'searchResEntry']
+        if(compact):
+            # drop each chunk's responses as soon as they are converted
+            return [PosixAccount.fromentry(entry) for entry in entries]
+        return entries
+
+    if(isinstance(conn, ConnectionPool) and workers > 1 and len(chunks) > 1):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # each search runs in a copy of this context, so metrics keep the helper label
+            futures=[executor.submit(copy_context().run, search, chunk) for chunk in chunks]
+            responses=[future.result() for future in futures]
+    else:
+        responses=[search(chunk) for chunk in chunks]
+
+    matches={}
+    for response in responses:
+        for entry in response:
+            values=entry.values(attribute) if compact else entry['attributes'].get(attribute, [])
+            if(not isinstance(values, list)):
+                values=[values]
+            for value in values:
+                try:
+                    folded=fold(value)
+                except (TypeError, ValueError):
+                    continue
+                if(folded in wanted):
+                    matches.setdefault(wanted[folded], []).append(entry)
+
+    found={}
+    duplicates={}
+    for key, entries in matches.items():
+        if(len(entries) == 1):
+            found[key]=entries[0]
+        else:
+            duplicates[key]=entries
+    missing=[key for key in unique if key not in matches]
+
+    return (found, missing, duplicates)
+
+def _readkeys(filename):
+    '''yield stripped, non-empty lines from a file (or stdin for -)'''
+    handle=stdin if filename == '-' else open(filename)
+    try:
+        for line in handle:
+            line=line.strip()
+            if(line):
+                yield line
+    finally:
+        if(handle is not stdin):
+            handle.close()
+
 if __name__ == '__main__':
     parser = argparser('print a user matching the posix username or uid')
     parser.add_argument('--username',
@@ -83,21 +335,126 @@ if __name__ == '__main__':
     parser.add_argument('--uid',
             default=None,
             help='posix uid to find')
+    parser.add_argument('--from-file',
+            default=None,
+            help='file of usernames one per line (- for stdin), prints JSON lines')
+    parser.add_argument('--by-uid',
+            action='store_true',
+            help='the --from-file lines are posix uids instead of usernames')
+    parser.add_argument('--workers',
+            type=int,
+            default=4,
+            help='concurrent searches for --from-file')
+    parser.add_argument('--chunk-size',
+            type=int,
+            default=100,
+            help='names per search for --from-file')
+    parser.add_argument('--attributes',
+            default='*',
+            help='comma separated attributes to fetch (ex: uid,uidNumber,gidNumber,homeDirectory)')
     parser.add_argument('--base',
-            default='ou=People,dc=company,dc=com',
-            help='OU to search (ex: ou=People,dc=company,dc=com)')
+            action='append',
+            default=None,
+            help='OU to search (ex: ou=People,dc=company,dc=com), repeat to search several at once')
+    parser.add_argument('--all-servers',
+            action='store_true',
+            help='search every server in -s at once, instead of one of them')
+    parser.add_argument('--timeout',
+            type=float,
+            default=None,
+            help='seconds to wait for several bases or servers to answer')
+    parser.add_argument('--exists',
+            action='store_true',
+            help='only check that --username exists, prints True or False')
+    parser.add_argument('--dn',
+            default=None,
+            help='with --exists, the dn the user would have, checked with a compare instead of a search')
+    parser.add_argument('--preflight',
+            action='store_true',
+            help='warn if the server can not answer the search from an index')
     args = parser.parse_args()
-    conn = connect(args=args)
+    bases=args.base or ['ou=People,dc=company,dc=com']
+    base=bases[0] if len(bases) == 1 else bases
+    attributes=args.attributes.split(',')
+    # only keep the full search responses around when every attribute is wanted
+    compact='*' not in attributes
 
+    if(args.preflight):
+        from ldaptools.preflight import preflight
+        from ldap3.utils.conv import escape_filter_chars
+        search_filter='(uidNumber=%s)'%escape_filter_chars(args.uid) if args.uid and not args.username else '(uid=%s)'%escape_filter_chars(args.username)
+        for warning in preflight(connect(args=args), search_filter):
+            print('warning: %s'%warning, file=stderr)
+
+    if(args.exists):
+        if(not args.username or len(bases) > 1 or args.all_servers):
+            print('--exists checks one --username in a single --base on one server')
+            exit(1)
+        forwarded, result = forward(args, 'userexists', username=args.username, base=base, dn=args.dn)
+        if(not forwarded):
+            result = userexists(connect(args=args), args.username, base, dn=args.dn)
+        print(result[0])
+        exit(0 if result[0] else 1)
+
+    if(args.from_file):
+        if(len(bases) > 1 or args.all_servers):
+            print('--from-file searches a single --base on one server')
+            exit(1)
+        lookup=getuids if args.by_uid else getusers
+        keys=_readkeys(args.from_file)
+        failed=False
+        with ConnectionPool(max_size=args.workers, args=args) as pool:
+            while(True):
+                batch=list(islice(keys, args.chunk_size*args.workers))
+                if(not batch):
+                    break
+                if(args.by_uid):
+                    # a line that is not a uid is reported like a key that was not found
+                    for key in [key for key in batch if not key.isdigit()]:
+                        print(dumps({'key': key, 'found': False, 'error': 'not a uid'}))
+                        failed=True
+                    batch=[key for key in batch if key.isdigit()]
+                    if(not batch):
+                        continue
+                found, missing, duplicates = lookup(pool, batch, base,
+                        attributes=attributes,
+                        chunk_size=args.chunk_size,
+                        workers=args.workers,
+                        compact=compact)
+                for key, entry in found.items():
+                    print(dumps({'key': key, 'found': True, 'dn': entry['dn'], 'attributes': dict(entry['attributes'])}, default=str))
+                for key in missing:
+                    print(dumps({'key': key, 'found': False}))
+                for key, entries in duplicates.items():
+                    print(dumps({'key': key, 'found': False, 'error': 'duplicate', 'dns': [e['dn'] for e in entries]}))
+                failed=failed or bool(missing) or bool(duplicates)
+        exit(1 if failed else 0)
+
+    forwarded=False
     if(args.username):
-        found, response = getuser(conn, args.username, args.base)
+        if(not args.all_servers):
+            forwarded, result = forward(args, 'getuser', username=args.username, base=base, attributes=attributes, timeout=args.timeout)
+        if(not forwarded):
+            conn = connectall(args=args) if args.all_servers else connect(args=args)
+            result = getuser(conn, args.username, base, attributes=attributes, compact=compact, timeout=args.timeout)
     elif(args.uid):
-        found, response = getuid(conn, args.uid, args.base)
+        if(not args.all_servers):
+            forwarded, result = forward(args, 'getuid', uid=args.uid, base=base, attributes=attributes, timeout=args.timeout)
+        if(not forwarded):
+            conn = connectall(args=args) if args.all_servers else connect(args=args)
+            result = getuid(conn, args.uid, base, attributes=attributes, compact=compact, timeout=args.timeout)
     else:
         print('either --username or --uid must be provided')
-        sys.exit(1)
+        exit(1)
+    found, response = result
+    if(forwarded and found):
+        # the daemon answers with the search response, shape it like a direct lookup
+        response=_shaped(response, attributes, compact)
 
     if(found):
+        from pprint import pprint
+        if(isinstance(response, PosixAccount)):
+            response={'dn': response.dn, 'attributes': response.asdict()}
         pprint(response)
     else:
         print('not found')
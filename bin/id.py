@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''print a user's uid, primary gid and groups, like id(1)'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import connect, argparser
+from ldaptools.metrics import helper
+from ldaptools.groups import GroupIndex
+from bin.getuser import getuser, getusers, _readkeys
+from itertools import islice
+from json import dumps
+
+# the user attributes id needs
+ATTRIBUTES=['uid', 'uidNumber', 'gidNumber']
+
+@helper('id')
+def userid(conn, username, base, groups, nested=True):
+    '''returns a user's uidNumber, gidNumber and groups
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    username(string): the posix username to look up
+    base(string): the basedn holding the user
+    groups(object): a loaded ldaptools.groups.GroupIndex
+    nested(bool): include the groups that the user's groups are members of
+
+    Returns two values in a tuple:
+    True/False depending on whether the user was found
+    a dict of uid, uidNumber, gidNumber and groups, or None if not found
+    '''
+    found, user = getuser(conn, username, base, attributes=ATTRIBUTES, compact=True)
+    if(not found):
+        return (False, None)
+    return (True, _described(user, groups.getgroups(username, user.get('gidNumber'), nested)))
+
+def _described(user, groups):
+    return {
+        'uid': user.get('uid'),
+        'uidNumber': user.get('uidNumber'),
+        'gidNumber': user.get('gidNumber'),
+        'groups': groups,
+        }
+
+def formatid(described):
+    '''returns the id(1) line for a dict from userid'''
+    primary=[g['cn'] for g in described['groups'] if g['gidNumber'] == described['gidNumber']]
+    names=[('%s(%s)'%(g['gidNumber'], g['cn']) if g['gidNumber'] != None else g['cn']) for g in described['groups']]
+    return 'uid=%s(%s) gid=%s%s groups=%s'%(
+            described['uidNumber'],
+            described['uid'],
+            described['gidNumber'],
+            '(%s)'%primary[0] if primary else '',
+            ','.join(names))
+
+if __name__ == '__main__':
+    parser = argparser("print a user's uid, primary gid and groups, like id(1)")
+    parser.add_argument('--username',
+            default=None,
+            help='posix username to describe')
+    parser.add_argument('--from-file',
+            default=None,
+            help='file of usernames one per line (- for stdin), prints JSON lines')
+    parser.add_argument('--base',
+            default='ou=People,dc=company,dc=com',
+            help='OU holding the users (ex: ou=People,dc=company,dc=com)')
+    parser.add_argument('--group-base',
+            default='ou=Group,dc=company,dc=com',
+            help='OU holding the groups (ex: ou=Group,dc=company,dc=com)')
+    parser.add_argument('--direct',
+            action='store_true',
+            help='only list the groups the user is a member of directly')
+    parser.add_argument('--chunk-size',
+            type=int,
+            default=100,
+            help='names per search for --from-file')
+    parser.add_argument('--page-size',
+            type=int,
+            default=1000,
+            help='groups to request per page')
+    args = parser.parse_args()
+
+    if(not args.username and not args.from_file):
+        print('either --username or --from-file must be provided')
+        exit(1)
+
+    conn=connect(args=args)
+    groups=GroupIndex(args.group_base)
+    groups.load(conn, args.page_size)
+
+    if(args.from_file):
+        keys=_readkeys(args.from_file)
+        failed=False
+        while(True):
+            batch=list(islice(keys, args.chunk_size))
+            if(not batch):
+                break
+            found, missing, duplicates = getusers(conn, batch, args.base,
+                    attributes=ATTRIBUTES,
+                    chunk_size=args.chunk_size,
+                    compact=True)
+            memberships=groups.getgroups_many(list(found),
+                    {key: user.get('gidNumber') for key, user in found.items()},
+                    nested=not args.direct)
+            for key, user in found.items():
+                print(dumps(dict(_described(user, memberships[key]), key=key, found=True)))
+            for key in missing:
+                print(dumps({'key': key, 'found': False}))
+            for key, entries in duplicates.items():
+                print(dumps({'key': key, 'found': False, 'error': 'duplicate', 'dns': [e.dn for e in entries]}))
+            failed=failed or bool(missing) or bool(duplicates)
+        exit(1 if failed else 0)
+
+    found, described = userid(conn, args.username, args.base, groups, nested=not args.direct)
+    if(not found):
+        print('not found')
+        exit(1)
+    print(formatid(described))
@@ -5,32 +5,111 @@
 # the ldaptools module has not been "installed". This inserts the 
 # project directory into python's path, so the module can be found
 from pathlib import Path
-from sys import exit, path
+from sys import exit, path, stderr
 project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
 from ldaptools import connect, argparser
+from ldaptools.metrics import helper
+from ldaptools.daemon import forward
+from ldaptools.fanout import fanout, connectall, FanoutTimeout
 
-def isuidfree(conn, uid, base):
+@helper('isuidfree')
+def isuidfree(conn, uid, base, chunk_size=100, cache=None, timeout=None, exists_only=False, time_limit=None):
     '''check if a UID is free within a particular search base
 
+    A list of uids can be checked at once, in which case they are grouped
+    into (|(uidNumber=a)(uidNumber=b)...) filters of at most chunk_size uids,
+    and the uids are only considered free if none of them are in use.
+
+    With a cache (a ldaptools.replica.Replica, or a ldaptools.cache.UserCache)
+    only the uids it does not know about are searched for.
+
+    Given a list of bases or of connections, every base is searched on every
+    server at once (see ldaptools.fanout).  Checking a single uid then stops
+    at the first server and base that has it.
+
+    With exists_only, the searches ask for no attributes (1.1) and a size
+    limit of one entry, so the server stops at the first match and sends
+    back only its dn.  The entries returned then say which uids are taken
+    only by their dns, so callers that read uidNumber from them (genuid)
+    must not use it.
+
     Parameters:
-    conn(object): a ldap3 connection object
-    uid(int): a numeric UID to check posix users for a free uid
-    base(string): the basedn to search
+    conn(object): a ldap3 connection object, or a list of them to check every server
+    uid(int or list): a numeric UID (or a list of them) to check posix users for a free uid
+    base(string): the basedn to search, or a list of them to check all at once
+    chunk_size(int): the maximum number of uids to check per search
+    cache(object): a ldaptools.replica.Replica or ldaptools.cache.UserCache to answer from
+    timeout(float): seconds each fan-out waits for the bases and servers to answer
+    exists_only(bool): only find out whether any of the uids is taken, see above
+    time_limit(int): seconds the server may spend on each search (default the server's limit)
 
     Returns two values in a tuple:
     True if the uid is free, False if a user already has it
     array of dicts containing matching responses
+
+    Raises:
+    Exception if a base could not be searched and no other base had the uid
+    FanoutTimeout if the bases and servers did not answer within timeout
     '''
-    status, _, response, _ = conn.search(
-            search_base=base,
-            search_filter='(uidNumber=%s)'%uid,
-            attributes=['uidNumber'])
+    if(not isinstance(uid, (list, tuple, set))):
+        uid=[uid]
+    uids=[int(u) for u in uid]
+
+    attributes=['1.1'] if exists_only else ['uidNumber']
+    found=False
+    responses=[]
+    if(cache != None):
+        unknown=[]
+        for u in uids:
+            # a replica can hand back every user sharing a uid, a UserCache only one
+            if(hasattr(cache, 'lookupall')):
+                known, entries = cache.lookupall('uidNumber', u)
+            else:
+                known, entry = cache.lookup('uidNumber', u)
+                entries=[] if entry == None else [entry]
+            if(not known):
+                unknown.append(u)
+            elif(entries):
+                found=True
+                responses.extend(entries)
+        uids=unknown
+        if(found and exists_only):
+            return (False, responses)
+
+    for i in range(0, len(uids), chunk_size):
+        chunk=uids[i:i+chunk_size]
+        search_filter='(uidNumber=%s)'%chunk[0]
+        if(len(chunk) > 1):
+            search_filter='(|%s)'%''.join('(uidNumber=%s)'%u for u in chunk)
+
+        if(isinstance(conn, (list, tuple)) or not isinstance(base, str)):
+            # one hit settles a single uid, a list needs every taken uid reported
+            stop=(lambda entries: len(entries) > 0) if len(uids) == 1 or exists_only else None
+            response, errors, complete = fanout(conn, base, search_filter, attributes, timeout, stop)
+            if(not response and errors):
+                raise Exception('unable to search %s'%'; '.join('%s: %s'%(target, error) for target, error in errors.items()))
+            if(not response and not complete):
+                raise FanoutTimeout('the search did not finish within %ss'%timeout)
+            status=bool(response)
+        else:
+            status, _, response, _ = conn.search(
+                    search_base=base,
+                    search_filter=search_filter,
+                    attributes=attributes,
+                    size_limit=1 if exists_only else 0,
+                    time_limit=time_limit or 0)
+            # a size limited search that found more says sizeLimitExceeded
+            status=status or (exists_only and len(response) > 0)
+        found=found or status
+        responses.extend(response)
+        if(found and exists_only):
+            break
 
     # returns false if status is true(result found)
     # returns true if status is false(result not found)
-    return (not status, response)
+    return (not found, responses)
 
 if __name__ == '__main__':
     parser = argparser('check if uid is free')
@@ -39,12 +118,37 @@ if __name__ == '__main__':
             required=True,
             help='uid to check')
     parser.add_argument('--base',
-            default='ou=People,dc=company,dc=com',
-            help='OU to search (ex: ou=People,dc=company,dc=com)')
+            action='append',
+            default=None,
+            help='OU to search (ex: ou=People,dc=company,dc=com), repeat to check several at once')
+    parser.add_argument('--all-servers',
+            action='store_true',
+            help='check every server in -s at once, instead of one of them')
+    parser.add_argument('--timeout',
+            type=float,
+            default=None,
+            help='seconds to wait for several bases or servers to answer')
+    parser.add_argument('--preflight',
+            action='store_true',
+            help='warn if the server can not answer the search from an index')
     args = parser.parse_args()
-    conn = connect(args=args)
+    bases=args.base or ['ou=People,dc=company,dc=com']
+    base=bases[0] if len(bases) == 1 else bases
+    # the matching entries are only printed with -v
+    exists_only=not args.verbose
+
+    if(args.preflight):
+        from ldaptools.preflight import preflight
+        for warning in preflight(connect(args=args), '(uidNumber=%s)'%args.uid):
+            print('warning: %s'%warning, file=stderr)
 
-    free, response = isuidfree(conn, args.uid, args.base)
+    forwarded=False
+    if(not args.all_servers):
+        forwarded, result = forward(args, 'isuidfree', uid=args.uid, base=base, timeout=args.timeout, exists_only=exists_only)
+    if(not forwarded):
+        conn = connectall(args=args) if args.all_servers else connect(args=args)
+        result = isuidfree(conn, args.uid, base, timeout=args.timeout, exists_only=exists_only)
+    free, response = result
     print(free)
     if(args.verbose):
         print(response)
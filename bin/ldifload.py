@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+'''load an LDIF file of adds, modifies, renames and deletes into the directory'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, stderr
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import argparser, serverinfo
+from ldaptools.metrics import helper
+from ldaptools.pool import ConnectionPool
+from ldaptools.throttle import throttleargs, getthrottle, describe
+from ldap3 import MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE, MODIFY_INCREMENT
+from ldap3.utils.dn import to_dn
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from collections import Counter, deque
+from base64 import b64decode
+from time import monotonic
+from json import loads, dumps
+from os import replace
+
+# ldap result codes that mean the change was already made (a resumed run)
+RESULT_NO_SUCH_ATTRIBUTE=16
+RESULT_ATTRIBUTE_OR_VALUE_EXISTS=20
+RESULT_NO_SUCH_OBJECT=32
+RESULT_ENTRY_ALREADY_EXISTS=68
+
+# per changetype, the result codes a record applied before gets when it is
+# applied again; adds and deletes always, the others only in a resumed run
+# (a modify that deletes a value another record already removed, or a modrdn
+# of an entry that is not there, is an error the first time)
+ALREADY={'add': (RESULT_ENTRY_ALREADY_EXISTS,), 'delete': (RESULT_NO_SUCH_OBJECT,)}
+ALREADY_RESUMED={
+    'modify': (RESULT_NO_SUCH_ATTRIBUTE, RESULT_ATTRIBUTE_OR_VALUE_EXISTS),
+    'modrdn': (RESULT_NO_SUCH_OBJECT, RESULT_ENTRY_ALREADY_EXISTS),
+    }
+
+# LDAP Transactions (RFC 5805)
+START_TRANSACTION='1.3.6.1.1.21.1'
+TRANSACTION_SPECIFICATION='1.3.6.1.1.21.2'
+END_TRANSACTION='1.3.6.1.1.21.3'
+
+MODIFY_OPERATIONS={
+    'add': MODIFY_ADD,
+    'delete': MODIFY_DELETE,
+    'replace': MODIFY_REPLACE,
+    'increment': MODIFY_INCREMENT,
+    }
+
+def readldif(handle, number=0):
+    '''yield the change records of an LDIF file (RFC 2849) one at a time
+
+    Only the current record is held in memory.  Content records (no
+    changetype) are returned as adds, and control: lines are ignored.
+
+    Every record is a dict with:
+    number: its position in the file, counting from 1
+    offset, end: the bytes it spans, end is where the next record can be read from
+    dn, changetype: 'add', 'delete', 'modify' or 'modrdn'
+    attributes: for add, a dict of attribute to a list of values
+    changes: for modify, a list of (operation, attribute, values)
+    newrdn, deleteoldrdn, newsuperior: for modrdn
+
+    Parameters:
+    handle(file): the LDIF file opened in binary mode, at the start of a record
+    number(int): the number of the record before the first one read
+
+    Raises:
+    ValueError if a record can not be parsed
+    '''
+    offset=handle.tell()
+    start=offset
+    lines=[]
+    for raw in handle:
+        position=offset
+        offset+=len(raw)
+        line=raw.rstrip(b'\r\n')
+        if(not line):
+            if(lines):
+                record=_record(lines, number+1, start, offset)
+                lines=[]
+                if(record != None):
+                    number+=1
+                    yield record
+            continue
+        if(line.startswith(b' ') and lines):
+            lines[-1]+=line[1:]
+            continue
+        if(not lines):
+            start=position
+        lines.append(line)
+
+    if(lines):
+        record=_record(lines, number+1, start, offset)
+        if(record != None):
+            yield record
+
+def _record(lines, number, start, end):
+    '''build a record dict from its unfolded lines, None if it holds no change'''
+    pairs=[_pair(line) for line in lines if not line.startswith(b'#')]
+    if(pairs and pairs[0][0].lower() == 'version'):
+        pairs=pairs[1:]
+    if(not pairs):
+        return None
+    if(pairs[0][0].lower() != 'dn'):
+        raise ValueError('record %s (byte %s) does not start with a dn'%(number, start))
+
+    record={'number': number, 'offset': start, 'end': end, 'dn': _text(pairs[0][1]), 'changetype': 'add'}
+    rest=[pair for pair in pairs[1:] if pair[0].lower() != 'control']
+    if(rest and rest[0][0].lower() == 'changetype'):
+        record['changetype']=_text(rest[0][1]).strip().lower()
+        rest=rest[1:]
+
+    changetype=record['changetype']
+    if(changetype == 'add'):
+        attributes={}
+        for name, value in rest:
+            attributes.setdefault(name, []).append(value)
+        record['attributes']=attributes
+    elif(changetype in ('modrdn', 'moddn')):
+        record['changetype']='modrdn'
+        fields={name.lower(): value for name, value in rest}
+        record['newrdn']=_text(fields.get('newrdn'))
+        record['deleteoldrdn']=_text(fields.get('deleteoldrdn', '1')).strip() == '1'
+        record['newsuperior']=_text(fields['newsuperior']) if 'newsuperior' in fields else None
+    elif(changetype == 'modify'):
+        changes=[]
+        current=None
+        for name, value in rest:
+            if(name == '-'):
+                current=None
+            elif(current == None):
+                if(name.lower() not in MODIFY_OPERATIONS):
+                    raise ValueError('record %s (%s) has an unknown modify operation %s'%(number, record['dn'], name))
+                current=(name.lower(), _text(value).strip(), [])
+                changes.append(current)
+            else:
+                current[2].append(value)
+        record['changes']=changes
+    elif(changetype != 'delete'):
+        raise ValueError('record %s (%s) has an unknown changetype %s'%(number, record['dn'], changetype))
+    return record
+
+def _pair(line):
+    '''split an unfolded LDIF line into its name and value (bytes if base64 or a url)'''
+    if(line == b'-'):
+        return ('-', None)
+    colon=line.find(b':')
+    if(colon < 1):
+        raise ValueError('unable to parse LDIF line %r'%line[:80])
+    name=line[:colon].decode('utf-8')
+    value=line[colon+1:]
+    if(value.startswith(b':')):
+        return (name, b64decode(value[1:].strip()))
+    if(value.startswith(b'<')):
+        url=value[1:].strip().decode('utf-8')
+        if(not url.startswith('file://')):
+            raise ValueError('only file:// urls are supported (%s)'%url)
+        return (name, Path(url[7:]).read_bytes())
+    return (name, value.lstrip(b' ').decode('utf-8'))
+
+def _text(value):
+    if(isinstance(value, (bytes, bytearray))):
+        return bytes(value).decode('utf-8')
+    return value
+
+def _fold(dn):
+    return dn.lower()
+
+def _parent(dn):
+    '''the folded parent dn, '' for a top level entry'''
+    try:
+        return _fold(','.join(to_dn(dn)[1:]))
+    except Exception:
+        return ''
+
+def _dns(record):
+    '''the folded dns a record touches: its own, and for renames the new one'''
+    dns=[_fold(record['dn'])]
+    if(record['changetype'] == 'modrdn'):
+        superior=record['newsuperior'] or ','.join(to_dn(record['dn'])[1:])
+        dns.append(_fold('%s,%s'%(record['newrdn'], superior)))
+    return dns
+
+def _conflicts(unit, busy):
+    '''True if a unit of records must wait for one of the dns in flight'''
+    for record in unit:
+        for dn in _dns(record):
+            if(busy[dn] or busy[_parent(dn)]):
+                return True
+            # children in flight go first: a delete needs them gone, and an add
+            # has to see which of them failed for want of it
+            if(any(count and other.endswith(','+dn) for other, count in busy.items())):
+                return True
+    return False
+
+def apply(conn, record, controls=None):
+    '''run one LDIF record against the directory
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    record(dict): a record from readldif
+    controls(list): ldap3 controls to send with the operation
+
+    Returns two values in a tuple:
+    True if the operation succeeded
+    the ldap result dict
+    '''
+    changetype=record['changetype']
+    if(changetype == 'add'):
+        status, result, _, _ = conn.add(record['dn'], attributes=record['attributes'], controls=controls)
+    elif(changetype == 'delete'):
+        status, result, _, _ = conn.delete(record['dn'], controls=controls)
+    elif(changetype == 'modify'):
+        changes={}
+        for operation, attribute, values in record['changes']:
+            changes.setdefault(attribute, []).append((MODIFY_OPERATIONS[operation], values))
+        status, result, _, _ = conn.modify(record['dn'], changes, controls=controls)
+    else:
+        status, result, _, _ = conn.modify_dn(record['dn'], record['newrdn'],
+                delete_old_dn=record['deleteoldrdn'],
+                new_superior=record['newsuperior'],
+                controls=controls)
+    return (status, result)
+
+def supportstransactions(conn):
+    '''True if the server advertises the LDAP Transactions extended operation'''
+    info=conn.server.info
+    if(info == None):
+        info, _ = serverinfo(conn)
+    return START_TRANSACTION in [extension[0] for extension in (info.supported_extensions or [])]
+
+def transaction(conn, records):
+    '''run records in one LDAP transaction (RFC 5805), all or nothing
+
+    Parameters:
+    conn(object): a ldap3 connection object, used for nothing else meanwhile
+    records(list): records from readldif
+
+    Returns:
+    a list of (record, status, result) if the transaction committed,
+    or None if it was refused or rolled back, in which case nothing was changed
+    '''
+    status, result, _, _ = conn.extended(START_TRANSACTION)
+    if(not status or not result.get('responseValue')):
+        return None
+    identifier=result['responseValue']
+    controls=[(TRANSACTION_SPECIFICATION, True, identifier)]
+
+    outcomes=[]
+    for record in records:
+        status, result = apply(conn, record, controls)
+        if(not status):
+            conn.extended(END_TRANSACTION, _endtransaction(identifier, False))
+            return None
+        outcomes.append((record, status, result))
+
+    status, _, _, _ = conn.extended(END_TRANSACTION, _endtransaction(identifier, True))
+    return outcomes if status else None
+
+def _endtransaction(identifier, commit):
+    '''BER encode a txnEndReq: SEQUENCE { commit BOOLEAN DEFAULT TRUE, identifier OCTET STRING }'''
+    body=(b'' if commit else _ber(0x01, b'\x00'))+_ber(0x04, bytes(identifier))
+    return _ber(0x30, body)
+
+def _ber(tag, value):
+    length=len(value)
+    if(length < 0x80):
+        return bytes([tag, length])+value
+    encoded=length.to_bytes((length.bit_length()+7)//8, 'big')
+    return bytes([tag, 0x80|len(encoded)])+encoded+value
+
+def readcheckpoint(filename):
+    '''returns the checkpoint ldifload last wrote, or None'''
+    if(filename == None or not Path(filename).exists()):
+        return None
+    return loads(Path(filename).read_text())
+
+@helper('ldifload')
+def ldifload(conn, filename, window=16, transactions=None, batch_size=100, checkpoint=None, errors=None, checkpoint_every=1000, progress=None, max_wait=10000):
+    '''apply every record of an LDIF file, concurrently but in a safe order
+
+    Records are read as a stream.  Up to window operations run at once,
+    but a record waits while anything touching its dn, its parent or (for
+    deletes and renames) its children is in flight, so entries are created
+    parent first as they appear in the file.  An add that fails because its
+    parent does not exist yet is held back until the parent is added later
+    in the file, or fails once max_wait more records have been read without
+    it, so a parent that never comes does not hold the checkpoint back (and
+    every record read since in memory) until the end of the file.
+
+    With transactions, batch_size consecutive records are sent as one LDAP
+    transaction per connection; a batch that is refused or rolled back is
+    retried one record at a time.  Transactions are used by default when
+    the server advertises them.
+
+    The checkpoint file records the last record before which everything is
+    done, and the byte offset to continue from.  Running again with the
+    same checkpoint skips straight there; the few records that finished
+    past it are applied again, and adds that already exist or deletes of
+    entries already gone count as already done, as do (in the resumed run)
+    modifies that find the values already added or removed and renames
+    whose entry has already moved.
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+        (pass a pool to actually run operations concurrently)
+    filename(string): the LDIF file
+    window(int): the maximum number of operations (or transactions) in flight
+    transactions(bool): True or False to force LDAP transactions on or off, None to detect
+    batch_size(int): the number of records per transaction
+    checkpoint(string): a file to save progress to and resume from
+    errors(string): a file to append failed records to, as JSON lines
+    checkpoint_every(int): records between checkpoint writes
+    progress(callable): called with (counts, seconds) after every checkpoint write
+    max_wait(int): records read past an add held back for its parent before it fails
+
+    Returns:
+    a dict counting records by outcome (ok, already, failed)
+
+    Raises:
+    ValueError if the file can not be parsed
+    Exception if the connection fails (resume from the checkpoint)
+    '''
+    def borrowed():
+        return conn.connection() if isinstance(conn, ConnectionPool) else nullcontext(conn)
+
+    if(transactions == None):
+        with borrowed() as checkconn:
+            transactions=supportstransactions(checkconn)
+    if(not isinstance(conn, ConnectionPool)):
+        # one connection can only run one operation, or transaction, at a time safely
+        window=1 if transactions else window
+
+    saved=readcheckpoint(checkpoint)
+    number, offset = (saved['number'], saved['offset']) if saved else (0, 0)
+    counts=dict(saved['counts']) if saved else {'ok': 0, 'already': 0, 'failed': 0}
+    started=monotonic()
+
+    # the records read but not yet done, by number -> end offset
+    ends={}
+    completed=set()
+    watermark={'number': number, 'offset': offset, 'since': 0}
+
+    def save():
+        if(checkpoint != None):
+            with open(checkpoint+'.tmp', 'w') as handle:
+                handle.write(dumps({'ldif': str(filename), 'number': watermark['number'], 'offset': watermark['offset'], 'counts': counts}))
+            replace(checkpoint+'.tmp', checkpoint)
+        if(progress != None):
+            progress(dict(counts), monotonic()-started)
+
+    def done(record):
+        completed.add(record['number'])
+        while(watermark['number']+1 in completed):
+            watermark['number']+=1
+            completed.discard(watermark['number'])
+            watermark['offset']=ends.pop(watermark['number'])
+        watermark['since']+=1
+        if(watermark['since'] >= checkpoint_every):
+            watermark['since']=0
+            save()
+
+    errorlog=open(errors, 'a') if errors != None else None
+    deferred={}     # folded parent dn -> records waiting for it to be added
+    waiting={}      # folded dn of a deferred record -> the parent dn it waits on
+    ready=deque()   # units to send, in order, before reading more of the file
+    busy=Counter()  # folded dn -> operations in flight touching it
+    inflight={}     # future -> unit
+
+    def outcome(record, status, result, final=False):
+        changetype=record['changetype']
+        code=result.get('result') if result else None
+        if(status):
+            counts['ok']+=1
+        elif(code in ALREADY.get(changetype, ()) or (saved and code in ALREADY_RESUMED.get(changetype, ()))):
+            counts['already']+=1
+        elif(changetype == 'add' and code == RESULT_NO_SUCH_OBJECT and not final):
+            # the parent may come later in the file
+            defer(record, _parent(record['dn']))
+            return
+        else:
+            counts['failed']+=1
+            if(errorlog != None):
+                errorlog.write(dumps({'number': record['number'], 'dn': record['dn'], 'changetype': changetype,
+                        'result': code, 'error': result.get('description') if result else None, 'message': result.get('message') if result else None})+'\n')
+                errorlog.flush()
+        if(changetype == 'add' and (status or code == RESULT_ENTRY_ALREADY_EXISTS)):
+            # the held back records go next, ahead of the rest of the file
+            children=deferred.pop(_fold(record['dn']), [])
+            for child in reversed(children):
+                for dn in _dns(child):
+                    waiting.pop(dn, None)
+                ready.appendleft([child])
+        done(record)
+
+    def run(unit):
+        with borrowed() as opconn:
+            if(len(unit) > 1):
+                return transaction(opconn, unit)
+            status, result = apply(opconn, unit[0])
+            return [(unit[0], status, result)]
+
+    def reap(finished):
+        for future in finished:
+            unit=inflight.pop(future)
+            for record in unit:
+                for dn in _dns(record):
+                    busy[dn]-=1
+                    if(not busy[dn]):
+                        del busy[dn]
+            outcomes=future.result()
+            if(outcomes == None):
+                # the transaction was refused or rolled back, go one by one
+                for record in reversed(unit):
+                    ready.appendleft([record])
+                continue
+            for record, status, result in outcomes:
+                outcome(record, status, result)
+
+    def expire(last):
+        '''fail the records held back since before record number last-max_wait'''
+        for parent, records in list(deferred.items()):
+            stale=[record for record in records if record['number'] <= last-max_wait]
+            if(not stale):
+                continue
+            kept=[record for record in records if record['number'] > last-max_wait]
+            if(kept):
+                deferred[parent]=kept
+            else:
+                del deferred[parent]
+            for record in stale:
+                for dn in _dns(record):
+                    waiting.pop(dn, None)
+                outcome(record, False, {'result': RESULT_NO_SUCH_OBJECT, 'description': 'noSuchObject',
+                        'message': 'the parent entry was not added within %s records'%max_wait}, True)
+
+    def defer(record, parent):
+        deferred.setdefault(parent, []).append(record)
+        for dn in _dns(record):
+            waiting[dn]=parent
+
+    def drain(executor):
+        '''send the units in ready, in order, as the window and the dns in flight allow'''
+        while(ready):
+            unit=ready[0]
+            if(inflight and (len(inflight) >= window or _conflicts(unit, busy))):
+                # reaping can put records ahead of this unit, so look again after
+                finished, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+                reap(finished)
+                continue
+            ready.popleft()
+            # records on an entry whose add is held back wait behind it, in file order
+            kept=[]
+            for record in unit:
+                parent=next((waiting[dn] for dn in _dns(record)+[_parent(dn) for dn in _dns(record)] if dn in waiting), None)
+                if(parent != None):
+                    defer(record, parent)
+                else:
+                    kept.append(record)
+            if(not kept):
+                continue
+            for record in kept:
+                for dn in _dns(record):
+                    busy[dn]+=1
+            inflight[executor.submit(run, kept)]=kept
+
+    def units(records):
+        '''group the records into transactions, or one unit per record'''
+        unit=[]
+        for record in records:
+            ends[record['number']]=record['end']
+            unit.append(record)
+            if(not transactions or len(unit) >= batch_size):
+                yield unit
+                unit=[]
+        if(unit):
+            yield unit
+
+    try:
+        with open(filename, 'rb') as handle, ThreadPoolExecutor(max_workers=window) as executor:
+            handle.seek(offset)
+            for unit in units(readldif(handle, number)):
+                ready.append(unit)
+                drain(executor)
+                if(deferred):
+                    expire(unit[-1]['number'])
+
+            while(inflight or ready):
+                drain(executor)
+                if(inflight):
+                    finished, _ = wait(list(inflight), return_when=FIRST_COMPLETED)
+                    reap(finished)
+
+        # records whose parent never showed up
+        for records in list(deferred.values()):
+            for record in records:
+                outcome(record, False, {'result': RESULT_NO_SUCH_OBJECT, 'description': 'noSuchObject', 'message': 'the parent entry was never added'}, True)
+        deferred.clear()
+        waiting.clear()
+    finally:
+        save()
+        if(errorlog != None):
+            errorlog.close()
+
+    return counts
+
+if __name__ == '__main__':
+    parser = argparser('load an LDIF file of changes, resumable')
+    parser.add_argument('--from-file',
+            required=True,
+            help='LDIF file to load')
+    parser.add_argument('--checkpoint',
+            default=None,
+            help='file to save progress to, reused to resume an interrupted load')
+    parser.add_argument('--errors',
+            default=None,
+            help='file to append failed records to as JSON lines')
+    parser.add_argument('--window',
+            type=int,
+            default=16,
+            help='operations (or transactions) in flight')
+    parser.add_argument('--transactions',
+            choices=['auto','on','off'],
+            default='auto',
+            help='group records into LDAP transactions (auto: if the server supports them)')
+    parser.add_argument('--batch-size',
+            type=int,
+            default=100,
+            help='records per transaction')
+    parser.add_argument('--max-wait',
+            type=int,
+            default=10000,
+            help='records to read past an add whose parent is missing before it fails')
+    throttleargs(parser)
+    args = parser.parse_args()
+    throttle=getthrottle(args, args.window)
+
+    def report(counts, seconds):
+        if(args.verbose):
+            total=sum(counts.values())
+            print('%s records in %.1fs (%.0f records/s) %s'%(total, seconds, total/seconds if seconds else 0, dumps(counts)), file=stderr)
+
+    with ConnectionPool(max_size=args.window, write=True, args=args, throttle=throttle) as pool:
+        counts = ldifload(pool, args.from_file,
+                window=args.window,
+                transactions={'auto': None, 'on': True, 'off': False}[args.transactions],
+                batch_size=args.batch_size,
+                checkpoint=args.checkpoint,
+                errors=args.errors,
+                progress=report,
+                max_wait=args.max_wait)
+    print(dumps(counts))
+    if(throttle != None and args.verbose):
+        print('throttle: %s'%describe(throttle.stats()), file=stderr)
+    if(counts['failed']):
+        exit(1)
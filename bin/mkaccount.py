@@ -10,48 +10,16 @@ project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
 from ldaptools import connect, argparser
-from bin.genuid import genuid
-from random import randint
+from ldaptools.metrics import helper
 
-def mkaccount(conn, username, uid, ou, gid=100, firstName=None, lastName=None, cn=None, gecos=None, email=None, shell='/bin/bash', home=None, password=None):
-    '''create and add a user to the directory
-
-    dn = mkaccount(conn, 
-            username='svc_testaccount',
-            uid=12345,
-            ou='ou=Applications,dc=company,dc=com',
-            gecos='Owner: John Doe <jdoe@company.com>',
-            email='owningteam@company.com')
-
-    dn = mkaccount(conn, 
-            username='jdoe',
-            uid=13579,
-            ou='ou=People,dc=company,dc=com',
-            firstName='John',
-            lastName='Doe',
-            email='jdoe@company.com',
-            password='abc123!@#098zyx')
+def accountattributes(username, uid, ou, gid=100, firstName=None, lastName=None, cn=None, gecos=None, email=None, shell='/bin/bash', home=None, password=None):
+    '''build the dn and attributes for a new user without adding it
 
-    Parameters:
-    conn(object): a ldap3 connection object
-    username(string): linux username (called uid in ldap)
-    uid(int): posix uid (called uidNumber in ldap)
-    gid(int): posix gid (called gidNumber in ldap)
-    firstName(string): the first name of the user (called givenName in ldap)
-    lastName(string): the last name of the user (called sn in ldap)
-    gecos(string): the posix gecos string (otherwise constructed from the name)
-    email(string): the user's email address (called mail in ldap)
-    ou(string): the OU to add the user to (used to construct the dn)
-    shell(string): the login shell (called loginShell in ldap)
-    home(string): the home directory (called homeDirectory in ldap)
-    password(string): the password to set (can be None)
+    Takes the same parameters as mkaccount, without conn.
 
     Returns two values in a tuple:
-    dn of the created object
-    attributes the user was created with
-
-    Raises:
-    Exception if unsucessful
+    dn of the object
+    attributes the user would be created with
     '''
 
     dn='uid=%s,%s'%(username,ou)
@@ -98,15 +66,73 @@ def mkaccount(conn, username, uid, ou, gid=100, firstName=None, lastName=None, c
 
     # populate home if not provided
     if(home == None):
-        attributes['homeDirectory'] = '/home/%s'%username
+        home = '/home/%s'%username
+    attributes['homeDirectory'] = home
+
+    # explicit gecos and cn win over the ones built from the name
+    if(gecos != None):
+        attributes['gecos'] = gecos
+    if(cn != None):
+        attributes['cn'] = cn
 
     # if cn was not able to be populated from firstName and lastName
     if('cn' not in attributes):
         attributes['cn'] = username
 
-    status, response, result, _ = conn.add('uid=%s,%s'%(username,ou),
+    return (dn, attributes)
+
+@helper('mkaccount')
+def mkaccount(conn, username, uid, ou, gid=100, firstName=None, lastName=None, cn=None, gecos=None, email=None, shell='/bin/bash', home=None, password=None, cache=None):
+    '''create and add a user to the directory
+
+    dn = mkaccount(conn, 
+            username='svc_testaccount',
+            uid=12345,
+            ou='ou=Applications,dc=company,dc=com',
+            gecos='Owner: John Doe <jdoe@company.com>',
+            email='owningteam@company.com')
+
+    dn = mkaccount(conn, 
+            username='jdoe',
+            uid=13579,
+            ou='ou=People,dc=company,dc=com',
+            firstName='John',
+            lastName='Doe',
+            email='jdoe@company.com',
+            password='abc123!@#098zyx')
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    username(string): linux username (called uid in ldap)
+    uid(int): posix uid (called uidNumber in ldap)
+    gid(int): posix gid (called gidNumber in ldap)
+    firstName(string): the first name of the user (called givenName in ldap)
+    lastName(string): the last name of the user (called sn in ldap)
+    gecos(string): the posix gecos string (otherwise constructed from the name)
+    email(string): the user's email address (called mail in ldap)
+    ou(string): the OU to add the user to (used to construct the dn)
+    shell(string): the login shell (called loginShell in ldap)
+    home(string): the home directory (called homeDirectory in ldap)
+    password(string): the password to set (can be None)
+    cache(object): a ldaptools.cache.UserCache or ldaptools.replica.Replica to invalidate for the new user
+
+    Returns two values in a tuple:
+    dn of the created object
+    attributes the user was created with
+
+    Raises:
+    Exception if unsucessful
+    '''
+
+    dn, attributes = accountattributes(username, uid, ou, gid, firstName, lastName, cn, gecos, email, shell, home, password)
+
+    status, response, result, _ = conn.add(dn,
             attributes=attributes)
 
+    # forget any "not found" answers cached before the user existed
+    if(cache != None):
+        cache.invalidate(uid=username, uidNumber=uid, dn=dn)
+
     if(not status):
         raise Exception('user creation failed: %s'%response['description'])
 
@@ -149,7 +175,7 @@ if __name__ == '__main__':
             default=None,
             help='new user password'),
     args = parser.parse_args()
-    conn = connect(args=args)
+    conn = connect(args=args, write=True)
 
     dn, attributes = mkaccount(conn, 
             username=args.username, 
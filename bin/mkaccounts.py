@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+'''make many accounts from a CSV or JSON lines file'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, stdin, stderr
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import argparser
+from ldaptools.metrics import helper
+from ldaptools.pool import ConnectionPool
+from bin.mkaccount import accountattributes
+from bin.genuid import useduids, genuids
+from ldaptools.allocator import UidAllocator, initcounter
+from ldaptools.throttle import throttleargs, getthrottle, describe
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+from itertools import islice
+from csv import DictReader
+from json import loads, dumps
+from re import match
+
+# the record fields understood by mkaccounts, named like mkaccount's parameters
+FIELDS=['username','uid','gid','firstName','lastName','cn','gecos','email','shell','home','password','ou']
+
+# ldap result code for entryAlreadyExists
+ENTRY_ALREADY_EXISTS=68
+
+def startcounter(conn, counter, uidmin, uidmax, uidbase):
+    '''create a counter entry for mkaccounts, unless it already exists
+
+    The counter starts just above the highest uid used in the range, so it
+    never hands out a uid that was assigned before it existed.
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    counter(string): the counter entry to create
+    uidmin(int): the minimum uid to assign(inclusive)
+    uidmax(int): the maximum uid to assign(exclusive)
+    uidbase(string): the basedn to look for used uids in
+
+    Returns:
+    True if the counter was created, False if it already existed
+
+    Raises:
+    Exception if the used uids can not be read or the counter can not be added
+    '''
+    borrowed=conn.connection() if isinstance(conn, ConnectionPool) else nullcontext(conn)
+    with borrowed as counterconn:
+        used=useduids(counterconn, uidmin, uidmax, uidbase)
+        start=uidmin+max([i+1 for i, flag in enumerate(used) if flag] or [0])
+        status, result = initcounter(counterconn, counter, start)
+    if(not status and result['result'] != ENTRY_ALREADY_EXISTS):
+        raise Exception('unable to create the counter %s: %s'%(counter, result['description']))
+    return status
+
+def readaccounts(filename):
+    '''yield account records from a CSV file or a JSON lines file
+
+    CSV files must have a header row using the names in FIELDS.  A file is
+    read as JSON lines if its first non-blank character is {.  Records are
+    read one at a time, so the file is never held in memory.
+
+    Parameters:
+    filename(string): the file to read, or - for stdin
+
+    Returns:
+    a generator of dicts, one per record
+    '''
+    handle=stdin if filename == '-' else open(filename, newline='')
+    try:
+        first=''
+        while(first == ''):
+            line=handle.readline()
+            if(line == ''):
+                return
+            first=line.strip()
+
+        if(first.startswith('{')):
+            yield loads(first)
+            for line in handle:
+                line=line.strip()
+                if(line):
+                    yield loads(line)
+        else:
+            for record in DictReader(handle, fieldnames=[f.strip() for f in first.split(',')]):
+                yield {k: v for k, v in record.items() if v not in (None, '')}
+    finally:
+        if(handle is not stdin):
+            handle.close()
+
+def validateaccount(record):
+    '''check an account record locally, before anything is sent to ldap
+
+    Numeric fields are converted to int in place.
+
+    Parameters:
+    record(dict): an account record as produced by readaccounts
+
+    Returns:
+    a list of problems, empty if the record is valid
+    '''
+    problems=[]
+    username=record.get('username')
+    if(not username):
+        problems.append('username is required')
+    elif(not match(r'^[a-z_][a-z0-9_.-]*$', str(username))):
+        problems.append('invalid username %s'%username)
+
+    for field in ('uid','gid'):
+        if(record.get(field) in (None, '')):
+            record.pop(field, None)
+            continue
+        try:
+            record[field]=int(record[field])
+        except (TypeError, ValueError):
+            problems.append('%s must be numeric'%field)
+
+    unknown=set(record)-set(FIELDS)
+    if(unknown):
+        problems.append('unknown fields %s'%', '.join(sorted(unknown)))
+
+    if(record.get('email') and '@' not in record['email']):
+        problems.append('invalid email %s'%record['email'])
+
+    return problems
+
+def readresults(filename):
+    '''return the usernames a previous run already finished
+
+    Parameters:
+    filename(string): a results file written by mkaccounts
+
+    Returns:
+    a set of usernames whose status was ok or exists
+    '''
+    done=set()
+    if(filename == None or not Path(filename).exists()):
+        return done
+    with open(filename) as handle:
+        for line in handle:
+            try:
+                result=loads(line)
+            except ValueError:
+                continue # a line cut short by a crash
+            if(result.get('status') in ('ok','exists')):
+                done.add(result.get('username'))
+    return done
+
+@helper('mkaccounts')
+def mkaccounts(conn, records, ou, uidmin=1000, uidmax=8500, uidbase=None, results=None, workers=8, batch_size=1000, counter=None):
+    '''create and add many users to the directory
+
+    Records are validated locally, records without a uid are given one from
+    a single snapshot of the used uids (see genuid.genuids), or claimed from
+    a counter entry when other workers may be allocating at the same time
+    (see ldaptools.allocator), and the adds are
+    issued concurrently with at most workers operations in flight.  The
+    outcome of each record is appended to the results file as a JSON line;
+    running again with the same results file skips every record that was
+    already added (or already existed).
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    records(iterable): account dicts, using the names in FIELDS
+    ou(string): the OU to add users to, unless a record has its own ou
+    uidmin(int): the minimum uid to assign(inclusive)
+    uidmax(int): the maximum uid to assign(exclusive)
+    uidbase(string): the basedn to check uids in (default ou)
+    results(string): a file to append per-record results to
+    workers(int): the maximum number of adds in flight
+    batch_size(int): the number of records to assign uids for at once
+    counter(string): a counter entry to claim uids from instead of the snapshot
+
+    Returns:
+    a dict counting records by status (ok, exists, skipped, invalid, failed)
+    '''
+    uidbase=uidbase or ou
+    done=readresults(results)
+    counts={'ok': 0, 'exists': 0, 'skipped': 0, 'invalid': 0, 'failed': 0}
+    output=open(results, 'a') if results != None else None
+
+    def record(result):
+        counts[result['status']]+=1
+        if(output != None):
+            output.write(dumps(result)+'\n')
+            output.flush()
+
+    def borrowed():
+        return conn.connection() if isinstance(conn, ConnectionPool) else nullcontext(conn)
+
+    def add(account):
+        dn, attributes = accountattributes(ou=account.pop('ou', ou), **account)
+        with borrowed() as addconn:
+            status, result, _, _ = addconn.add(dn, attributes=attributes)
+        if(status):
+            return {'username': attributes['uid'], 'uid': attributes['uidNumber'], 'dn': dn, 'status': 'ok'}
+        if(result['result'] == ENTRY_ALREADY_EXISTS):
+            return {'username': attributes['uid'], 'uid': attributes['uidNumber'], 'dn': dn, 'status': 'exists'}
+        return {'username': attributes['uid'], 'uid': attributes['uidNumber'], 'dn': dn, 'status': 'failed', 'error': result['description']}
+
+    try:
+        used=None
+        allocator=None
+        if(counter == None):
+            with borrowed() as searchconn:
+                used=useduids(searchconn, uidmin, uidmax, uidbase)
+        else:
+            # one allocator for the run, so uids left in a block carry over to the next batch
+            allocator=UidAllocator(conn, counter, uidmax, batch_size, uidbase, uidmin=uidmin)
+
+        records=iter(records)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending=set()
+            while(True):
+                batch=list(islice(records, batch_size))
+                if(not batch):
+                    break
+
+                accounts=[]
+                for account in batch:
+                    account=dict(account)
+                    if(account.get('username') in done):
+                        counts['skipped']+=1
+                        continue
+                    problems=validateaccount(account)
+                    if(problems):
+                        record({'username': account.get('username'), 'status': 'invalid', 'error': '; '.join(problems)})
+                        continue
+                    if(used != None and 'uid' in account and uidmin <= account['uid'] < uidmax):
+                        used[account['uid']-uidmin]=1
+                    accounts.append(account)
+
+                needuid=[account for account in accounts if 'uid' not in account]
+                if(needuid):
+                    try:
+                        if(allocator != None):
+                            # claim what this batch still needs in one round trip
+                            allocator.block_size=max(len(needuid)-len(allocator.block), 1)
+                            uids=allocator.take(len(needuid))
+                        else:
+                            with borrowed() as searchconn:
+                                uids=genuids(searchconn, uidmin, uidmax, uidbase, count=len(needuid), used=used)
+                    except Exception as e:
+                        # a missing counter or an exhausted range fails the records, resumable once fixed
+                        for account in needuid:
+                            record({'username': account['username'], 'status': 'failed', 'error': str(e)})
+                        accounts=[account for account in accounts if 'uid' in account]
+                        uids=[]
+                    for account, uid in zip(needuid, uids):
+                        account['uid']=uid
+
+                for account in accounts:
+                    if(len(pending) >= workers):
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            record(_outcome(future))
+                    future=executor.submit(add, account)
+                    future.username=account['username']
+                    pending.add(future)
+
+            for future in pending:
+                record(_outcome(future))
+    finally:
+        if(output != None):
+            output.close()
+
+    return counts
+
+def _outcome(future):
+    '''turn a finished add into a result, including unexpected errors'''
+    try:
+        return future.result()
+    except Exception as e:
+        return {'username': future.username, 'status': 'failed', 'error': str(e)}
+
+if __name__ == '__main__':
+    parser = argparser('make many user accounts from a CSV or JSON lines file')
+    parser.add_argument('--from-file',
+            required=True,
+            help='CSV (with a header row) or JSON lines file of accounts, - for stdin')
+    parser.add_argument('--results',
+            required=True,
+            help='file to append per-account results to, reused to resume a run')
+    parser.add_argument('--ou',
+            default='ou=People,dc=company,dc=com',
+            help='OU to create users in (ex: ou=People,dc=company,dc=com)')
+    parser.add_argument('--uidmin',
+            type=int,
+            default=1000,
+            help='minimum uid to assign(inclusive)')
+    parser.add_argument('--uidmax',
+            type=int,
+            default=8500,
+            help='maximum uid to assign(exclusive)')
+    parser.add_argument('--workers',
+            type=int,
+            default=8,
+            help='number of adds in flight')
+    parser.add_argument('--counter',
+            default=None,
+            help='claim uids from this counter entry, safe with concurrent runs (see ldaptools.allocator)')
+    parser.add_argument('--init-counter',
+            action='store_true',
+            help='create the --counter entry first if it does not exist, starting above the highest uid in use')
+    throttleargs(parser)
+    args = parser.parse_args()
+    if(args.init_counter and not args.counter):
+        parser.error('--init-counter needs --counter')
+    throttle=getthrottle(args, args.workers)
+
+    with ConnectionPool(max_size=args.workers, write=True, args=args, throttle=throttle) as pool:
+        if(args.init_counter):
+            try:
+                if(startcounter(pool, args.counter, args.uidmin, args.uidmax, args.ou)):
+                    print('created the counter %s'%args.counter, file=stderr)
+            except Exception as e:
+                print(str(e), file=stderr)
+                exit(1)
+        counts = mkaccounts(pool, readaccounts(args.from_file), args.ou,
+                uidmin=args.uidmin,
+                uidmax=args.uidmax,
+                results=args.results,
+                workers=args.workers,
+                counter=args.counter)
+    print(dumps(counts))
+    if(throttle != None and args.verbose):
+        print('throttle: %s'%describe(throttle.stats()), file=stderr)
+    if(counts['invalid'] or counts['failed']):
+        exit(1)
@@ -10,7 +10,10 @@ project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
 from ldaptools import connect, argparser
+from ldaptools.metrics import helper
+from ldaptools.daemon import forward
 
+@helper('pingstate')
 def pingstate(conn):
     '''returns the value of dn=state
 
@@ -40,12 +43,34 @@ def pingstate(conn):
     if(not status):
         raise Exception('query failed')
 
-    return response[0]['attributes']
+    return flatten(response[0]['attributes'])
+
+def flatten(attributes):
+    '''returns the dsa state attributes with single values and booleans unwrapped
+
+    Without the server schema loaded, values arrive as lists of strings.
+
+    Parameters:
+    attributes(dict): the attributes of the cn=state entry
+
+    Returns:
+    a dict containing the dsa state
+    '''
+    state={}
+    for name, value in attributes.items():
+        if(isinstance(value, list) and len(value) == 1):
+            value=value[0]
+        if(value in ('TRUE', 'FALSE')):
+            value=(value == 'TRUE')
+        state[name]=value
+
+    return state
 
 if __name__ == '__main__':
     args = argparser('return the dn=state').parse_args()
-    conn = connect(args=args)
-    state=pingstate(conn)
+    forwarded, state = forward(args, 'pingstate')
+    if(not forwarded):
+        state=pingstate(connect(args=args))
     print(state['dsaIsActive'])
     if(args.verbose):
         print(state)
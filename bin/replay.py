@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+'''replay a recorded session against a snapshot, faster than it ran'''
+
+# this script might be called from the project directory, in cases where
+# the ldaptools module has not been "installed". This inserts the
+# project directory into python's path, so the module can be found
+from pathlib import Path
+from sys import exit, path, stderr
+project = str(Path(__file__).resolve().parents[1])
+path.insert(0, project)
+
+from ldaptools import connect, argparser
+from ldaptools.replay import readrecording, replay
+from json import dumps
+
+if __name__ == '__main__':
+    parser = argparser('replay a recorded session against a snapshot, faster than it ran')
+    parser.add_argument('--recording',
+            required=True,
+            help='file written by --record')
+    parser.add_argument('--speed',
+            type=float,
+            default=1.0,
+            help='times faster than recorded to issue the operations, 0 for back to back')
+    parser.add_argument('--output',
+            default=None,
+            help='file to write the JSON report to (default stdout)')
+    args = parser.parse_args()
+
+    # replaying writes, so never against a real server
+    if(not args.snapshot):
+        print('--snapshot is required, a recording is only replayed offline')
+        exit(1)
+
+    operations=readrecording(args.recording)
+    report=replay(operations, lambda: connect(args=args), args.speed)
+    output=dumps(report, indent=2)
+    if(args.output):
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+    print('%s operations in %.2fs (%.0f ops/s, recorded %.0f ops/s), %s mismatches, %s errors'%(
+            report['operations'],
+            report['seconds'],
+            report['ops_per_sec'],
+            report['recorded_ops_per_sec'],
+            len(report['mismatches']),
+            len(report['errors'])), file=stderr)
+    exit(1 if report['mismatches'] or report['errors'] else 0)
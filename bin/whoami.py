@@ -10,7 +10,10 @@ project = str(Path(__file__).resolve().parents[1])
 path.insert(0, project)
 
 from ldaptools import connect, argparser
+from ldaptools.metrics import helper
+from ldaptools.daemon import forward
 
+@helper('whoami')
 def whoami(conn):
     '''returns who is logged in
 
@@ -35,6 +38,8 @@ def whoami(conn):
 
 if __name__ == '__main__':
     args = argparser('return who is logged in').parse_args()
-    conn = connect(args=args)
-    print(whoami(conn))
+    forwarded, result = forward(args, 'whoami')
+    if(not forwarded):
+        result = whoami(connect(args=args))
+    print(result)
 
@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 '''ldaptools - helper functions for ldap scripts in python3
 
-Designed for LDAP servers that use 389 and START_TLS with TLS1.2.  To allow for
-thread-safe operation, we also use SAFE_SYNC.
+Designed for LDAP servers that use 389 and START_TLS with TLS1.2 (or TLS1.3,
+see ldaptools.tls).  To allow for thread-safe operation, we also use SAFE_SYNC.
 
 Three authentication types are provided by this module, anonymous bind, SASL
 External auth/SSL Certificate, and SASL simple username/password.  
+
+The server's schema and DSA info are not read when connecting.  They are
+fetched by serverinfo() the first time something needs them, and can be
+cached on disk between runs with schema_cache.
+
+ldap3, ssl and argparse are imported by the functions that use them rather
+than here, so a script that answers from the daemon (see ldaptools.daemon)
+never loads them.  Keep it that way: importing ldap3 costs more than most
+of our scripts spend talking to the server.
 '''
 
-from ssl import CERT_REQUIRED, PROTOCOL_TLSv1_2
-from ldap3 import Tls, Server, Connection, AUTO_BIND_TLS_BEFORE_BIND, ALL, SAFE_SYNC, EXTERNAL, SASL, SIMPLE
-from argparse import ArgumentParser
+from threading import Lock
+from pathlib import Path
+from os import replace
+from re import sub
+
+_infolock=Lock()
+
+# OID of the Simple Paged Results control (RFC 2696)
+PAGED_RESULTS='1.2.840.113556.1.4.319'
+
+class CookieRejected(Exception):
+    '''raised when the server refuses the cookie a paged search was resumed from'''
 
 def connect(**kw):
     '''connects to LDAP and returns a ldap3 connection object
@@ -41,7 +59,8 @@ def connect(**kw):
     (at the cost of not being thread-safe), provide client_strategy=ldap3.SYNC instead.
     
     Params:
-    server(string): *required* hostname or IP of the ldap server
+    server(string): *required* hostname or IP of the ldap server, or a list (or
+        comma separated string) of them, or srv:domain (see ldaptools.topology)
     debug(bool): prints detailed debug info to console
     verbose(bool): prints some info to console
     auth_user(string): user to bind as (ie: uid=cking,ou=People,dc=company,dc=com)
@@ -50,6 +69,17 @@ def connect(**kw):
     auth_cert(string): a path to a client signed certificate in PEM format
     args(object): a parsed args object from argparser created by ldaptools.argparser
     client_strategy: value to pass to ldap3 connection client_strategy (default SAFE_SYNC)
+    get_info: value to pass to ldap3 server get_info (default NONE, see serverinfo)
+    schema_cache(string): a directory to cache the schema and DSA info in (see serverinfo)
+    metrics: True (or a ldaptools.metrics.Registry) to record operation timings (see ldaptools.metrics)
+    write(bool): with several servers, connect to a provider rather than a consumer
+    site(string): with several servers, the local dsaSite to prefer for reads
+    ca_certs(string): a path to the CA certificates to trust (default the OS bundle)
+    tls13(bool): allow TLS 1.3 as well as TLS 1.2 (see ldaptools.tls)
+    snapshot(string): an LDIF or JSON lines export to load and connect to
+        instead of a server (see ldaptools.snapshot), server is then ignored
+    record(string): a file to record the connection's operations in (see ldaptools.replay)
+    throttle(object): a ldaptools.throttle.Throttle to pace the connection's writes with
 
     Returns:
     ldap3 connection object
@@ -57,22 +87,52 @@ def connect(**kw):
     Raises:
     ValueError if a required parameter is not provided
     '''
-    server=kw.pop('server',None)
-    auth_user=kw.pop('auth_user',None)
-    auth_pass=kw.pop('auth_pass',None)
-    auth_key=kw.pop('auth_key',None)
-    auth_cert=kw.pop('auth_cert',None)
+    from ldap3 import Server, Connection, AUTO_BIND_TLS_BEFORE_BIND, NONE, SAFE_SYNC, EXTERNAL, SASL, SIMPLE
     client_strategy=kw.pop('client_strategy',SAFE_SYNC)
+    metrics=kw.pop('metrics',None)
+    snapshot=kw.pop('snapshot',None)
+    record=kw.pop('record',None)
+    throttle=kw.pop('throttle',None)
+    if('args' in kw):
+        snapshot=getattr(kw['args'],'snapshot',snapshot)
+        record=getattr(kw['args'],'record',record)
 
+    # an offline copy of the directory, nothing to resolve or bind to
+    if(snapshot != None):
+        from ldaptools.snapshot import snapshotserver, mockconnection
+        conn=mockconnection(snapshotserver(str(snapshot)), client_strategy)
+        return _observed(conn, metrics, record, throttle)
+
+    server, auth_user, auth_pass, auth_key, auth_cert = connparams(**kw)
+    get_info=kw.pop('get_info',NONE)
+    schema_cache=kw.pop('schema_cache',None)
+    write=kw.pop('write',False)
+    site=kw.pop('site',None)
+    ca_certs=kw.pop('ca_certs',None)
+    tls13=kw.pop('tls13',False)
     if('args' in kw):
-        server=kw['args'].server
-        auth_user=kw['args'].auth_user
-        auth_pass=kw['args'].auth_pass
-        auth_key=kw['args'].auth_key
-        auth_cert=kw['args'].auth_cert
+        schema_cache=getattr(kw['args'],'schema_cache',schema_cache)
+        site=getattr(kw['args'],'site',site)
+        ca_certs=getattr(kw['args'],'ca_certs',ca_certs)
+        tls13=getattr(kw['args'],'tls13',tls13)
 
-    if(server == None):
-        raise ValueError('server is required')
+    # several servers, pick one by role, site and latency
+    if(isinstance(server, tuple)):
+        from ldaptools.topology import gettopology
+        topology=gettopology(server, site,
+                auth_user=auth_user,
+                auth_pass=auth_pass,
+                auth_key=auth_key,
+                auth_cert=auth_cert,
+                ca_certs=ca_certs,
+                tls13=tls13)
+        return topology.connect(write,
+                client_strategy=client_strategy,
+                get_info=get_info,
+                schema_cache=schema_cache,
+                metrics=metrics,
+                record=record,
+                throttle=throttle)
 
     authentication=None
     if(auth_key and auth_cert):
@@ -80,15 +140,11 @@ def connect(**kw):
     elif(auth_user and auth_pass):
         authentication=SIMPLE
 
-    ldaptls = Tls(
-            local_private_key_file=auth_key,
-            local_certificate_file=auth_cert,
-            ca_certs_file=None, # use OS defaults
-            validate=CERT_REQUIRED, 
-            version=PROTOCOL_TLSv1_2)
-
-    # connect over clearext, as we will be using START_TLS
-    ldapserver = Server(server, port=389, use_ssl=False, tls=ldaptls, get_info=ALL)
+    # connect over clearext, as we will be using START_TLS.  The TLS settings
+    # are shared, so later connections reuse the SSLContext and TLS session
+    from ldaptools.tls import gettls
+    ldaptls=gettls(auth_key, auth_cert, ca_certs, tls13)
+    ldapserver = Server(server, port=389, use_ssl=False, tls=ldaptls, get_info=get_info)
     
     # automatically upgrade the connection with START_TLS, then bind
     conn = Connection(ldapserver,
@@ -100,8 +156,215 @@ def connect(**kw):
             client_strategy=client_strategy,
             collect_usage=True)
 
+    # TLS 1.3 session tickets only arrive once the bind has been answered
+    ldaptls.remember(conn)
+
+    _observed(conn, metrics, record, throttle)
+
+    # loading from the cache is cheap, and keeps values formatted as before
+    if(schema_cache != None):
+        serverinfo(conn, schema_cache)
+
     return conn
 
+def _observed(conn, metrics, record, throttle=None):
+    '''time, record and throttle a connection's operations, as connect was asked to'''
+    if(metrics):
+        from ldaptools.metrics import instrument
+        instrument(conn, None if metrics is True else metrics)
+    if(record != None):
+        from ldaptools.replay import recorder
+        recorder(str(record)).attach(conn)
+    # last, so the time spent waiting for the throttle is not timed or recorded
+    if(throttle != None):
+        throttle.attach(conn)
+    return conn
+
+def serverinfo(conn, cache=None):
+    '''returns the DSA info and schema of the server, fetching them on first use
+
+    connect does not read the schema or rootDSE, so results are returned
+    with unformatted (list of string) values until this has been called.
+    Once loaded, the info is kept on the connection's server object and
+    later calls are free.
+
+    If cache is a directory, the info is stored there in ldap3's offline JSON
+    format, keyed by server and the modifyTimestamp of the subschema entry.
+    A later run only reads that timestamp (two base searches) and loads the
+    rest from disk, unless the schema has changed.
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    cache(string): a directory to cache the schema and DSA info in
+
+    Returns two values in a tuple:
+    ldap3 DsaInfo object
+    ldap3 SchemaInfo object
+    '''
+    from ldap3 import ALL
+    from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+    server=conn.server
+    with _infolock:
+        if(server.info != None and server.schema != None):
+            return (server.info, server.schema)
+
+        infofile, schemafile = None, None
+        stamp=schemastamp(conn) if cache != None else None
+        if(stamp != None):
+            name=sub(r'[^A-Za-z0-9.-]', '_', '%s_%s_%s'%(server.host, server.port, stamp))
+            infofile=Path(cache)/('%s.info.json'%name)
+            schemafile=Path(cache)/('%s.schema.json'%name)
+            if(infofile.exists() and schemafile.exists()):
+                server.attach_dsa_info(DsaInfo.from_file(str(infofile)))
+                server.attach_schema_info(SchemaInfo.from_file(str(schemafile)))
+                return (server.info, server.schema)
+
+        server.get_info=ALL
+        server.get_info_from_server(conn)
+
+        if(infofile != None and server.info != None and server.schema != None):
+            Path(cache).mkdir(parents=True, exist_ok=True)
+            for info, target in ((server.info, infofile), (server.schema, schemafile)):
+                info.to_file(str(target)+'.tmp')
+                replace(str(target)+'.tmp', str(target))
+
+        return (server.info, server.schema)
+
+def schemastamp(conn):
+    '''returns the modifyTimestamp of the server's subschema entry
+
+    Parameters:
+    conn(object): a ldap3 connection object
+
+    Returns:
+    the timestamp as a string, or None if the server does not publish one
+    '''
+    from ldap3 import BASE
+    status, _, response, _ = conn.search('', '(objectClass=*)',
+            search_scope=BASE,
+            attributes=['subschemaSubentry'])
+    if(not status):
+        return None
+    subschema=_single(response[0]['attributes'].get('subschemaSubentry'))
+    if(not subschema):
+        return None
+
+    status, _, response, _ = conn.search(subschema, '(objectClass=*)',
+            search_scope=BASE,
+            attributes=['modifyTimestamp'])
+    if(not status):
+        return None
+    stamp=_single(response[0]['attributes'].get('modifyTimestamp'))
+    if(stamp == None):
+        return None
+    if(hasattr(stamp, 'strftime')):
+        stamp=stamp.strftime('%Y%m%d%H%M%SZ')
+    return str(stamp)
+
+def _single(value):
+    '''returns the only value of a single valued attribute, formatted or not'''
+    if(isinstance(value, list)):
+        return value[0] if value else None
+    return value
+
+def iter_entries(conn, base, search_filter='(objectClass=*)', attributes=['*'], page_size=500, cookie=None, on_page=None):
+    '''yields the entries matching a search, one page at a time
+
+    Uses the Simple Paged Results control, so only one page of entries is
+    held in memory no matter how large the subtree is, and the server's
+    sizelimit does not cut the search short.
+
+    To resume an interrupted walk, save the cookie passed to on_page and
+    pass it back as cookie.  Most servers (OpenLDAP, AD) only honour a
+    cookie on the connection that received it, and refuse it anywhere else.
+
+        for entry in iter_entries(conn, 'ou=People,dc=company,dc=com', '(objectClass=posixAccount)', ['uid']):
+            print(entry['dn'])
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    base(string): the basedn to search
+    search_filter(string): the ldap filter to match
+    attributes(list): the attributes to return
+    page_size(int): the number of entries to request per page
+    cookie(bytes): a cookie from on_page to resume from
+    on_page(callable): called with the cookie for the next page (None after
+        the last page) once every entry of a page has been yielded
+
+    Returns:
+    a generator of search result entries (searchResEntry dicts)
+
+    Raises:
+    CookieRejected if the first search, resumed from cookie, fails
+    Exception if a search fails
+    '''
+    resumed=cookie != None
+    while(True):
+        status, result, response, _ = conn.search(
+                search_base=base,
+                search_filter=search_filter,
+                attributes=attributes,
+                paged_size=page_size,
+                paged_cookie=cookie)
+
+        if(not status and result['result'] != 0):
+            if(resumed):
+                raise CookieRejected('the server refused the paged search cookie (%s), most servers only accept one on the connection that received it'%result['description'])
+            raise Exception('paged search failed: %s'%result['description'])
+        resumed=False
+
+        for entry in response:
+            if(entry.get('type') == 'searchResEntry'):
+                yield entry
+        del response
+
+        try:
+            cookie=result['controls'][PAGED_RESULTS]['value']['cookie']
+        except (KeyError, TypeError):
+            cookie=None
+        if(not cookie):
+            cookie=None
+
+        if(on_page != None):
+            on_page(cookie)
+        if(cookie == None):
+            break
+
+def connparams(**kw):
+    '''resolve the server and credentials that connect would use
+
+    Accepts the same keywords as connect, including args.
+
+    Returns five values in a tuple:
+    server, auth_user, auth_pass, auth_key, auth_cert
+
+    Raises:
+    ValueError if a required parameter is not provided
+    '''
+    server=kw.get('server',None)
+    auth_user=kw.get('auth_user',None)
+    auth_pass=kw.get('auth_pass',None)
+    auth_key=kw.get('auth_key',None)
+    auth_cert=kw.get('auth_cert',None)
+
+    if('args' in kw):
+        server=kw['args'].server
+        auth_user=kw['args'].auth_user
+        auth_pass=kw['args'].auth_pass
+        auth_key=kw['args'].auth_key
+        auth_cert=kw['args'].auth_cert
+
+    if(server == None):
+        raise ValueError('server is required')
+
+    # several servers are returned as a tuple, so the result stays hashable
+    if(isinstance(server, (list, tuple))):
+        server=tuple(server)
+    elif(',' in server or server.startswith('srv:')):
+        server=tuple(s.strip() for s in server.split(',') if s.strip())
+
+    return (server, auth_user, auth_pass, auth_key, auth_cert)
+
 def argparser(description=''):
     '''build a parser with common ldap params
 
@@ -111,11 +374,15 @@ def argparser(description=''):
     Returns:
     argparser object
     '''
+    from argparse import ArgumentParser
     parser = ArgumentParser(description=description)
     parser.add_argument('-s',
             default='default-host.company.com',
             dest='server',
-            help='server name to connect to')
+            help='server name to connect to, or a comma separated list, or srv:domain')
+    parser.add_argument('--site',
+            default=None,
+            help='with several servers, the local dsaSite to prefer for reads')
     parser.add_argument('-v',
             action='store_true',
             dest='verbose')
@@ -138,5 +405,29 @@ def argparser(description=''):
             default=None,
             dest='auth_cert',
             help='path to client cert for SASL extended auth')
+    parser.add_argument('--ca',
+            default=None,
+            dest='ca_certs',
+            help='path to the CA certificates to trust (default the OS bundle)')
+    parser.add_argument('--tls13',
+            action='store_true',
+            help='allow TLS 1.3 as well as TLS 1.2')
+    parser.add_argument('--schema-cache',
+            default=None,
+            dest='schema_cache',
+            help='directory to cache the server schema in between runs')
+    parser.add_argument('--snapshot',
+            default=None,
+            help='LDIF or JSON lines export to run against offline instead of a server')
+    parser.add_argument('--record',
+            default=None,
+            help='file to record every operation and its timing in, for bin/replay.py')
+    parser.add_argument('--socket',
+            default=None,
+            help='ldaptools daemon socket to forward queries to (default $LDAPTOOLS_SOCKET)')
+    parser.add_argument('--no-daemon',
+            action='store_true',
+            dest='no_daemon',
+            help='always connect directly, even if a daemon is running')
     return parser
 
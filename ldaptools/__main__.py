@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''ldaptools - run any of the tools as a subcommand of one entry point
+
+    python3 -m ldaptools getuser --username jdoe
+    bin/ldaptools genuid --count 5
+    bin/ldaptools                 # list the subcommands
+
+The subcommand's module is only imported once it has been picked, so each
+run loads what that one tool needs and nothing else, and every option works
+exactly as when the script is run directly.
+'''
+
+from pathlib import Path
+from sys import argv, exit, path, stderr
+project = str(Path(__file__).resolve().parents[1])
+if(project not in path):
+    path.insert(0, project)
+
+# subcommand -> the module run as __main__
+COMMANDS={
+    'audit': 'bin.audit',
+    'daemon': 'ldaptools.daemon',
+    'export': 'bin.export',
+    'genuid': 'bin.genuid',
+    'getuser': 'bin.getuser',
+    'id': 'bin.id',
+    'isuidfree': 'bin.isuidfree',
+    'ldifload': 'bin.ldifload',
+    'mkaccount': 'bin.mkaccount',
+    'mkaccounts': 'bin.mkaccounts',
+    'pingstate': 'bin.pingstate',
+    'replay': 'bin.replay',
+    'whoami': 'bin.whoami',
+    }
+
+def summary(module):
+    '''returns the first line of a module's docstring, read without importing it'''
+    from ast import parse, get_docstring
+    source=Path(project, *module.split('.')).with_suffix('.py').read_text()
+    line=(get_docstring(parse(source)) or '').splitlines()[0]
+    # library modules start with 'ldaptools.name - '
+    return line.split(' - ', 1)[-1]
+
+def usage(file=stderr):
+    print('usage: ldaptools <command> [options]\n\ncommands:', file=file)
+    for command, module in COMMANDS.items():
+        print('  %-12s %s'%(command, summary(module)), file=file)
+    print('\nrun ldaptools <command> --help for the options of a command', file=file)
+
+def main(arguments=None):
+    '''run the subcommand named by the first argument
+
+    Parameters:
+    arguments(list): the command line, without the program name (default sys.argv[1:])
+    '''
+    from runpy import run_module
+    arguments=argv[1:] if arguments == None else arguments
+    if(not arguments or arguments[0] in ('-h', '--help', 'help')):
+        usage(file=None if arguments else stderr)
+        exit(0 if arguments else 2)
+    command=arguments[0]
+    if(command not in COMMANDS):
+        print('ldaptools: unknown command %s'%command, file=stderr)
+        usage()
+        exit(2)
+
+    # argparse takes the program name from argv[0]
+    argv[:]=['ldaptools %s'%command]+arguments[1:]
+    run_module(COMMANDS[command], run_name='__main__')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+'''ldaptools.account - a compact posixAccount entry
+
+ldap3 returns every entry as a dict holding each attribute twice, decoded
+and as raw bytes, plus the raw dn.  PosixAccount keeps the dn and the raw
+values of the requested attributes in __slots__, and decodes a value the
+first time it is read.  The helpers return it when asked to be compact:
+
+    found, user = getuser(conn, 'jdoe', base, attributes=ATTRIBUTES, compact=True)
+    print(user.uidNumber, user.homeDirectory)
+
+    found, missing, duplicates = getusers(pool, names, base, attributes=ATTRIBUTES, compact=True)
+'''
+
+# the attributes most callers need, a good projection for compact lookups
+ATTRIBUTES=['uid', 'uidNumber', 'gidNumber', 'homeDirectory']
+
+# the attributes that get a slot of their own, the rest go in a dict
+FIELDS=('uid', 'uidNumber', 'gidNumber', 'cn', 'homeDirectory', 'loginShell', 'gecos')
+INTEGERS=('uidNumber', 'gidNumber')
+
+class PosixAccount:
+    '''a posixAccount entry with lazily decoded attributes
+
+    The first value of each attribute in FIELDS is an attribute of the
+    object (user.uid, user.uidNumber, ...), None if it was not returned.
+    Every attribute, including multiple values and ones outside FIELDS, is
+    available with get() and values().  user['dn'] and user['attributes']
+    work as on a search response, for code written against those.
+
+    Build one with fromentry().
+    '''
+
+    __slots__=('dn', '_uid', '_uidNumber', '_gidNumber', '_cn', '_homeDirectory', '_loginShell', '_gecos', '_other', '_raw')
+
+    def __init__(self, dn, values, raw=None):
+        '''
+        Parameters:
+        dn(string): the entry's dn
+        values(dict): attribute name to a list of values, bytes or decoded
+        raw(dict): the entry's raw_attributes, kept as is if given
+        '''
+        self.dn=dn
+        other=None
+        for field in FIELDS:
+            setattr(self, '_'+field, None)
+        for name, value in values.items():
+            if(not isinstance(value, list)):
+                value=[value]
+            if(not value):
+                continue
+            field=_field(name)
+            if(field != None):
+                setattr(self, '_'+field, value[0] if len(value) == 1 else list(value))
+            else:
+                if(other == None):
+                    other={}
+                other[name]=list(value)
+        self._other=other
+        self._raw=raw
+
+    @classmethod
+    def fromentry(cls, entry, attributes=None, raw=False):
+        '''build a PosixAccount from a search response entry (or a cached one)
+
+        Parameters:
+        entry(dict): a searchResEntry dict, or a PosixAccount (returned as is)
+        attributes(list): only keep these attributes (default all, as does '*')
+        raw(bool): keep ldap3's raw_attributes dict too
+
+        Returns:
+        a PosixAccount object
+        '''
+        if(isinstance(entry, cls)):
+            return entry
+        values=entry.get('raw_attributes') or entry['attributes']
+        if(attributes != None and '*' not in attributes):
+            wanted=set(a.lower() for a in attributes)
+            values={name: value for name, value in values.items() if name.lower() in wanted}
+        return cls(entry['dn'], values, entry.get('raw_attributes') if raw else None)
+
+    def _decoded(self, field):
+        value=getattr(self, '_'+field)
+        if(isinstance(value, list)):
+            return _decode(field, value[0])
+        if(value != None and isinstance(value, (bytes, bytearray))):
+            value=_decode(field, value)
+            setattr(self, '_'+field, value)
+        return value
+
+    uid=property(lambda self: self._decoded('uid'))
+    uidNumber=property(lambda self: self._decoded('uidNumber'))
+    gidNumber=property(lambda self: self._decoded('gidNumber'))
+    cn=property(lambda self: self._decoded('cn'))
+    homeDirectory=property(lambda self: self._decoded('homeDirectory'))
+    loginShell=property(lambda self: self._decoded('loginShell'))
+    gecos=property(lambda self: self._decoded('gecos'))
+
+    @property
+    def raw(self):
+        '''ldap3's raw_attributes, if fromentry was asked to keep them'''
+        return self._raw
+
+    def values(self, name):
+        '''returns every decoded value of an attribute, [] if it was not returned'''
+        field=_field(name)
+        if(field != None):
+            value=getattr(self, '_'+field)
+            if(value == None):
+                return []
+            return [_decode(field, v) for v in (value if isinstance(value, list) else [value])]
+        for other, value in (self._other or {}).items():
+            if(other.lower() == name.lower()):
+                return [_decode(other, v) for v in value]
+        return []
+
+    def get(self, name, default=None):
+        '''returns the first decoded value of an attribute'''
+        values=self.values(name)
+        return values[0] if values else default
+
+    def asdict(self):
+        '''returns the attributes as a dict of decoded values, single values unwrapped'''
+        names=[field for field in FIELDS if getattr(self, '_'+field) != None]+list(self._other or {})
+        attributes={}
+        for name in names:
+            values=self.values(name)
+            attributes[name]=values[0] if len(values) == 1 else values
+        return attributes
+
+    def __getitem__(self, key):
+        if(key == 'dn'):
+            return self.dn
+        if(key == 'attributes'):
+            return self.asdict()
+        if(key == 'type'):
+            return 'searchResEntry'
+        raise KeyError(key)
+
+    def __eq__(self, other):
+        return isinstance(other, PosixAccount) and self.dn.lower() == other.dn.lower()
+
+    def __hash__(self):
+        return hash(self.dn.lower())
+
+    def __repr__(self):
+        return 'PosixAccount(%r, uid=%r, uidNumber=%r)'%(self.dn, self.uid, self.uidNumber)
+
+def _field(name):
+    '''the FIELDS name matching an attribute name case-insensitively, or None'''
+    lowered=name.lower()
+    for field in FIELDS:
+        if(field.lower() == lowered):
+            return field
+    return None
+
+def _decode(name, value):
+    '''decode a raw value, as an int for the numeric attributes'''
+    if(isinstance(value, (bytes, bytearray))):
+        value=bytes(value).decode('utf-8', 'replace')
+    if(name in INTEGERS):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+    return value
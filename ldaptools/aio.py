@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+'''ldaptools.aio - asyncio versions of the ldaptools helpers
+
+Connections use ldap3's ASYNC strategy: requests are written to the socket
+without waiting, and one receiver thread per connection collects the
+responses.  AsyncConnection turns the receiver's "response complete" signal
+into an asyncio future, so any number of coroutines can have operations
+outstanding on one connection without holding a thread each.
+
+The operation methods return the same (status, result, response, request)
+tuples as a SAFE_SYNC connection, and the helpers mirror the functions in
+bin/ of the same name.
+
+    from ldaptools import aio
+    conn = await aio.connect(server='ldap.company.com')
+    found, user = await aio.getuser(conn, 'jdoe', 'ou=People,dc=company,dc=com')
+    await conn.close()
+'''
+
+# the helpers reuse the pure parts of the bin/ scripts
+from pathlib import Path
+from sys import path
+project = str(Path(__file__).resolve().parents[1])
+if(project not in path):
+    path.insert(0, project)
+
+import asyncio
+from threading import Lock
+from ldap3 import ASYNC
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.config import get_config_parameter
+from ldaptools import connect as _connect, PAGED_RESULTS
+from bin.genuid import uidnumbers, freeuids
+from bin.mkaccount import accountattributes
+from bin.pingstate import flatten
+
+# ldap result codes
+RESULT_SUCCESS=0
+RESULT_COMPARE_TRUE=6
+
+# OID of the "Who am I?" extended operation (RFC 4532)
+WHOAMI='1.3.6.1.4.1.4203.1.11.3'
+
+class AsyncConnection:
+    '''awaitable operations over an ldap3 ASYNC connection
+
+    Parameters:
+    conn(object): a bound ldap3 connection using the ASYNC (or MOCK_ASYNC) strategy
+    timeout(float): seconds to wait for each response (default ldap3's RESPONSE_WAITING_TIMEOUT)
+    '''
+
+    def __init__(self, conn, timeout=None):
+        self.conn=conn
+        self.timeout=timeout if timeout != None else get_config_parameter('RESPONSE_WAITING_TIMEOUT')
+        self._loop=asyncio.get_running_loop()
+        self._lock=Lock()
+        self._waiters={}    # message id -> future awaiting it
+        self._ready=set()   # message ids that completed before anyone awaited them
+
+        # mock strategies have their responses ready as soon as the request is sent
+        self._immediate=getattr(conn.strategy, 'no_real_dsa', False)
+        if(not self._immediate):
+            original=conn.strategy.set_event_for_message
+            def notify(message_id):
+                original(message_id)
+                with self._lock:
+                    waiter=self._waiters.pop(message_id, None)
+                    if(waiter == None):
+                        self._ready.add(message_id)
+                if(waiter != None):
+                    self._loop.call_soon_threadsafe(_resolve, waiter)
+            conn.strategy.set_event_for_message=notify
+
+    async def _response(self, message_id):
+        '''wait for a message to complete and return (response, result)'''
+        if(not self._immediate):
+            with self._lock:
+                if(message_id in self._ready):
+                    self._ready.discard(message_id)
+                    waiter=None
+                else:
+                    waiter=self._loop.create_future()
+                    self._waiters[message_id]=waiter
+            if(waiter != None):
+                try:
+                    await asyncio.wait_for(waiter, self.timeout)
+                finally:
+                    with self._lock:
+                        self._waiters.pop(message_id, None)
+        return self.conn.get_response(message_id)
+
+    async def search(self, search_base, search_filter, **kw):
+        '''search, see ldap3.Connection.search for the parameters
+
+        Returns four values in a tuple, like a SAFE_SYNC connection:
+        True if any entries were found
+        the result dict
+        the list of entries
+        None
+        '''
+        response, result = await self._response(self.conn.search(search_base, search_filter, **kw))
+        status=(result['result'] == RESULT_SUCCESS and len(response) > 0)
+        return (status, result, response, None)
+
+    async def add(self, dn, object_class=None, attributes=None, controls=None):
+        '''add an entry, returns (status, result, response, None)'''
+        response, result = await self._response(self.conn.add(dn, object_class, attributes, controls))
+        return (result['result'] == RESULT_SUCCESS, result, response, None)
+
+    async def modify(self, dn, changes, controls=None):
+        '''modify an entry, returns (status, result, response, None)'''
+        response, result = await self._response(self.conn.modify(dn, changes, controls))
+        return (result['result'] == RESULT_SUCCESS, result, response, None)
+
+    async def delete(self, dn, controls=None):
+        '''delete an entry, returns (status, result, response, None)'''
+        response, result = await self._response(self.conn.delete(dn, controls))
+        return (result['result'] == RESULT_SUCCESS, result, response, None)
+
+    async def compare(self, dn, attribute, value, controls=None):
+        '''compare an attribute value, returns (True if it matched, result, response, None)'''
+        response, result = await self._response(self.conn.compare(dn, attribute, value, controls))
+        return (result['result'] == RESULT_COMPARE_TRUE, result, response, None)
+
+    async def extended(self, request_name, request_value=None, controls=None):
+        '''run an extended operation, returns (status, result, response, None)'''
+        response, result = await self._response(self.conn.extended(request_name, request_value, controls))
+        return (result['result'] == RESULT_SUCCESS, result, response, None)
+
+    async def close(self):
+        '''unbind and close the connection'''
+        await asyncio.get_running_loop().run_in_executor(None, self.conn.unbind)
+        with self._lock:
+            waiters=list(self._waiters.values())
+            self._waiters.clear()
+        for waiter in waiters:
+            if(not waiter.done()):
+                waiter.set_exception(ConnectionError('connection closed'))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+def _resolve(waiter):
+    if(not waiter.done()):
+        waiter.set_result(None)
+
+async def connect(timeout=None, **kw):
+    '''connects to LDAP and returns an AsyncConnection
+
+    Takes the same keywords as ldaptools.connect.  START_TLS and the bind
+    happen in the default executor so the event loop is not blocked.
+
+    Parameters:
+    timeout(float): seconds to wait for each response
+    **kw: keywords passed to ldaptools.connect
+
+    Returns:
+    AsyncConnection object
+    '''
+    kw.setdefault('client_strategy', ASYNC)
+    conn=await asyncio.get_running_loop().run_in_executor(None, lambda: _connect(**kw))
+    return AsyncConnection(conn, timeout)
+
+async def getuser(conn, username, base):
+    '''returns a user from within the specified base, see bin/getuser.py'''
+    status, _, response, _ = await conn.search(base, '(uid=%s)'%escape_filter_chars(str(username)), attributes=['*'])
+    return _single(status, response)
+
+async def getuid(conn, uid, base):
+    '''returns a user by uid from within the specified base, see bin/getuser.py'''
+    status, _, response, _ = await conn.search(base, '(uidNumber=%s)'%escape_filter_chars(str(uid)), attributes=['*'])
+    return _single(status, response)
+
+def _single(status, response):
+    if(status): #we think we found something
+        if(len(response)<1):
+            raise Exception('for some reason status is false and response is 0... that should not happen')
+        elif(len(response)>1):
+            raise ValueError('too many responses were found (duplicate uid?)')
+        return (status, response[0])
+
+    # we did not find anything
+    return (status, None)
+
+async def isuidfree(conn, uid, base, chunk_size=100):
+    '''check if a UID (or a list of them) is free, see bin/isuidfree.py'''
+    if(not isinstance(uid, (list, tuple, set))):
+        uid=[uid]
+    uids=[int(u) for u in uid]
+
+    searches=[]
+    for i in range(0, len(uids), chunk_size):
+        chunk=uids[i:i+chunk_size]
+        search_filter='(uidNumber=%s)'%chunk[0]
+        if(len(chunk) > 1):
+            search_filter='(|%s)'%''.join('(uidNumber=%s)'%u for u in chunk)
+        searches.append(conn.search(base, search_filter, attributes=['uidNumber']))
+
+    found=False
+    responses=[]
+    for status, _, response, _ in await asyncio.gather(*searches):
+        found=found or status
+        responses.extend(response)
+    return (not found, responses)
+
+async def useduids(conn, uidmin, uidmax, base, page_size=1000):
+    '''build a map of the uids in use within the specified base, see bin/genuid.py'''
+    used=bytearray(max(uidmax-uidmin,0))
+    cookie=None
+    while(True):
+        status, result, response, _ = await conn.search(base, '(uidNumber=*)',
+                attributes=['uidNumber'],
+                paged_size=page_size,
+                paged_cookie=cookie)
+        if(not status and result['result'] != RESULT_SUCCESS):
+            raise Exception('uid search failed: %s'%result['description'])
+
+        for uid in uidnumbers(response):
+            if(uidmin <= uid < uidmax):
+                used[uid-uidmin]=1
+
+        try:
+            cookie=result['controls'][PAGED_RESULTS]['value']['cookie']
+        except (KeyError, TypeError):
+            cookie=None
+        if(not cookie):
+            break
+    return used
+
+async def genuids(conn, uidmin, uidmax, base, count=1, strategy='lowest', attempts=10, page_size=1000, used=None):
+    '''generate a number of free uids, see bin/genuid.py'''
+    if(used == None):
+        used=await useduids(conn, uidmin, uidmax, base, page_size)
+
+    founduids=[]
+    for i in range(attempts):
+        proposed=freeuids(used, uidmin, count-len(founduids), strategy)
+        for uid in proposed:
+            used[uid-uidmin]=1
+
+        free, response = await isuidfree(conn, proposed, base)
+        if(free):
+            founduids.extend(proposed)
+        else:
+            taken=set(uidnumbers(response))
+            founduids.extend(uid for uid in proposed if uid not in taken)
+
+        if(len(founduids) >= count):
+            break
+
+    if(len(founduids) < count):
+        raise ValueError('unable to find %s valid uids in %s attempts'%(count, attempts))
+
+    return sorted(founduids) if strategy == 'lowest' else founduids
+
+async def genuid(conn, uidmin, uidmax, base, attempts):
+    '''generate a uid between uidmin and uidmax, see bin/genuid.py'''
+    return (await genuids(conn, uidmin, uidmax, base, count=1, strategy='random', attempts=attempts))[0]
+
+async def mkaccount(conn, username, uid, ou, **kw):
+    '''create and add a user to the directory, see bin/mkaccount.py
+
+    Takes the same keyword parameters as bin/mkaccount.py's mkaccount.
+    '''
+    dn, attributes = accountattributes(username, uid, ou, **kw)
+    status, result, _, _ = await conn.add(dn, attributes=attributes)
+    if(not status):
+        raise Exception('user creation failed: %s'%result['description'])
+    return (dn, attributes)
+
+async def pingstate(conn):
+    '''returns the value of dn=state, see bin/pingstate.py'''
+    status, _, response, _ = await conn.search('cn=state', '(objectClass=*)',
+            attributes=['dsaIsActive','dsaEnv','dsaSite','dsaRole','dsaFQDN'])
+    if(not status):
+        raise Exception('query failed')
+
+    return flatten(response[0]['attributes'])
+
+async def whoami(conn):
+    '''returns who is logged in, see bin/whoami.py'''
+    status, result, _, _ = await conn.extended(WHOAMI)
+    if(not status):
+        raise Exception('query failed')
+
+    user='Anonymous'
+    if(result.get('responseValue')):
+        user=result['responseValue'].decode('UTF-8')
+    return user
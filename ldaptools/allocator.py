@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+'''ldaptools.allocator - hand out uids from several workers without duplicates
+
+genuid proposes a uid that isuidfree reports as free, so two workers that
+run it at the same time can both get the same uid and both add an account
+with it.  The allocator keeps the next free uid in a counter entry instead,
+and claims uids with a modify that deletes the value it read and adds the
+new one.  The delete fails if another worker moved the counter first, so
+each value is claimed exactly once; the loser reads the counter again and
+retries.
+
+A worker can claim a block of uids at a time (block_size) and hand them out
+locally with no round trip per uid.  uids left in a block when a worker
+stops are skipped, not reused.
+
+    initcounter(conn, 'cn=uidNext,dc=company,dc=com', 1000)
+    allocator = UidAllocator(conn, 'cn=uidNext,dc=company,dc=com', uidmax=8500,
+            block_size=50, base='ou=People,dc=company,dc=com', uidmin=1000)
+    uid = allocator.next()
+'''
+
+# isuidfree lives with the other helpers in bin/
+from pathlib import Path
+from sys import path
+project = str(Path(__file__).resolve().parents[1])
+if(project not in path):
+    path.insert(0, project)
+
+from contextlib import nullcontext
+from threading import Lock
+from random import random
+from time import sleep
+from ldaptools.pool import ConnectionPool
+from ldaptools.metrics import helper
+
+def _borrowed(conn):
+    return conn.connection() if isinstance(conn, ConnectionPool) else nullcontext(conn)
+
+def readcounter(conn, dn, attribute='uidNumber'):
+    '''returns the value of a counter entry
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    dn(string): the counter entry
+    attribute(string): the attribute holding the next free uid
+
+    Raises:
+    Exception if the counter can not be read
+    '''
+    from ldap3 import BASE
+    status, result, response, _ = conn.search(dn, '(objectClass=*)', BASE, attributes=[attribute])
+    if(not status or not response):
+        raise Exception('unable to read the counter %s: %s'%(dn, result['description']))
+    value=response[0]['attributes'].get(attribute)
+    if(isinstance(value, list)):
+        value=value[0] if value else None
+    if(value == None):
+        raise Exception('the counter %s has no %s'%(dn, attribute))
+    return int(value)
+
+def initcounter(conn, dn, start, attribute='uidNumber', object_class=['top', 'device', 'extensibleObject']):
+    '''create a counter entry holding the next free uid
+
+    Start it above every uid already in use (see genuid.useduids), or give
+    the allocator a base so it skips uids that are taken.
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    dn(string): the counter entry to create
+    start(int): the first uid to hand out
+    attribute(string): the attribute to keep the next free uid in
+    object_class(list): the entry's objectClasses, which must allow attribute
+
+    Returns two values in a tuple:
+    True if the counter was created, False otherwise
+    the ldap result of the add
+    '''
+    status, result, _, _ = conn.add(dn, attributes={'objectClass': object_class, attribute: str(start)})
+    return (status, result)
+
+@helper('claimuids')
+def claimuids(conn, dn, count=1, uidmax=None, attribute='uidNumber', attempts=20, partial=False, uidmin=None):
+    '''atomically advance a counter entry by count, returning the uids claimed
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    dn(string): the counter entry
+    count(int): the number of uids to claim
+    uidmax(int): the maximum uid to hand out(exclusive), or None for no limit
+    attribute(string): the attribute holding the next free uid
+    attempts(int): the maximum number of tries while other workers move the counter
+    partial(bool): claim fewer than count uids if fewer are left below uidmax
+    uidmin(int): the minimum uid to hand out(inclusive), or None for no limit
+
+    Returns:
+    range of the claimed uids
+
+    Raises:
+    ValueError if the counter is below uidmin, the range is exhausted or
+        the counter stays contended
+    Exception if the counter can not be read or modified
+    '''
+    from ldap3 import MODIFY_ADD, MODIFY_DELETE
+    with _borrowed(conn) as counterconn:
+        for attempt in range(attempts):
+            current=readcounter(counterconn, dn, attribute)
+            # checked before claiming, so a misplaced counter is left as it was
+            if(uidmin != None and current < uidmin):
+                raise ValueError('the counter %s is at %s, below the minimum uid %s'%(dn, current, uidmin))
+            claimed=count
+            if(uidmax != None and current+count > uidmax):
+                if(not partial or current >= uidmax):
+                    raise ValueError('only %s uids are left below %s, %s requested'%(max(uidmax-current, 0), uidmax, count))
+                claimed=uidmax-current
+
+            status, result, _, _ = counterconn.modify(dn, {attribute: [
+                    (MODIFY_DELETE, [str(current)]),
+                    (MODIFY_ADD, [str(current+claimed)])]})
+            if(status):
+                return range(current, current+claimed)
+
+            # the delete only fails this way if another worker got there first
+            if(readcounter(counterconn, dn, attribute) == current):
+                raise Exception('unable to update the counter %s: %s'%(dn, result['description']))
+            sleep(random()*0.005*(attempt+1))
+
+    raise ValueError('the counter %s was still contended after %s attempts'%(dn, attempts))
+
+class UidAllocator:
+    '''hands out uids claimed in blocks from a counter entry
+
+    Safe to share between threads; run one per process.
+
+    Parameters:
+    conn(object): a ldap3 connection object or a ldaptools.pool.ConnectionPool
+    dn(string): the counter entry (see initcounter)
+    uidmax(int): the maximum uid to hand out(exclusive), or None for no limit
+    block_size(int): the number of uids to claim per round trip
+    base(string): if set, each block is checked with one isuidfree search and
+        uids that are already used in base are skipped
+    attribute(string): the attribute holding the next free uid
+    uidmin(int): the minimum uid to hand out(inclusive), or None for no limit
+    '''
+
+    def __init__(self, conn, dn, uidmax=None, block_size=1, base=None, attribute='uidNumber', uidmin=None):
+        if(block_size < 1):
+            raise ValueError('block_size must be at least 1')
+        self.conn=conn
+        self.dn=dn
+        self.uidmax=uidmax
+        self.block_size=block_size
+        self.base=base
+        self.attribute=attribute
+        self.uidmin=uidmin
+        self.lock=Lock()
+        self.block=[]
+
+    def next(self):
+        '''returns the next uid, claiming a new block when the last one ran out
+
+        Raises:
+        ValueError if the range is exhausted or the counter is below uidmin
+        '''
+        with self.lock:
+            while(not self.block):
+                self.block=self._claim()
+            return self.block.pop(0)
+
+    def take(self, count):
+        '''returns a list of count uids'''
+        return [self.next() for i in range(count)]
+
+    def _claim(self):
+        '''claim a block, trimmed to uidmax, without the uids already used in base'''
+        block=list(claimuids(self.conn, self.dn, self.block_size, self.uidmax, self.attribute, partial=True, uidmin=self.uidmin))
+        if(self.base == None):
+            return block
+
+        from bin.isuidfree import isuidfree
+        from bin.genuid import uidnumbers
+        with _borrowed(self.conn) as checkconn:
+            free, response = isuidfree(checkconn, block, self.base)
+        if(free):
+            return block
+        taken=set(uidnumbers(response))
+        return [uid for uid in block if uid not in taken]
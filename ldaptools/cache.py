@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+'''ldaptools.cache - an in-process cache of user entries
+
+getuser(), getuid() and mkaccount() in bin/ accept a cache= parameter.
+Entries are indexed by uid, uidNumber and dn, so looking a user up by any of
+them fills all three.  "Not found" answers are cached too, for a shorter
+time.  Use one cache per search base.
+
+    from ldaptools.cache import UserCache
+    cache = UserCache(max_size=1000, ttl=300)
+    found, user = getuser(conn, 'svc_backup', base, cache=cache)
+    print(cache.stats())
+'''
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic
+
+class UserCache:
+    '''a size bounded LRU cache of user entries with per-entry expiry
+
+    Parameters:
+    max_size(int): the maximum number of entries (and of "not found" answers) kept
+    ttl(float): seconds an entry is served from the cache
+    negative_ttl(float): seconds a "not found" answer is served from the cache
+    '''
+
+    def __init__(self, max_size=1000, ttl=300, negative_ttl=60):
+        self.max_size=max_size
+        self.ttl=ttl
+        self.negative_ttl=negative_ttl
+        self.lock=Lock()
+        self.entries=OrderedDict()  # folded dn -> (entry, expires), least recently used first
+        self.index={}               # (attribute, folded value) -> folded dn
+        self.missing=OrderedDict()  # (attribute, folded value) -> expires
+        self.lastrefresh=None
+        self.counters={'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def lookup(self, attribute, value):
+        '''look a user up by uid, uidNumber or dn
+
+        Parameters:
+        attribute(string): one of uid, uidNumber or dn
+        value: the value to look up
+
+        Returns two values in a tuple:
+        True if the cache knows the answer, False if the directory must be asked
+        the cached entry, or None if it is not known or known not to exist
+        '''
+        key=_key(attribute, value)
+        now=monotonic()
+        with self.lock:
+            dn=key[1] if attribute == 'dn' else self.index.get(key)
+            if(dn in self.entries):
+                entry, expires = self.entries[dn]
+                if(expires > now):
+                    self.entries.move_to_end(dn)
+                    self.counters['hits']+=1
+                    return (True, entry)
+                self._drop(dn)
+                self.counters['expirations']+=1
+
+            expires=self.missing.get(key)
+            if(expires != None):
+                if(expires > now):
+                    self.missing.move_to_end(key)
+                    self.counters['negative_hits']+=1
+                    return (True, None)
+                del self.missing[key]
+                self.counters['expirations']+=1
+
+            self.counters['misses']+=1
+            return (False, None)
+
+    def put(self, entry):
+        '''cache an entry as returned by a search, indexed by uid, uidNumber and dn'''
+        dn=_key('dn', entry['dn'])[1]
+        keys=[('dn', dn)]+[_key(attribute, value)
+                for attribute in ('uid', 'uidNumber')
+                for value in _values(entry['attributes'].get(attribute))]
+        with self.lock:
+            self._drop(dn)
+            self.entries[dn]=(entry, monotonic()+self.ttl)
+            for key in keys:
+                self.missing.pop(key, None)
+                if(key[0] != 'dn'):
+                    self.index[key]=dn
+            while(len(self.entries) > self.max_size):
+                self._drop(next(iter(self.entries)))
+                self.counters['evictions']+=1
+
+    def putmissing(self, attribute, value):
+        '''cache that no user has this uid, uidNumber or dn'''
+        key=_key(attribute, value)
+        with self.lock:
+            self.missing[key]=monotonic()+self.negative_ttl
+            self.missing.move_to_end(key)
+            while(len(self.missing) > self.max_size):
+                self.missing.popitem(last=False)
+                self.counters['evictions']+=1
+
+    def invalidate(self, uid=None, uidNumber=None, dn=None):
+        '''forget everything cached about a user, found or not'''
+        keys=[]
+        if(uid != None):
+            keys.append(_key('uid', uid))
+        if(uidNumber != None):
+            keys.append(_key('uidNumber', uidNumber))
+        if(dn != None):
+            keys.append(_key('dn', dn))
+        with self.lock:
+            for key in keys:
+                self.missing.pop(key, None)
+                cached=key[1] if key[0] == 'dn' else self.index.get(key)
+                if(cached in self.entries):
+                    self._drop(cached)
+                    self.counters['invalidations']+=1
+
+    def refresh(self, conn, base, since=None):
+        '''update cached entries that changed in the directory
+
+        Runs one search for posixAccounts whose modifyTimestamp is newer than
+        the last refresh (or since), instead of refetching every entry.
+        Changed entries that are cached are replaced and their ttl restarted,
+        and "not found" answers for keys that now exist are dropped.  Deleted
+        entries are not seen by this search and simply expire.
+
+        Parameters:
+        conn(object): a ldap3 connection object
+        base(string): the basedn to search
+        since(datetime): only look at changes after this time (default the last refresh)
+
+        Returns:
+        the number of cached entries that were updated
+        '''
+        started=datetime.now(timezone.utc)
+        since=since or self.lastrefresh
+        if(since == None):
+            since=started-timedelta(seconds=self.ttl)
+
+        status, result, response, _ = conn.search(base,
+                '(&(objectClass=posixAccount)(modifyTimestamp>=%s))'%since.astimezone(timezone.utc).strftime('%Y%m%d%H%M%SZ'),
+                attributes=['*'])
+        if(not status and result['result'] != 0):
+            raise Exception('refresh search failed: %s'%result['description'])
+
+        updated=0
+        for entry in response:
+            if(entry.get('type') != 'searchResEntry'):
+                continue
+            dn=_key('dn', entry['dn'])[1]
+            with self.lock:
+                cached=dn in self.entries
+            if(cached):
+                self.put(entry)
+                updated+=1
+            else:
+                self.invalidate(dn=entry['dn'], uid=_first(entry['attributes'].get('uid')), uidNumber=_first(entry['attributes'].get('uidNumber')))
+
+        self.lastrefresh=started
+        return updated
+
+    def stats(self):
+        '''returns the hit, miss, eviction and size counters as a dict'''
+        with self.lock:
+            stats=dict(self.counters)
+            stats['size']=len(self.entries)
+            stats['missing_size']=len(self.missing)
+        return stats
+
+    def clear(self):
+        '''forget every entry, keeping the counters'''
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+            self.missing.clear()
+
+    def _drop(self, dn):
+        '''remove an entry and its index keys (lock must be held)'''
+        cached=self.entries.pop(dn, None)
+        if(cached == None):
+            return
+        for attribute in ('uid', 'uidNumber'):
+            for value in _values(cached[0]['attributes'].get(attribute)):
+                key=_key(attribute, value)
+                if(self.index.get(key) == dn):
+                    del self.index[key]
+
+def _key(attribute, value):
+    '''fold a value the way the directory matches it'''
+    if(attribute == 'uidNumber'):
+        return (attribute, int(value))
+    return (attribute, str(value).lower())
+
+def _values(value):
+    if(value == None):
+        return []
+    if(isinstance(value, list)):
+        return value
+    return [value]
+
+def _first(value):
+    values=_values(value)
+    return values[0] if values else None
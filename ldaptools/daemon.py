@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+'''ldaptools.daemon - keep bound connections warm for the bin/ scripts
+
+Every bin/ script pays for START_TLS and a bind before its one query.  The
+daemon holds a pool of bound connections and answers the scripts' queries
+over a Unix socket, so a forwarded invocation only costs a local round
+trip.
+
+Start it with the same connection options the scripts use:
+
+    ./ldaptools/daemon.py -s ldap.company.com --key client.key --cert client.pem
+
+The scripts forward to it whenever the socket exists and the daemon serves
+the same server and identity, with the same --key, --ca, --tls13 and
+--site, and connect directly otherwise (or with --no-daemon).  The
+socket is created readable by its owner only, and the scripts only
+forward to a socket owned by their own user in a directory no other user
+can change (see trusted).
+
+Requests and replies are one JSON object per line:
+
+    {"call": "getuser", "server": ..., "identity": ..., "params": {"username": "jdoe", "base": "..."}}
+    {"ok": true, "result": [true, {...}]}
+    {"ok": false, "error": "too many responses were found (duplicate uid?)", "type": "ValueError"}
+'''
+
+from os import environ, getuid, lstat, path as ospath
+from socket import socket, AF_UNIX, SOCK_STREAM
+from json import dumps, loads
+
+def socketpath():
+    '''returns the default socket path
+
+    LDAPTOOLS_SOCKET if set, otherwise ldaptools.sock in XDG_RUNTIME_DIR, or
+    in /tmp/ldaptools-<uid>, a directory only its owner can use.
+    '''
+    if(environ.get('LDAPTOOLS_SOCKET')):
+        return environ['LDAPTOOLS_SOCKET']
+    if(environ.get('XDG_RUNTIME_DIR')):
+        return ospath.join(environ['XDG_RUNTIME_DIR'], 'ldaptools.sock')
+    return '/tmp/ldaptools-%s/ldaptools.sock'%getuid()
+
+def trusted(socket_path):
+    '''True if socket_path is a socket of this user's that no one else can replace
+
+    Anyone can create a path in /tmp, and a daemon listening there could
+    answer isuidfree or genuid with whatever it likes, so the scripts only
+    forward to a socket owned by their own user, in a directory that only
+    that user (or root) can change, or a sticky one like /tmp itself.
+    '''
+    from stat import S_ISSOCK
+    try:
+        info=lstat(socket_path)
+    except OSError:
+        return False
+    return S_ISSOCK(info.st_mode) and info.st_uid == getuid() and _private(ospath.dirname(ospath.abspath(socket_path)))
+
+def _private(directory):
+    '''True if only this user or root can add, remove or rename entries in directory'''
+    from stat import S_ISDIR, S_ISVTX
+    try:
+        info=lstat(directory)
+    except OSError:
+        return False
+    if(not S_ISDIR(info.st_mode) or info.st_uid not in (getuid(), 0)):
+        return False
+    return not info.st_mode & 0o022 or bool(info.st_mode & S_ISVTX)
+
+def identity(args):
+    '''returns who the parsed args would bind as and how, to match against the daemon
+
+    Returns:
+    a list of the identity (certificate or user), the key, the CA file,
+    whether TLS 1.3 is required and the site, as it reads back from JSON
+    '''
+    return [args.auth_cert or args.auth_user or '',
+            getattr(args, 'auth_key', None),
+            getattr(args, 'ca_certs', None),
+            bool(getattr(args, 'tls13', False)),
+            getattr(args, 'site', None)]
+
+def call(name, params, server, who, socket_path=None, timeout=30):
+    '''run a helper in the daemon and return its result
+
+    Parameters:
+    name(string): the helper to run (getuser, getuid, userexists, isuidfree, genuid, genuids, whoami or pingstate)
+    params(dict): the helper's keyword parameters
+    server(string): the server the caller would connect to
+    who(list): who the caller would bind as and how (see identity)
+    socket_path(string): the daemon socket (default socketpath())
+    timeout(float): seconds to wait for the reply
+
+    Returns:
+    the helper's return value, with tuples as lists
+
+    Raises:
+    OSError if the daemon can not be reached
+    LookupError if the daemon serves a different server or identity, or
+        connects with different options
+    ValueError or Exception if the helper raised one
+    '''
+    client=socket(AF_UNIX, SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path or socketpath())
+        client.sendall((dumps({'call': name, 'server': server, 'identity': who, 'params': params})+'\n').encode('utf-8'))
+        reply=b''
+        while(not reply.endswith(b'\n')):
+            data=client.recv(65536)
+            if(not data):
+                raise OSError('daemon closed the connection')
+            reply+=data
+    finally:
+        client.close()
+
+    reply=loads(reply)
+    if(reply['ok']):
+        return reply['result']
+    if(reply.get('type') == 'LookupError'):
+        raise LookupError(reply['error'])
+    if(reply.get('type') == 'ValueError'):
+        raise ValueError(reply['error'])
+    raise Exception(reply['error'])
+
+def forward(args, name, **params):
+    '''try to run a helper in the daemon on behalf of a bin/ script
+
+    Parameters:
+    args(object): the script's parsed args from ldaptools.argparser
+    name(string): the helper to run
+    **params: the helper's keyword parameters
+
+    Returns two values in a tuple:
+    True if the daemon answered, False if the script should connect itself
+    the helper's return value, or None
+    '''
+    socket_path=getattr(args, 'socket', None) or socketpath()
+    # the daemon can neither see a snapshot nor record for us
+    if(getattr(args, 'snapshot', None) or getattr(args, 'record', None)):
+        return (False, None)
+    if(getattr(args, 'no_daemon', False) or not trusted(socket_path)):
+        return (False, None)
+    try:
+        return (True, call(name, params, args.server, identity(args), socket_path))
+    except (OSError, LookupError):
+        return (False, None)
+
+def _served():
+    '''returns the helpers the daemon runs, by name (imported in the daemon only)'''
+    from bin.getuser import getuser, getuid, userexists
+    from bin.isuidfree import isuidfree
+    from bin.genuid import genuid, genuids
+    from bin.whoami import whoami
+    from bin.pingstate import pingstate
+    return {
+        'getuser': getuser,
+        'getuid': getuid,
+        'userexists': userexists,
+        'isuidfree': isuidfree,
+        'genuid': genuid,
+        'genuids': genuids,
+        'whoami': whoami,
+        'pingstate': pingstate,
+        }
+
+def _jsonable(value):
+    '''convert ldap3 results to plain JSON types, dropping raw attribute bytes'''
+    if(isinstance(value, (list, tuple))):
+        return [_jsonable(v) for v in value]
+    if(isinstance(value, dict) or hasattr(value, 'items')):
+        return {str(k): _jsonable(v) for k, v in value.items() if k != 'raw_attributes'}
+    if(isinstance(value, (bytes, bytearray))):
+        return bytes(value).decode('utf-8', 'replace')
+    if(value == None or isinstance(value, (bool, int, float, str))):
+        return value
+    return str(value)
+
+def serve(args, socket_path=None, max_size=4, **kw):
+    '''serve helper calls over a Unix socket until interrupted
+
+    Parameters:
+    args(object): parsed args from ldaptools.argparser, the server and identity to serve
+    socket_path(string): where to create the socket (default socketpath())
+    max_size(int): the maximum number of pooled connections
+    **kw: extra keywords for ldaptools.pool.ConnectionPool (idle_timeout, ...)
+    '''
+    from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+    from os import mkdir, umask, unlink
+    from ldaptools.pool import ConnectionPool
+
+    served=_served()
+    pool=ConnectionPool(max_size=max_size, args=args, **kw)
+    socket_path=socket_path or socketpath()
+    who=identity(args)
+
+    class Handler(StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request=loads(line)
+                    if(request.get('server') != args.server or request.get('identity') != who):
+                        raise LookupError('this daemon serves %s as %s'%(args.server, who[0] or 'anonymous'))
+                    function=served.get(request.get('call'))
+                    if(function == None):
+                        raise LookupError('unknown call %s'%request.get('call'))
+                    with pool.connection() as conn:
+                        result=function(conn, **request.get('params', {}))
+                    reply={'ok': True, 'result': _jsonable(result)}
+                except Exception as e:
+                    reply={'ok': False, 'error': str(e), 'type': type(e).__name__}
+                self.wfile.write((dumps(reply)+'\n').encode('utf-8'))
+                self.wfile.flush()
+
+    directory=ospath.dirname(ospath.abspath(socket_path))
+    if(socket_path == socketpath() and not ospath.lexists(directory)):
+        mkdir(directory, 0o700)
+    if(not _private(directory)):
+        raise PermissionError('%s can be changed by other users, refusing to serve in it'%directory)
+    if(ospath.lexists(socket_path)):
+        # only ever remove our own stale socket, never someone else's file
+        if(not trusted(socket_path)):
+            raise PermissionError('%s exists and is not a socket of this user\'s'%socket_path)
+        unlink(socket_path)
+    previous=umask(0o177)
+    try:
+        server=ThreadingUnixStreamServer(socket_path, Handler)
+    finally:
+        umask(previous)
+    server.daemon_threads=True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+        if(ospath.exists(socket_path)):
+            unlink(socket_path)
+
+if __name__ == '__main__':
+    # this script might be called from the project directory, in cases where
+    # the ldaptools module has not been "installed". This inserts the
+    # project directory into python's path, so the module can be found
+    from pathlib import Path
+    from sys import path
+    project = str(Path(__file__).resolve().parents[1])
+    path.insert(0, project)
+
+    from ldaptools import argparser
+    parser = argparser('keep bound ldap connections warm for the bin/ scripts')
+    parser.add_argument('--pool-size',
+            type=int,
+            default=4,
+            help='maximum number of pooled connections')
+    args = parser.parse_args()
+    serve(args, args.socket, args.pool_size)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+'''ldaptools.fanout - run one search over many bases and servers at once
+
+Users live in several OUs and the OUs on several servers, so a question
+like "is this uid used anywhere" is one search per (server, base).  fanout()
+runs them all from a thread pool, merges the entries by dn, stops as soon
+as a stop() test says the answer is known, and gives up on whatever is
+still running when the deadline passes.
+
+    conns = connectall(args=args)     # one connection per server in -s a,b
+    entries, errors, complete = fanout(conns, ['ou=People,dc=company,dc=com', 'ou=Applications,dc=company,dc=com'],
+            '(uidNumber=1234)', ['uidNumber'], timeout=5, stop=lambda entries: len(entries) > 0)
+
+isuidfree, getuser and getuid in bin/ use it when given a list of bases or
+of connections.
+'''
+
+from contextlib import nullcontext
+from contextvars import copy_context
+from math import ceil
+from time import monotonic
+from ldaptools import connect, connparams
+from ldaptools.pool import ConnectionPool
+
+# ldap result codes that mean "nothing here" rather than a failure
+RESULT_SUCCESS=0
+RESULT_NO_SUCH_OBJECT=32
+
+class FanoutTimeout(Exception):
+    '''raised by the helpers when the deadline passed before the answer was known'''
+
+def fanout(conns, bases, search_filter, attributes=['*'], timeout=None, stop=None, workers=8):
+    '''run a search over every combination of connection and base concurrently
+
+    A base that does not exist on a server counts as holding no entries.
+    Searches that have not started when the fan-out ends are cancelled; ones
+    already running are left to finish in the background (each is sent with
+    a server side time limit matching the deadline).
+
+    Parameters:
+    conns(list): ldap3 connection objects or ldaptools.pool.ConnectionPools, one per server
+        (a single one is accepted too)
+    bases(list): the basedns to search (a single string is accepted too)
+    search_filter(string): the ldap filter to match
+    attributes(list): the attributes to return
+    timeout(float): seconds until the fan-out gives up, None to wait for every search
+    stop(callable): called with the merged entries after each search finishes,
+        return True once they settle the answer to end the fan-out early
+    workers(int): the maximum number of searches in flight
+
+    Returns three values in a tuple:
+    a list of the entries found, one per dn, in the order they arrived
+    a dict of 'server base' to the error, for every search that failed
+    True if every search finished, False if stop() or the deadline ended it early
+    '''
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    if(not isinstance(conns, (list, tuple))):
+        conns=[conns]
+    if(isinstance(bases, str)):
+        bases=[bases]
+    deadline=monotonic()+timeout if timeout != None else None
+
+    def search(conn, base):
+        time_limit=max(ceil(deadline-monotonic()), 1) if deadline != None else 0
+        with (conn.connection() if isinstance(conn, ConnectionPool) else nullcontext(conn)) as borrowed:
+            status, result, response, _ = borrowed.search(base, search_filter, attributes=attributes, time_limit=time_limit)
+        if(not status and result['result'] not in (RESULT_SUCCESS, RESULT_NO_SUCH_OBJECT)):
+            raise Exception(result['description'])
+        return [entry for entry in response if entry.get('type') == 'searchResEntry']
+
+    executor=ThreadPoolExecutor(max_workers=max(1, min(workers, len(conns)*len(bases))))
+    pending={}
+    for conn in conns:
+        for base in bases:
+            # each search runs in a copy of this context, so metrics keep the helper label
+            pending[executor.submit(copy_context().run, search, conn, base)]='%s %s'%(_label(conn), base)
+
+    entries={}
+    errors={}
+    complete=True
+    try:
+        while(pending):
+            remaining=deadline-monotonic() if deadline != None else None
+            if(remaining != None and remaining <= 0):
+                complete=False
+                break
+            finished, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in finished:
+                target=pending.pop(future)
+                try:
+                    for entry in future.result():
+                        entries.setdefault(entry['dn'].lower(), entry)
+                except Exception as e:
+                    errors[target]=str(e)
+            if(stop != None and stop(list(entries.values()))):
+                complete=not pending
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return (list(entries.values()), errors, complete)
+
+def connectall(**kw):
+    '''connect to every server of a comma separated or srv: server list
+
+    Parameters:
+    **kw: keywords for ldaptools.connect (args, server, auth_user, ...)
+
+    Returns:
+    a list of ldap3 connection objects, one per server
+    '''
+    from argparse import Namespace
+    from ldaptools.topology import expand
+    server, auth_user, auth_pass, auth_key, auth_cert = connparams(**kw)
+    servers=expand(server if isinstance(server, tuple) else (server,))
+    args=kw.pop('args', None)
+    if(args == None):
+        return [connect(**dict(kw, server=s)) for s in servers]
+    # args names the whole list, so each connection gets a copy naming its
+    # own server, and keeps the rest of the options (--ca, --snapshot, ...)
+    return [connect(args=Namespace(**dict(vars(args), server=s)), **kw) for s in servers]
+
+def _label(conn):
+    '''the server a connection or pool talks to, for error messages'''
+    if(isinstance(conn, ConnectionPool)):
+        return str(connparams(**conn.kw)[0])
+    return conn.server.host
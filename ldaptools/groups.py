@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+'''ldaptools.groups - every group membership under a base, indexed both ways
+
+A GroupIndex reads every posixGroup, groupOfNames and groupOfUniqueNames
+under a base with one paged search and indexes the memberships by user and
+by group, so checking a user's groups costs a few dict lookups instead of a
+search per user.  Groups that are members of other groups (member or
+uniqueMember holding a group's dn) are followed transitively, and the
+closure of each group is worked out once and kept until the next load().
+
+    groups = GroupIndex('ou=Group,dc=company,dc=com')
+    groups.load(conn)
+    groups.getgroups('jdoe')                     # [{'dn': ..., 'cn': ..., 'gidNumber': ...}, ...]
+    groups.getgroups_many(['jdoe', 'asmith'])    # {'jdoe': [...], 'asmith': [...]}
+    groups.ismember('jdoe', 'wheel')
+
+Users are matched by uid.  memberUid values are uids, and member dns that
+are not groups are matched by their dn, and by their uid if the first RDN
+is uid= (uid=jdoe,ou=People,dc=company,dc=com).
+'''
+
+from threading import RLock
+from ldaptools import iter_entries
+
+GROUP_FILTER='(|(objectClass=posixGroup)(objectClass=groupOfNames)(objectClass=groupOfUniqueNames))'
+
+# the attributes read for every group
+ATTRIBUTES=['cn', 'gidNumber', 'memberUid', 'member', 'uniqueMember']
+
+class GroupIndex:
+    '''the groups under a base, indexed by member and by group
+
+    Parameters:
+    base(string): the basedn holding the groups
+    search_filter(string): the entries that are groups
+    '''
+
+    def __init__(self, base, search_filter=GROUP_FILTER):
+        self.base=base
+        self.search_filter=search_filter
+        self.lock=RLock()
+        self.groups={}      # folded group dn -> {'dn', 'cn', 'gidNumber'}
+        self.names={}       # folded cn -> set of folded group dns
+        self.gids={}        # gidNumber -> set of folded group dns
+        self.direct={}      # folded uid or member dn -> set of folded group dns
+        self.members={}     # folded group dn -> set of folded uids and member dns
+        self.parents={}     # folded group dn -> set of folded group dns it is a member of
+        self.children={}    # folded group dn -> set of folded group dns that are its members
+        self.ancestors={}   # folded group dn -> every group it is in, directly or not (memo)
+        self.descendants={} # folded group dn -> every group in it, directly or not (memo)
+        self.loaded=False
+
+    def load(self, conn, page_size=500):
+        '''replace the index with every group in the directory
+
+        Parameters:
+        conn(object): a ldap3 connection object
+        page_size(int): the number of entries to request per page
+
+        Returns:
+        the number of groups loaded
+        '''
+        groups={}
+        names={}
+        gids={}
+        members={}
+        for entry in iter_entries(conn, self.base, self.search_filter, ATTRIBUTES, page_size):
+            attributes=entry['attributes']
+            dn=_fold(entry['dn'])
+            cn=_first(attributes.get('cn'))
+            gid=_first(attributes.get('gidNumber'))
+            try:
+                gid=None if gid == None else int(gid)
+            except (TypeError, ValueError):
+                gid=None
+            groups[dn]={'dn': entry['dn'], 'cn': cn, 'gidNumber': gid}
+            if(cn != None):
+                names.setdefault(_fold(cn), set()).add(dn)
+            if(gid != None):
+                gids.setdefault(gid, set()).add(dn)
+            keys=members.setdefault(dn, set())
+            keys.update(_fold(uid) for uid in _values(attributes, 'memberUid'))
+            for attribute in ('member', 'uniqueMember'):
+                keys.update(_fold(member) for member in _values(attributes, attribute))
+
+        # now that every group is known, split the member dns into groups and users
+        direct={}
+        parents={}
+        children={}
+        for dn, keys in members.items():
+            for key in keys:
+                if(key in groups):
+                    parents.setdefault(key, set()).add(dn)
+                    children.setdefault(dn, set()).add(key)
+                    continue
+                direct.setdefault(key, set()).add(dn)
+                uid=_rdnuid(key)
+                if(uid != None):
+                    direct.setdefault(uid, set()).add(dn)
+            # a group's members are its users, its member groups are in children
+            members[dn]=set(key for key in keys if key not in groups)
+
+        with self.lock:
+            self.groups=groups
+            self.names=names
+            self.gids=gids
+            self.direct=direct
+            self.members=members
+            self.parents=parents
+            self.children=children
+            self.ancestors={}
+            self.descendants={}
+            self.loaded=True
+        return len(groups)
+
+    def getgroups(self, uid, gidNumber=None, nested=True):
+        '''returns the groups a user is a member of
+
+        Parameters:
+        uid(string): the posix username, or the dn of the member
+        gidNumber(int): the user's primary gid, its group is included too
+        nested(bool): include the groups that the user's groups are members of
+
+        Returns:
+        a list of {'dn', 'cn', 'gidNumber'} dicts, sorted by gidNumber then cn
+        '''
+        with self.lock:
+            dns=set(self.direct.get(_fold(uid), ()))
+            if(gidNumber != None):
+                dns.update(self.gids.get(int(gidNumber), ()))
+            if(nested):
+                for dn in list(dns):
+                    dns.update(self._closure(dn, self.parents, self.ancestors))
+            return _sorted(self.groups[dn] for dn in dns)
+
+    def getgroups_many(self, uids, gidNumbers=None, nested=True):
+        '''returns the groups of many users at once
+
+        Parameters:
+        uids(list): the posix usernames, or the dns of the members
+        gidNumbers(dict): uid to the user's primary gid, for the users that have one
+        nested(bool): include the groups that the users' groups are members of
+
+        Returns:
+        a dict of uid to the list getgroups returns for it
+        '''
+        gidNumbers=gidNumbers or {}
+        with self.lock:
+            return {uid: self.getgroups(uid, gidNumbers.get(uid), nested) for uid in uids}
+
+    def getmembers(self, group, nested=True):
+        '''returns the members of a group
+
+        Parameters:
+        group(string): the cn or dn of the group
+        nested(bool): include the members of the groups that are members of it
+
+        Returns:
+        a sorted list of the uids and member dns (lowercased), or None if the group is not known
+        '''
+        with self.lock:
+            dns=self._resolve(group)
+            if(not dns):
+                return None
+            if(nested):
+                for dn in list(dns):
+                    dns.update(self._closure(dn, self.children, self.descendants))
+            members=set()
+            for dn in dns:
+                members.update(self.members.get(dn, ()))
+            return sorted(members)
+
+    def ismember(self, uid, group, nested=True):
+        '''True if a user is a member of a group (given by cn or dn)'''
+        with self.lock:
+            wanted=self._resolve(group)
+            direct=self.direct.get(_fold(uid), set())
+            if(not wanted or wanted & direct):
+                return bool(wanted)
+            if(not nested):
+                return False
+            return any(wanted & self._closure(dn, self.parents, self.ancestors) for dn in direct)
+
+    def stats(self):
+        '''returns the number of groups, members and memberships indexed'''
+        with self.lock:
+            return {
+                'groups': len(self.groups),
+                'members': len(self.direct),
+                'memberships': sum(len(keys) for keys in self.members.values()),
+                'nested': sum(len(dns) for dns in self.children.values()),
+                }
+
+    def _resolve(self, group):
+        '''the folded dns of a group given by cn or dn'''
+        group=_fold(group)
+        if(group in self.groups):
+            return {group}
+        return set(self.names.get(group, ()))
+
+    @staticmethod
+    def _closure(dn, edges, memo):
+        '''every group reachable from dn over edges, not including dn unless in a cycle
+
+        The result for dn is kept in memo, and the walk stops at any group
+        that already has one, so each closure is worked out once per load.
+        Only finished walks are kept, which keeps cycles correct.
+        '''
+        reached=memo.get(dn)
+        if(reached != None):
+            return reached
+        reached=set()
+        pending=list(edges.get(dn, ()))
+        while(pending):
+            group=pending.pop()
+            if(group in reached):
+                continue
+            reached.add(group)
+            known=memo.get(group)
+            if(known != None):
+                reached.update(known)
+                continue
+            pending.extend(edges.get(group, ()))
+        memo[dn]=reached
+        return reached
+
+def _values(attributes, attribute):
+    value=attributes.get(attribute)
+    if(value == None):
+        return []
+    return value if isinstance(value, list) else [value]
+
+def _first(value):
+    if(isinstance(value, list)):
+        return value[0] if value else None
+    return value
+
+def _fold(value):
+    '''fold a uid or dn the way the directory matches it'''
+    return ','.join(part.strip() for part in str(value).lower().split(','))
+
+def _rdnuid(dn):
+    '''the uid of a dn whose first RDN is uid=, or None'''
+    rdn=dn.split(',', 1)[0]
+    if(not rdn.startswith('uid=')):
+        return None
+    return rdn[4:].strip()
+
+def _sorted(groups):
+    return sorted(groups, key=lambda group: (group['gidNumber'] == None, group['gidNumber'] or 0, group['cn'] or ''))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+'''ldaptools.metrics - operation timing and usage metrics
+
+connect(metrics=True) (or instrument(conn)) wraps a connection's search,
+add, modify, delete, compare and extended methods so every call records its
+latency in a histogram labelled by operation, server and the ldaptools
+helper that issued it.  The helpers in bin/ label themselves with the
+helper decorator.  Bytes sent and received and referrals come from the
+usage statistics ldap3 already collects (connect passes collect_usage=True).
+
+The metrics can be read with snapshot(), rendered in the Prometheus text
+format with prometheus(), served over http with serve(), or written to a
+JSON file periodically with dump().
+
+    conn = connect(args=args, metrics=True)
+    ...
+    print(prometheus())
+'''
+
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock, Thread, Event
+from time import perf_counter, time
+from weakref import finalize
+from itertools import count
+from json import dumps
+from os import replace
+
+# latency histogram bucket upper bounds, in seconds
+BUCKETS=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# ldap result codes that are not errors
+RESULT_SUCCESS=0
+RESULT_COMPARE_FALSE=5
+RESULT_COMPARE_TRUE=6
+
+# the connection methods that are timed
+OPERATIONS=('search', 'add', 'modify', 'delete', 'compare', 'extended')
+
+# the ldap3 usage counters exported, in the order they are kept
+USAGE=('bytes_transmitted', 'bytes_received', 'referrals_received')
+
+_helper=ContextVar('ldaptools_helper', default='')
+
+class Registry:
+    '''latency histograms and error counts, plus the connections to read usage from
+
+    The usage of a connection is read live while it is open, and added to
+    its server's totals when it is unbound, reopened or garbage collected,
+    so the exported byte and referral counters never go down.
+    '''
+
+    def __init__(self):
+        self.lock=Lock()
+        self.histograms={}  # (operation, helper, server) -> [bucket counts..., +Inf count, sum]
+        self.errors={}      # (operation, helper, server) -> count
+        self.usage={}       # server -> USAGE totals of the usage already folded in
+        self.live={}        # key -> [server, ldap3 usage, USAGE values already folded in]
+        self.keys=count()
+
+    def track(self, conn):
+        '''read a connection's usage until it is gone'''
+        usage=conn.usage
+        if(not usage):
+            return
+        key=next(self.keys)
+        with self.lock:
+            self.live[key]=[conn.server.host, usage, [0]*len(USAGE)]
+        finalize(conn, self._fold, key, True)
+
+        unbind=conn.unbind
+        def unbound(*args, **kw):
+            try:
+                return unbind(*args, **kw)
+            finally:
+                self._fold(key)
+        conn.unbind=wraps(unbind)(unbound)
+
+        # ldap3 resets the usage when a connection is opened again
+        reopen=conn.open
+        def opened(*args, **kw):
+            self._fold(key)
+            try:
+                return reopen(*args, **kw)
+            finally:
+                with self.lock:
+                    if(key in self.live):
+                        self.live[key][2]=_counts(usage)
+        conn.open=wraps(reopen)(opened)
+
+    def _fold(self, key, final=False):
+        '''add what a connection used since the last fold to its server's totals'''
+        with self.lock:
+            entry=self.live.get(key)
+            if(entry == None):
+                return
+            server, usage, folded = entry
+            current=_counts(usage)
+            totals=self.usage.setdefault(server, [0]*len(USAGE))
+            for i, value in enumerate(current):
+                totals[i]+=max(0, value-folded[i])
+            entry[2]=current
+            if(final):
+                del self.live[key]
+
+    def observe(self, operation, helper, server, seconds, failed=False):
+        '''record one operation'''
+        key=(operation, helper, server)
+        with self.lock:
+            histogram=self.histograms.get(key)
+            if(histogram == None):
+                histogram=self.histograms[key]=[0]*(len(BUCKETS)+2)
+            for i, bound in enumerate(BUCKETS):
+                if(seconds <= bound):
+                    histogram[i]+=1
+            histogram[-2]+=1
+            histogram[-1]+=seconds
+            if(failed):
+                self.errors[key]=self.errors.get(key, 0)+1
+
+    def snapshot(self):
+        '''returns every metric as a plain dict'''
+        with self.lock:
+            operations=[]
+            for (operation, helper, server), histogram in self.histograms.items():
+                operations.append({
+                    'operation': operation,
+                    'helper': helper,
+                    'server': server,
+                    'count': histogram[-2],
+                    'sum': histogram[-1],
+                    'errors': self.errors.get((operation, helper, server), 0),
+                    'buckets': dict(zip([str(b) for b in BUCKETS], histogram[:len(BUCKETS)])),
+                    })
+            totals={server: list(values) for server, values in self.usage.items()}
+            for server, usage, folded in self.live.values():
+                values=totals.setdefault(server, [0]*len(USAGE))
+                for i, value in enumerate(_counts(usage)):
+                    values[i]+=max(0, value-folded[i])
+
+        servers={server: dict(zip(('bytes_sent', 'bytes_received', 'referrals'), values)) for server, values in totals.items()}
+        return {'time': time(), 'operations': operations, 'servers': servers}
+
+    def reset(self):
+        '''forget every recorded operation'''
+        with self.lock:
+            self.histograms.clear()
+            self.errors.clear()
+
+REGISTRY=Registry()
+
+def helper(name):
+    '''decorator that labels the operations run inside a function with name
+
+    Nested helpers keep the outermost label, so the ldap searches genuid
+    runs through isuidfree are counted under genuid.
+    '''
+    def decorate(function):
+        @wraps(function)
+        def labelled(*args, **kw):
+            if(_helper.get()):
+                return function(*args, **kw)
+            token=_helper.set(name)
+            try:
+                return function(*args, **kw)
+            finally:
+                _helper.reset(token)
+        return labelled
+    return decorate
+
+def instrument(conn, registry=None):
+    '''time every operation run on a connection
+
+    Only synchronous strategies (SYNC, SAFE_SYNC, ...) are timed, as the
+    asynchronous ones return before the server answers.
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    registry(object): the Registry to record into (default the shared REGISTRY)
+
+    Returns:
+    the same connection object
+    '''
+    registry=registry or REGISTRY
+    registry.track(conn)
+    if(not conn.strategy.sync):
+        return conn
+
+    server=conn.server.host
+    for operation in OPERATIONS:
+        method=getattr(conn, operation)
+        def timed(*args, _method=method, _operation=operation, **kw):
+            started=perf_counter()
+            failed=True
+            try:
+                value=_method(*args, **kw)
+                failed=_failed(value)
+                return value
+            finally:
+                registry.observe(_operation, _helper.get(), server, perf_counter()-started, failed)
+        setattr(conn, operation, wraps(method)(timed))
+    return conn
+
+def _counts(usage):
+    return [getattr(usage, name) for name in USAGE]
+
+def _failed(value):
+    '''True if a SAFE_SYNC style return value carries an error result'''
+    if(isinstance(value, tuple) and len(value) == 4 and isinstance(value[1], dict)):
+        return value[1].get('result') not in (None, RESULT_SUCCESS, RESULT_COMPARE_FALSE, RESULT_COMPARE_TRUE)
+    return False
+
+def snapshot(registry=None):
+    '''returns every metric in the registry as a plain dict'''
+    return (registry or REGISTRY).snapshot()
+
+def prometheus(registry=None):
+    '''returns the metrics in the Prometheus text exposition format'''
+    data=snapshot(registry)
+    lines=[
+        '# HELP ldaptools_operation_seconds latency of ldap operations',
+        '# TYPE ldaptools_operation_seconds histogram',
+        ]
+    for op in data['operations']:
+        labels='operation="%s",helper="%s",server="%s"'%(op['operation'], op['helper'], _escape(op['server']))
+        for bound, count in op['buckets'].items():
+            lines.append('ldaptools_operation_seconds_bucket{%s,le="%s"} %s'%(labels, bound, count))
+        lines.append('ldaptools_operation_seconds_bucket{%s,le="+Inf"} %s'%(labels, op['count']))
+        lines.append('ldaptools_operation_seconds_sum{%s} %s'%(labels, op['sum']))
+        lines.append('ldaptools_operation_seconds_count{%s} %s'%(labels, op['count']))
+
+    lines.append('# HELP ldaptools_operation_errors_total ldap operations that raised or returned an error result')
+    lines.append('# TYPE ldaptools_operation_errors_total counter')
+    for op in data['operations']:
+        labels='operation="%s",helper="%s",server="%s"'%(op['operation'], op['helper'], _escape(op['server']))
+        lines.append('ldaptools_operation_errors_total{%s} %s'%(labels, op['errors']))
+
+    for name, field, text in (
+            ('ldaptools_bytes_sent_total', 'bytes_sent', 'bytes sent to the server'),
+            ('ldaptools_bytes_received_total', 'bytes_received', 'bytes received from the server'),
+            ('ldaptools_referrals_total', 'referrals', 'referrals received from the server')):
+        lines.append('# HELP %s %s'%(name, text))
+        lines.append('# TYPE %s counter'%name)
+        for server, usage in data['servers'].items():
+            lines.append('%s{server="%s"} %s'%(name, _escape(server), usage[field]))
+
+    return '\n'.join(lines)+'\n'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def serve(port=9389, address='127.0.0.1', registry=None):
+    '''serve the Prometheus text format over http from a daemon thread
+
+    The metrics name the helpers and servers in use, so only the local host
+    can read them unless another address is given ('' for every interface).
+
+    Parameters:
+    port(int): the port to listen on
+    address(string): the address to listen on (default the loopback address)
+    registry(object): the Registry to export
+
+    Returns:
+    the http.server object (call shutdown() to stop it)
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body=prometheus(registry).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server=ThreadingHTTPServer((address, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump(filename, interval=60, registry=None):
+    '''write a JSON snapshot of the metrics to a file every interval seconds
+
+    The file is replaced atomically, and written one last time when the
+    returned event is set.
+
+    Parameters:
+    filename(string): the file to write
+    interval(float): seconds between writes
+    registry(object): the Registry to export
+
+    Returns:
+    a threading.Event, set it to stop dumping
+    '''
+    stop=Event()
+
+    def write():
+        with open(filename+'.tmp', 'w') as handle:
+            handle.write(dumps(snapshot(registry)))
+        replace(filename+'.tmp', filename)
+
+    def run():
+        while(not stop.wait(interval)):
+            write()
+        write()
+
+    Thread(target=run, daemon=True).start()
+    return stop
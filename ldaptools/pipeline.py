@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+'''ldaptools.pipeline - many operations in flight on a few connections
+
+A SAFE_SYNC connection waits for each response before the next request is
+sent, so over a slow link every operation costs a full round trip.  A
+Pipeline writes requests to one or a few ldap3 ASYNC connections as soon as
+they are submitted, keeps up to window of them outstanding, and hands back
+a concurrent.futures.Future per operation, completed by the pipeline's own
+thread once the connection's receiver has the response with its message id.
+
+    with Pipeline(window=64, args=args) as pipeline:
+        futures = [pipeline.search(base, '(uid=%s)'%escape_filter_chars(name), attributes=['uid']) for name in names]
+        for future in futures:
+            status, result, response, _ = future.result()
+
+Futures resolve to the same (status, result, response, request) tuples as a
+SAFE_SYNC connection, and getuser, isuidfree and mkaccount below mirror the
+functions in bin/ of the same name.  pipeline.sync is a connection-like
+object whose methods wait for their future, so any helper in bin/ can share
+the pipeline from many threads.
+
+Operations are not ordered against each other, even on one connection (the
+server may work on them in parallel).  Wait for an add before submitting a
+modify of the same entry.
+'''
+
+# the helpers reuse the pure parts of the bin/ scripts
+from pathlib import Path
+from sys import path
+project = str(Path(__file__).resolve().parents[1])
+if(project not in path):
+    path.insert(0, project)
+
+from concurrent.futures import Future
+from threading import Condition, Lock, Semaphore, Thread
+from queue import SimpleQueue
+from heapq import heappush, heappop
+from time import monotonic
+from ldap3 import ASYNC
+from ldap3.utils.conv import escape_filter_chars
+from ldaptools import connect
+from bin.mkaccount import accountattributes
+
+# ldap result codes
+RESULT_SUCCESS=0
+RESULT_COMPARE_TRUE=6
+
+class PipelineTimeout(Exception):
+    '''raised by a future whose operation was not answered in time'''
+
+class Pipeline:
+    '''submit ldap operations and get futures, with up to window in flight
+
+    Parameters:
+    connections(int): the number of ASYNC connections to open
+    window(int): the maximum number of operations outstanding at once, over
+        every connection; submitting more blocks until one completes
+    timeout(float): default seconds an operation may take before its future
+        fails with PipelineTimeout (None waits forever)
+
+    When a connection's receiver stops (the server closed it, or the
+    network failed) the operations outstanding on it fail with
+    ConnectionError, and new ones go to the other connections.
+    conns(list): already bound ASYNC (or MOCK_ASYNC) connections to use
+        instead of opening new ones
+    **kw: keywords passed to ldaptools.connect (server, auth_user, args, ...)
+    '''
+
+    def __init__(self, connections=1, window=64, timeout=60, conns=None, **kw):
+        if(window < 1):
+            raise ValueError('window must be at least 1')
+        self.window=window
+        self.timeout=timeout
+        self.slots=Semaphore(window)
+        self.lock=Lock()
+        self.pending={}     # (connection index, message id) -> (future, deadline)
+        self.deadlines=[]   # heap of (deadline, connection index, message id)
+        self.reaper=None
+        self.wake=Condition(self.lock)
+        self.closed=False
+        self.owned=conns == None
+        if(conns == None):
+            kw.setdefault('client_strategy', ASYNC)
+            conns=[connect(**kw) for i in range(connections)]
+        self.conns=list(conns)
+        self.inflight=[0]*len(self.conns)
+        self.lost=[False]*len(self.conns)
+        self.immediate=[getattr(conn.strategy, 'no_real_dsa', False) for conn in self.conns]
+        self.completed=SimpleQueue()
+        if(not all(self.immediate)):
+            Thread(target=self._completer, daemon=True).start()
+        for index, conn in enumerate(self.conns):
+            if(not self.immediate[index]):
+                self._listen(index, conn)
+        self.sync=SyncView(self)
+
+    def search(self, search_base, search_filter, timeout=None, **kw):
+        '''submit a search, see ldap3.Connection.search for the parameters
+
+        Returns:
+        a Future of (True if any entries were found, result, entries, None)
+        '''
+        return self._submit(lambda conn: conn.search(search_base, search_filter, **kw), _searched, timeout)
+
+    def add(self, dn, object_class=None, attributes=None, controls=None, timeout=None):
+        '''submit an add, returns a Future of (status, result, response, None)'''
+        return self._submit(lambda conn: conn.add(dn, object_class, attributes, controls), _succeeded, timeout)
+
+    def modify(self, dn, changes, controls=None, timeout=None):
+        '''submit a modify, returns a Future of (status, result, response, None)'''
+        return self._submit(lambda conn: conn.modify(dn, changes, controls), _succeeded, timeout)
+
+    def delete(self, dn, controls=None, timeout=None):
+        '''submit a delete, returns a Future of (status, result, response, None)'''
+        return self._submit(lambda conn: conn.delete(dn, controls), _succeeded, timeout)
+
+    def compare(self, dn, attribute, value, controls=None, timeout=None):
+        '''submit a compare, returns a Future of (True if it matched, result, response, None)'''
+        return self._submit(lambda conn: conn.compare(dn, attribute, value, controls), _compared, timeout)
+
+    def extended(self, request_name, request_value=None, controls=None, timeout=None):
+        '''submit an extended operation, returns a Future of (status, result, response, None)'''
+        return self._submit(lambda conn: conn.extended(request_name, request_value, controls), _succeeded, timeout)
+
+    def close(self):
+        '''fail the outstanding futures, and unbind the connections the pipeline opened'''
+        with self.lock:
+            self.closed=True
+            pending=list(self.pending.values())
+            self.pending.clear()
+            self.deadlines.clear()
+            self.wake.notify_all()
+        self.completed.put(None)
+        for future, _ in pending:
+            _fail(future, ConnectionError('pipeline closed'))
+        if(self.owned):
+            for conn in self.conns:
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _submit(self, send, shape, timeout):
+        '''send an operation on the least busy connection and return its future'''
+        timeout=self.timeout if timeout == None else timeout
+        self.slots.acquire()
+        future=Future()
+        future.set_running_or_notify_cancel()
+        future.shape=shape
+        with self.lock:
+            if(self.closed):
+                self.slots.release()
+                raise Exception('pipeline is closed')
+            live=[index for index in range(len(self.conns)) if not self.lost[index]]
+            if(not live):
+                self.slots.release()
+                _fail(future, ConnectionError('every connection of the pipeline was lost'))
+                return future
+            index=min(live, key=self.inflight.__getitem__)
+            self.inflight[index]+=1
+            conn=self.conns[index]
+            try:
+                # sent under the lock, so the response can not beat the bookkeeping
+                message_id=send(conn)
+            except Exception as e:
+                self.inflight[index]-=1
+                self.slots.release()
+                _fail(future, e)
+                return future
+            deadline=None if timeout == None else monotonic()+timeout
+            self.pending[(index, message_id)]=(future, deadline)
+            if(deadline != None):
+                heappush(self.deadlines, (deadline, index, message_id))
+                self._startreaper()
+        if(self.immediate[index]):
+            self._complete(index, message_id)
+        return future
+
+    def _listen(self, index, conn):
+        '''pass the message ids the connection's receiver thread completes to _completer'''
+        original=conn.strategy.set_event_for_message
+        def notify(message_id):
+            original(message_id)
+            self.completed.put((index, message_id))
+        conn.strategy.set_event_for_message=notify
+
+        receiver=getattr(conn.strategy, 'receiver', None)
+        if(receiver != None):
+            # queued behind the responses the receiver completed before it stopped
+            def watch():
+                receiver.join()
+                self.completed.put((index, None))
+            Thread(target=watch, daemon=True).start()
+
+    def _completer(self):
+        # the receiver holds ldap3's lock while it notifies, so responses
+        # are collected from here rather than from notify
+        while(True):
+            completed=self.completed.get()
+            if(completed == None):
+                return
+            self._complete(*completed)
+
+    def _complete(self, index, message_id):
+        '''resolve the future of a message whose response is complete'''
+        if(message_id == None):
+            self._lose(index)
+            return
+        with self.lock:
+            entry=self.pending.pop((index, message_id), None)
+            if(entry != None):
+                self.inflight[index]-=1
+        conn=self.conns[index]
+        try:
+            response, result = conn.get_response(message_id)
+        except Exception as e:
+            if(entry != None):
+                self.slots.release()
+                _fail(entry[0], e)
+            return
+        if(entry == None):
+            # timed out and abandoned, the late response is dropped
+            return
+        self.slots.release()
+        future=entry[0]
+        if(not future.done()):
+            future.set_result(future.shape(result, response))
+
+    def _lose(self, index):
+        '''fail the operations outstanding on a connection whose receiver stopped'''
+        with self.lock:
+            self.lost[index]=True
+            lost=[key for key in self.pending if key[0] == index]
+            futures=[self.pending.pop(key)[0] for key in lost]
+            self.inflight[index]-=len(lost)
+        for future in futures:
+            self.slots.release()
+            _fail(future, ConnectionError('the connection to the server was lost'))
+
+    def _startreaper(self):
+        '''start the thread that fails operations past their deadline (lock held)'''
+        if(self.reaper == None):
+            self.reaper=Thread(target=self._reap, daemon=True)
+            self.reaper.start()
+        self.wake.notify()
+
+    def _reap(self):
+        with self.lock:
+            while(not self.closed):
+                now=monotonic()
+                expired=[]
+                while(self.deadlines and self.deadlines[0][0] <= now):
+                    _, index, message_id = heappop(self.deadlines)
+                    entry=self.pending.get((index, message_id))
+                    # the id may have been answered, or reused on a new operation
+                    if(entry == None or entry[1] == None or entry[1] > now):
+                        continue
+                    del self.pending[(index, message_id)]
+                    self.inflight[index]-=1
+                    expired.append((index, message_id, entry[0]))
+                if(expired):
+                    self.lock.release()
+                    try:
+                        for index, message_id, future in expired:
+                            self.slots.release()
+                            _fail(future, PipelineTimeout('no response within the deadline'))
+                            try:
+                                self.conns[index].abandon(message_id)
+                            except Exception:
+                                pass
+                    finally:
+                        self.lock.acquire()
+                    continue
+                self.wake.wait(None if not self.deadlines else self.deadlines[0][0]-now)
+
+class SyncView:
+    '''a SAFE_SYNC style connection whose operations go through a Pipeline
+
+    Each call waits for its own response, so it is only faster than a
+    connection when several threads share it.
+    '''
+
+    def __init__(self, pipeline):
+        self.pipeline=pipeline
+
+    def search(self, search_base, search_filter, search_scope=None, **kw):
+        if(search_scope != None):
+            kw['search_scope']=search_scope
+        return self.pipeline.search(search_base, search_filter, **kw).result()
+
+    def add(self, dn, object_class=None, attributes=None, controls=None):
+        return self.pipeline.add(dn, object_class, attributes, controls).result()
+
+    def modify(self, dn, changes, controls=None):
+        return self.pipeline.modify(dn, changes, controls).result()
+
+    def delete(self, dn, controls=None):
+        return self.pipeline.delete(dn, controls).result()
+
+    def compare(self, dn, attribute, value, controls=None):
+        return self.pipeline.compare(dn, attribute, value, controls).result()
+
+    def extended(self, request_name, request_value=None, controls=None):
+        return self.pipeline.extended(request_name, request_value, controls).result()
+
+def getuser(pipeline, username, base):
+    '''returns a Future of (found, user) for a user in base, see bin/getuser.py'''
+    return _then(pipeline.search(base, '(uid=%s)'%escape_filter_chars(str(username)), attributes=['*']), _single)
+
+def getuid(pipeline, uid, base):
+    '''returns a Future of (found, user) for a uid in base, see bin/getuser.py'''
+    return _then(pipeline.search(base, '(uidNumber=%s)'%escape_filter_chars(str(uid)), attributes=['*']), _single)
+
+def isuidfree(pipeline, uid, base, chunk_size=100, exists_only=False):
+    '''returns a Future of (free, matching entries) for a uid or list of them, see bin/isuidfree.py'''
+    if(not isinstance(uid, (list, tuple, set))):
+        uid=[uid]
+    uids=[int(u) for u in uid]
+
+    searches=[]
+    for i in range(0, len(uids), chunk_size):
+        chunk=uids[i:i+chunk_size]
+        search_filter='(uidNumber=%s)'%chunk[0]
+        if(len(chunk) > 1):
+            search_filter='(|%s)'%''.join('(uidNumber=%s)'%u for u in chunk)
+        if(exists_only):
+            searches.append(pipeline.search(base, search_filter, attributes=['1.1'], size_limit=1))
+        else:
+            searches.append(pipeline.search(base, search_filter, attributes=['uidNumber']))
+
+    def free(results):
+        found=False
+        responses=[]
+        for status, _, response, _ in results:
+            found=found or status or (exists_only and len(response) > 0)
+            responses.extend(response)
+        return (not found, responses)
+    return _gather(searches, free)
+
+def mkaccount(pipeline, username, uid, ou, **kw):
+    '''returns a Future of (dn, attributes) for a new user, see bin/mkaccount.py
+
+    Takes the same keyword parameters as bin/mkaccount.py's mkaccount.
+    '''
+    dn, attributes = accountattributes(username, uid, ou, **kw)
+    def added(outcome):
+        status, result, _, _ = outcome
+        if(not status):
+            raise Exception('user creation failed: %s'%result['description'])
+        return (dn, attributes)
+    return _then(pipeline.add(dn, attributes=attributes), added)
+
+def _searched(result, response):
+    status=(result['result'] == RESULT_SUCCESS and len(response) > 0)
+    return (status, result, response, None)
+
+def _succeeded(result, response):
+    return (result['result'] == RESULT_SUCCESS, result, response, None)
+
+def _compared(result, response):
+    return (result['result'] == RESULT_COMPARE_TRUE, result, response, None)
+
+def _single(outcome):
+    status, _, response, _ = outcome
+    if(status): #we think we found something
+        if(len(response)>1):
+            raise ValueError('too many responses were found (duplicate uid?)')
+        return (status, response[0])
+
+    # we did not find anything
+    return (status, None)
+
+def _then(future, function):
+    '''returns a Future of function(the result of future), without a thread'''
+    chained=Future()
+    chained.set_running_or_notify_cancel()
+    def done(finished):
+        try:
+            chained.set_result(function(finished.result()))
+        except Exception as e:
+            chained.set_exception(e)
+    future.add_done_callback(done)
+    return chained
+
+def _gather(futures, function):
+    '''returns a Future of function(the list of results of futures)'''
+    gathered=Future()
+    gathered.set_running_or_notify_cancel()
+    remaining=[len(futures)]
+    lock=Lock()
+    def done(finished):
+        with lock:
+            remaining[0]-=1
+            last=remaining[0] == 0
+        if(not last):
+            return
+        try:
+            gathered.set_result(function([future.result() for future in futures]))
+        except Exception as e:
+            gathered.set_exception(e)
+    if(not futures):
+        gathered.set_result(function([]))
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+def _fail(future, error):
+    if(not future.done()):
+        future.set_exception(error)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+'''ldaptools.pool - reusable pools of bound ldap connections
+
+connect() pays for a TCP connect, START_TLS, a bind and a schema fetch every
+time it is called.  A pool keeps a bounded number of bound SAFE_SYNC
+connections per server and set of credentials and hands them out again, so
+a long running process only pays that cost once per connection.
+
+    from ldaptools.pool import borrow
+    with borrow(args=args) as conn:
+        found, user = getuser(conn, 'jdoe', 'ou=People,dc=company,dc=com')
+'''
+
+from threading import Condition, Lock
+from contextlib import contextmanager
+from time import monotonic
+from ldaptools import connect, connparams
+
+# OID of the "Who am I?" extended operation (RFC 4532)
+WHOAMI='1.3.6.1.4.1.4203.1.11.3'
+
+class PoolTimeout(Exception):
+    '''raised when no connection becomes available in time'''
+
+class ConnectionPool:
+    '''a bounded pool of bound ldap connections for one server and identity
+
+    Connections are created lazily, up to max_size at once.  Idle connections
+    are closed after idle_timeout seconds, and a connection that has been idle
+    for longer than check_interval seconds is checked with a whoami before it
+    is handed out again.  A connection that fails the check, or that the
+    server has closed, is replaced with a freshly bound one.
+
+    Parameters:
+    max_size(int): the maximum number of connections open at once
+    idle_timeout(float): seconds an idle connection is kept before it is closed
+    check_interval(float): seconds of idleness after which a connection is checked
+    factory(callable): called with the connect keywords to open a connection
+    **kw: keywords passed to connect (server, auth_user, args, ...)
+    '''
+
+    def __init__(self, max_size=10, idle_timeout=300, check_interval=30, factory=connect, **kw):
+        if(max_size < 1):
+            raise ValueError('max_size must be at least 1')
+        connparams(**kw)
+        self.max_size=max_size
+        self.idle_timeout=idle_timeout
+        self.check_interval=check_interval
+        self.factory=factory
+        self.kw=kw
+        self.idle=[]        # list of (connection, time released), oldest first
+        self.size=0         # connections open, idle or borrowed
+        self.closed=False
+        self.cond=Condition(Lock())
+
+    def acquire(self, timeout=None):
+        '''borrow a connection from the pool
+
+        Parameters:
+        timeout(float): seconds to wait for a free connection (None waits forever)
+
+        Returns:
+        a bound ldap3 connection object
+
+        Raises:
+        PoolTimeout if no connection became available within timeout
+        Exception if the pool has been closed
+        '''
+        deadline=None if timeout == None else monotonic()+timeout
+        with self.cond:
+            while(True):
+                if(self.closed):
+                    raise Exception('pool is closed')
+                self._expire()
+                if(self.idle):
+                    conn, released = self.idle.pop()
+                    break
+                if(self.size < self.max_size):
+                    self.size+=1
+                    conn, released = None, None
+                    break
+                remaining=None if deadline == None else deadline-monotonic()
+                if(remaining != None and remaining <= 0):
+                    raise PoolTimeout('no connection available within %s seconds'%timeout)
+                self.cond.wait(remaining)
+
+        # network work happens outside of the lock
+        try:
+            if(conn != None and not self._healthy(conn, released)):
+                self._close(conn)
+                conn=None
+            if(conn == None):
+                conn=self.factory(**self.kw)
+        except Exception:
+            with self.cond:
+                self.size-=1
+                self.cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        '''return a borrowed connection to the pool
+
+        Parameters:
+        conn(object): a connection obtained from acquire
+        discard(bool): close the connection instead of keeping it
+        '''
+        if(discard or conn.closed):
+            self._close(conn)
+            with self.cond:
+                self.size-=1
+                self.cond.notify()
+            return
+
+        with self.cond:
+            closed=self.closed
+            if(closed):
+                self.size-=1
+            else:
+                self.idle.append((conn, monotonic()))
+            self.cond.notify()
+        if(closed):
+            self._close(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''borrow a connection for the duration of a with block
+
+        The connection is discarded instead of returned if the block raises
+        an ldap3 communication error, and when the pool is for several
+        servers the one it was made to is quarantined, so the next
+        connection fails over to another (see ldaptools.topology).
+        '''
+        conn=self.acquire(timeout)
+        try:
+            yield conn
+        except Exception as e:
+            if(_isconnerror(e)):
+                from ldaptools.topology import failed
+                failed(conn)
+            self.release(conn, discard=_isconnerror(e))
+            raise
+        self.release(conn)
+
+    def close(self):
+        '''close every idle connection and refuse further borrowing
+
+        Borrowed connections are closed when they are released.
+        '''
+        with self.cond:
+            self.closed=True
+            idle=self.idle
+            self.idle=[]
+            self.size-=len(idle)
+            self.cond.notify_all()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _expire(self):
+        '''close connections idle for longer than idle_timeout (lock must be held)'''
+        now=monotonic()
+        while(self.idle and now-self.idle[0][1] > self.idle_timeout):
+            conn, _ = self.idle.pop(0)
+            self.size-=1
+            self._close(conn)
+
+    def _healthy(self, conn, released):
+        '''check that a connection that has been idle is still usable'''
+        if(conn.closed):
+            return False
+        if(monotonic()-released < self.check_interval):
+            return True
+        try:
+            status, _, _, _ = conn.extended(WHOAMI)
+        except Exception:
+            return False
+        return status
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+def _isconnerror(e):
+    '''True if the exception means the connection can not be reused'''
+    from ldap3.core.exceptions import LDAPCommunicationError, LDAPSessionTerminatedByServerError
+    return isinstance(e, (LDAPCommunicationError, LDAPSessionTerminatedByServerError))
+
+_pools={}
+_poolslock=Lock()
+
+def getpool(max_size=10, idle_timeout=300, check_interval=30, **kw):
+    '''return the shared pool for a server and set of credentials
+
+    Pools are keyed by server, the credentials and every other option that
+    changes what a connection talks to (ca_certs, tls13, site, snapshot,
+    record and write), so every caller using the same identity and options
+    shares the same connections.  The pool options only apply when the pool
+    is first created.
+
+    Parameters:
+    max_size(int): the maximum number of connections open at once
+    idle_timeout(float): seconds an idle connection is kept before it is closed
+    check_interval(float): seconds of idleness after which a connection is checked
+    **kw: keywords passed to connect (server, auth_user, args, ...)
+
+    Returns:
+    a ConnectionPool object
+    '''
+    key=_poolkey(kw)
+    with _poolslock:
+        pool=_pools.get(key)
+        if(pool == None or pool.closed):
+            pool=ConnectionPool(max_size, idle_timeout, check_interval, **kw)
+            _pools[key]=pool
+    return pool
+
+def _poolkey(kw):
+    '''the connparams and options of connect keywords, args overriding them as connect does'''
+    options={name: kw.get(name, default) for name, default in (
+            ('ca_certs', None), ('tls13', False), ('site', None), ('snapshot', None), ('record', None))}
+    if('args' in kw):
+        options={name: getattr(kw['args'], name, value) for name, value in options.items()}
+    return connparams(**kw)+tuple(str(value) for value in options.values())+(bool(kw.get('write', False)),)
+
+def borrow(timeout=None, **kw):
+    '''borrow a connection from the shared pool for a with block
+
+        with borrow(server='ldap.company.com') as conn:
+            free, _ = isuidfree(conn, 12345, 'ou=People,dc=company,dc=com')
+
+    Parameters:
+    timeout(float): seconds to wait for a free connection (None waits forever)
+    **kw: keywords passed to getpool and connect
+
+    Returns:
+    a context manager yielding a bound ldap3 connection object
+    '''
+    return getpool(**kw).connection(timeout)
+
+def closeall():
+    '''close every shared pool'''
+    with _poolslock:
+        pools=list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''ldaptools.preflight - warn about filters the server can not answer from an index
+
+A search on an attribute the server does not index makes it read every
+entry under the base, which is fine once and not for every account of a
+bulk run.  preflight() checks the attributes of a filter against the
+schema (fetched by ldaptools.serverinfo) and, where the server lets us read
+them, its index definitions:
+
+    for warning in preflight(conn, '(uidNumber=1234)'):
+        print(warning, file=stderr)
+
+Index definitions are read from cn=config (OpenLDAP olcDbIndex), from the
+ldbm backends of 389 Directory Server, or from the attributeSchema entries
+of Active Directory (searchFlags).  All of these usually need an
+administrative bind; without one only the schema checks are made, unless
+the indexed attributes are passed in.
+'''
+
+from re import findall
+from ldaptools import serverinfo
+
+# attributes every server indexes, or that are not matched against entries
+ALWAYS_INDEXED=('objectclass', 'entryuuid', 'entrydn', '1.1', '*')
+
+def filterattributes(search_filter):
+    '''returns the attributes a filter matches on, lowercased, in the order they appear'''
+    attributes=[]
+    for attribute in findall(r'\(\s*!?\s*([A-Za-z][A-Za-z0-9-]*|[0-9.]+)(?:;[A-Za-z0-9-]+)*\s*(?::[^=]*)?[~<>]?=', search_filter):
+        attribute=attribute.lower()
+        if(attribute not in attributes):
+            attributes.append(attribute)
+    return attributes
+
+def indexedattributes(conn):
+    '''returns the attributes the server indexes, lowercased, or None if it will not say
+
+    Parameters:
+    conn(object): a ldap3 connection object
+
+    Returns:
+    a set of attribute names, or None if no index definitions could be read
+    '''
+    from ldap3 import BASE
+    indexed=set()
+    readable=False
+
+    # OpenLDAP: olcDbIndex: uid,uidNumber eq,pres
+    status, _, response, _ = _search(conn, 'cn=config', '(olcDbIndex=*)', ['olcDbIndex'])
+    for entry in response:
+        readable=True
+        for value in _values(entry, 'olcDbIndex'):
+            indexed.update(name.strip().lower() for name in value.split()[0].split(','))
+
+    # 389 Directory Server: cn=uid,cn=index,cn=userRoot,cn=ldbm database,cn=plugins,cn=config
+    status, _, response, _ = _search(conn, 'cn=ldbm database,cn=plugins,cn=config', '(objectClass=nsIndex)', ['cn'])
+    for entry in response:
+        readable=True
+        indexed.update(name.lower() for name in _values(entry, 'cn'))
+
+    # Active Directory: bit 1 of searchFlags is fATTINDEX
+    status, _, response, _ = _search(conn, '', '(objectClass=*)', ['schemaNamingContext'], BASE)
+    schema=[value for entry in response for value in _values(entry, 'schemaNamingContext')]
+    if(schema):
+        status, _, response, _ = _search(conn, schema[0], '(searchFlags:1.2.840.113556.1.4.803:=1)', ['lDAPDisplayName'])
+        for entry in response:
+            readable=True
+            indexed.update(name.lower() for name in _values(entry, 'lDAPDisplayName'))
+
+    return indexed if readable else None
+
+def preflight(conn, search_filter, indexed=None):
+    '''returns warnings about the attributes of a filter that will not use an index
+
+    Parameters:
+    conn(object): a ldap3 connection object
+    search_filter(string): the filter to check
+    indexed(iterable): the attributes the server indexes (default read with indexedattributes)
+
+    Returns:
+    a list of warning strings, empty if nothing was found
+    '''
+    _, schema = serverinfo(conn)
+    if(indexed == None):
+        indexed=indexedattributes(conn)
+    if(indexed != None):
+        indexed=set(name.lower() for name in indexed)
+        # an index can be defined on an attribute by any of its names
+        for name in (list(indexed) if schema != None else []):
+            indexed.update(_names(schema, name))
+
+    warnings=[]
+    for attribute in filterattributes(search_filter):
+        if(attribute in ALWAYS_INDEXED):
+            continue
+        if(schema != None and _attributetype(schema, attribute) == None):
+            warnings.append('%s is not in the server schema, the filter can never match it'%attribute)
+            continue
+        if(schema != None and _equality(schema, attribute) == None):
+            warnings.append('%s has no EQUALITY matching rule, matching it can not use an index'%attribute)
+        if(indexed != None and attribute not in indexed):
+            warnings.append('%s is not indexed, a search on it reads every entry under the base'%attribute)
+    return warnings
+
+def _search(conn, base, search_filter, attributes, search_scope=None):
+    '''search, returning no entries instead of raising when the server refuses'''
+    from ldap3 import SUBTREE
+    try:
+        return conn.search(base, search_filter, search_scope=search_scope or SUBTREE, attributes=attributes)
+    except Exception:
+        return (False, None, [], None)
+
+def _values(entry, attribute):
+    for name, value in entry.get('attributes', {}).items():
+        if(name.lower() == attribute.lower()):
+            return [str(v) for v in (value if isinstance(value, list) else [value])]
+    return []
+
+def _attributetype(schema, attribute):
+    '''the schema's AttributeTypeInfo for a name or oid, or None'''
+    info=schema.attribute_types.get(attribute)
+    if(info != None):
+        return info
+    for name, info in schema.attribute_types.items():
+        if(name.lower() == attribute or (info.oid or '').lower() == attribute):
+            return info
+    return None
+
+def _names(schema, attribute):
+    '''every name and the oid of an attribute type, lowercased'''
+    info=_attributetype(schema, attribute)
+    if(info == None):
+        return []
+    return [name.lower() for name in (info.name or [])]+[(info.oid or '').lower()]
+
+def _equality(schema, attribute):
+    '''the EQUALITY rule of an attribute type, following its superiors'''
+    seen=set()
+    info=_attributetype(schema, attribute)
+    while(info != None and info.oid not in seen):
+        seen.add(info.oid)
+        if(info.equality):
+            return info.equality
+        if(not info.superior):
+            return None
+        info=_attributetype(schema, info.superior[0].lower())
+    return None
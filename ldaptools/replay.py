@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+'''ldaptools.replay - record a session's operations and replay them faster
+
+connect(record='session.jsonl') (or --record on any script) writes every
+search, add, modify, delete, compare and extended operation run on the
+connection to a JSON lines file: when it started, its parameters, how long
+the server took, its result code and the ldaptools helper that issued it.
+Every connection of the process writes to the same file.
+
+replay() runs a recording again, normally against a snapshot (see
+ldaptools.snapshot) taken before it was made, with each recorded
+connection on a connection of its own and each operation issued at its
+recorded time divided by speed (0 runs them back to back).  It returns the
+throughput and latency per helper and operation, next to the recorded
+ones, and every operation whose result code differs from the recording:
+
+    ./bin/mkaccounts.py -s ldap.company.com --record session.jsonl --from-file new.csv
+    ./bin/replay.py --snapshot company.ldif --recording session.jsonl --speed 10
+
+The values of secret attributes (userPassword and the like) and of
+password modify requests are written as a placeholder, binds are not
+recorded at all, and the file is created readable by its owner only.
+Replayed, the placeholder is simply the password.
+
+Only synchronous strategies are recorded, as the asynchronous ones return
+before the server answers.  Paged searches are replayed with the cookies
+the replay's own server hands out.
+'''
+
+from functools import lru_cache, wraps
+from threading import Lock, Thread
+from time import perf_counter, sleep, time
+from base64 import b64encode, b64decode
+from itertools import count
+from json import dumps, loads
+from os import fchmod, fdopen, open as osopen, O_WRONLY, O_CREAT, O_TRUNC
+
+from ldaptools.metrics import OPERATIONS, _helper
+
+# attributes whose values are never written to a recording, lower case
+SECRETS=('userpassword', 'authpassword', 'unicodepwd', 'sambantpassword', 'sambalmpassword', 'krbprincipalkey')
+
+# OID of the password modify extended operation (RFC 3062)
+PASSWORD_MODIFY='1.3.6.1.4.1.4203.1.11.1'
+
+# what a secret value is recorded as
+REDACTED='(redacted)'
+
+class Recorder:
+    '''appends the operations of any number of connections to one file
+
+    Parameters:
+    path(string): the JSON lines file to write, replaced if it exists
+    '''
+
+    def __init__(self, path):
+        self.path=path
+        self.lock=Lock()
+        self.ids=count()
+        self.started=perf_counter()
+        # operations carry directory data, keep them from other users
+        descriptor=osopen(path, O_WRONLY|O_CREAT|O_TRUNC, 0o600)
+        fchmod(descriptor, 0o600)
+        self.handle=fdopen(descriptor, 'w')
+        self._write({'recording': 1, 'time': time()})
+
+    def attach(self, conn):
+        '''record every operation run on a connection, returns the connection'''
+        from inspect import signature
+        if(not conn.strategy.sync):
+            return conn
+        connection=next(self.ids)
+        for operation in OPERATIONS:
+            method=getattr(conn, operation)
+            parameters=signature(method)
+            def recorded(*args, _method=method, _operation=operation, _parameters=parameters, **kw):
+                at=perf_counter()
+                value=None
+                try:
+                    value=_method(*args, **kw)
+                    return value
+                finally:
+                    seconds=perf_counter()-at
+                    line={
+                        'conn': connection,
+                        'at': at-self.started,
+                        'op': _operation,
+                        'helper': _helper.get(),
+                        'params': _encode(_redact(_operation, dict(_parameters.bind(*args, **kw).arguments))),
+                        'seconds': seconds,
+                        'result': _resultcode(value),
+                        }
+                    if(_operation == 'search' and isinstance(value, tuple)):
+                        line['entries']=len(value[2] or [])
+                    self._write(line)
+            setattr(conn, operation, wraps(method)(recorded))
+        return conn
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
+
+    def _write(self, line):
+        with self.lock:
+            self.handle.write(dumps(line)+'\n')
+            self.handle.flush()
+
+@lru_cache(maxsize=None)
+def recorder(path):
+    '''returns the Recorder for a file, one per file and process'''
+    return Recorder(path)
+
+def readrecording(path):
+    '''returns the recorded operations of a file, in the order they started'''
+    operations=[]
+    with open(path) as handle:
+        for line in handle:
+            if(line.strip()):
+                operation=loads(line)
+                if('op' in operation):
+                    operations.append(operation)
+    operations.sort(key=lambda operation: operation['at'])
+    return operations
+
+def replay(operations, connection, speed=1.0):
+    '''run recorded operations again, keeping their connections and pacing
+
+    Parameters:
+    operations(list): the operations from readrecording
+    connection(callable): returns a new connection, called once per recorded one
+    speed(float): how many times faster than recorded to issue them, 0 for
+        as fast as they complete
+
+    Returns:
+    a dict with the operations run, the seconds they took and recorded,
+    operations per second, how far behind schedule the issuing fell (p99),
+    per helper/operation counts and p50/p99 latencies replayed and recorded,
+    and the mismatches (result codes that differ from the recording)
+    '''
+    connections={}
+    for operation in operations:
+        connections.setdefault(operation['conn'], []).append(operation)
+    conns={recorded: connection() for recorded in connections}
+
+    lock=Lock()
+    timings={}      # helper/operation -> ([replayed seconds], [recorded seconds])
+    behind=[]
+    mismatches=[]
+    errors=[]
+
+    def run(recorded, planned):
+        conn=conns[recorded]
+        cookies={}
+        for operation in planned:
+            if(speed):
+                wait=started+operation['at']/speed-perf_counter()
+                if(wait > 0):
+                    sleep(wait)
+            late=max(0.0, perf_counter()-started-(operation['at']/speed if speed else 0))
+            params=_decode(operation['params'])
+            key=None
+            if(operation['op'] == 'search' and 'paged_cookie' in params):
+                key=(params.get('search_base'), params.get('search_filter'))
+                params['paged_cookie']=cookies.pop(key, None) if params['paged_cookie'] else None
+            before=perf_counter()
+            try:
+                value=getattr(conn, operation['op'])(**params)
+            except Exception as e:
+                value=None
+                with lock:
+                    errors.append({'at': operation['at'], 'op': operation['op'], 'error': str(e)})
+            seconds=perf_counter()-before
+            if(key != None and isinstance(value, tuple)):
+                cookies[key]=_cookie(value[1])
+            result=_resultcode(value)
+            with lock:
+                label='%s/%s'%(operation['helper'] or '-', operation['op'])
+                replayed, original = timings.setdefault(label, ([], []))
+                replayed.append(seconds)
+                original.append(operation['seconds'])
+                behind.append(late)
+                if(result != operation['result']):
+                    mismatches.append({'at': operation['at'], 'op': operation['op'], 'helper': operation['helper'],
+                            'params': operation['params'], 'recorded': operation['result'], 'replayed': result})
+
+    threads=[Thread(target=run, args=(recorded, planned), daemon=True) for recorded, planned in connections.items()]
+    started=perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds=perf_counter()-started
+    for conn in conns.values():
+        conn.unbind()
+
+    recorded=max((operation['at']+operation['seconds'] for operation in operations), default=0.0)
+    return {
+        'operations': len(operations),
+        'connections': len(connections),
+        'speed': speed,
+        'seconds': seconds,
+        'recorded_seconds': recorded,
+        'ops_per_sec': len(operations)/seconds if seconds else 0.0,
+        'recorded_ops_per_sec': len(operations)/recorded if recorded else 0.0,
+        'behind_p99_ms': _percentile(behind, 0.99)*1000,
+        'by_operation': {label: {
+                'count': len(replayed),
+                'p50_ms': _percentile(replayed, 0.50)*1000,
+                'p99_ms': _percentile(replayed, 0.99)*1000,
+                'recorded_p50_ms': _percentile(original, 0.50)*1000,
+                'recorded_p99_ms': _percentile(original, 0.99)*1000,
+                } for label, (replayed, original) in sorted(timings.items())},
+        'mismatches': mismatches,
+        'errors': errors,
+        }
+
+def _resultcode(value):
+    '''the result code of a SAFE_SYNC style return value, None if it has none'''
+    if(isinstance(value, tuple) and len(value) == 4 and isinstance(value[1], dict)):
+        return value[1].get('result')
+    return None
+
+def _redact(operation, params):
+    '''params with the values of secret attributes and password changes replaced by REDACTED'''
+    if(operation == 'add' and isinstance(params.get('attributes'), dict)):
+        params['attributes']={attribute: REDACTED if attribute.lower() in SECRETS else values
+                for attribute, values in params['attributes'].items()}
+    elif(operation == 'modify' and isinstance(params.get('changes'), dict)):
+        params['changes']={attribute: _redactchange(change) if attribute.lower() in SECRETS else change
+                for attribute, change in params['changes'].items()}
+    elif(operation == 'extended' and params.get('request_name') == PASSWORD_MODIFY and params.get('request_value') != None):
+        params['request_value']=REDACTED
+    return params
+
+def _redactchange(change):
+    '''a modify change, (operation, values) or a list of them, with its values redacted'''
+    if(change and isinstance(change[0], (list, tuple))):
+        return [_redactchange(c) for c in change]
+    return (change[0], [REDACTED] if len(change) > 1 and change[1] else [])
+
+def _cookie(result):
+    from ldaptools import PAGED_RESULTS
+    try:
+        return result['controls'][PAGED_RESULTS]['value']['cookie'] or None
+    except (KeyError, TypeError):
+        return None
+
+def _encode(value):
+    '''parameters to JSON types, bytes as {'base64': ...}'''
+    if(isinstance(value, (bytes, bytearray))):
+        return {'base64': b64encode(bytes(value)).decode('ascii')}
+    if(isinstance(value, dict)):
+        return {str(k): _encode(v) for k, v in value.items()}
+    if(isinstance(value, (list, tuple, set))):
+        return [_encode(v) for v in value]
+    if(value == None or isinstance(value, (str, int, float, bool))):
+        return value
+    return str(value)
+
+def _decode(value):
+    if(isinstance(value, dict)):
+        if(list(value) == ['base64']):
+            return b64decode(value['base64'])
+        return {k: _decode(v) for k, v in value.items()}
+    if(isinstance(value, list)):
+        return [_decode(v) for v in value]
+    return value
+
+def _percentile(values, fraction):
+    if(not values):
+        return 0.0
+    values=sorted(values)
+    return values[min(len(values)-1, int(len(values)*fraction))]
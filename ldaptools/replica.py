@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+'''ldaptools.replica - a local, continuously updated copy of the posixAccounts
+
+A Replica loads every posixAccount under a base with one paged search and
+indexes the entries by dn, uid, uidNumber and gidNumber.  It then follows
+the directory, either with a persistent search (watch, on an ASYNC_STREAM
+connection to a server that supports it) or by polling modifyTimestamp
+(follow), which also periodically compares the dns to notice deletions.
+save() writes a snapshot that restore() loads on the next start, so only the
+changes since the snapshot have to be fetched.
+
+A replica answers the same lookup() calls as ldaptools.cache.UserCache, so
+it is passed to the helpers in bin/ as their cache:
+
+    replica = Replica('ou=People,dc=company,dc=com')
+    replica.load(conn)
+    stop = replica.follow(conn, interval=30)
+    found, user = getuser(conn, 'jdoe', replica.base, cache=replica)
+    free, _ = isuidfree(conn, 1234, replica.base, cache=replica)
+    uid = genuid(conn, 1000, 8500, replica.base, 10, replica=replica)
+
+Answers are as fresh as the last change the replica saw.  Keys passed to
+invalidate() (mkaccount does this) are looked up in the directory until
+the change arrives.
+'''
+
+from datetime import datetime, timezone
+from threading import RLock, Thread, Event
+from json import dumps, loads
+from os import replace
+from ldaptools import iter_entries
+
+# the persistent search request control (draft-ietf-ldapext-psearch)
+PERSISTENT_SEARCH='2.16.840.1.113730.3.4.3'
+
+# the attributes that are indexed, besides dn
+INDEXED=('uid', 'uidNumber', 'gidNumber')
+
+class Replica:
+    '''an in-memory copy of the entries under a base, indexed for lookups
+
+    Parameters:
+    base(string): the basedn to copy
+    search_filter(string): the entries to copy
+    attributes(list): the attributes to keep (the indexed ones are always kept)
+    '''
+
+    def __init__(self, base, search_filter='(objectClass=posixAccount)', attributes=['*']):
+        self.base=base
+        self.search_filter=search_filter
+        self.attributes=list(attributes)
+        if('*' not in self.attributes):
+            self.attributes.extend(a for a in INDEXED if a not in self.attributes)
+        self.lock=RLock()
+        self.entries={}                             # folded dn -> entry
+        self.index={a: {} for a in INDEXED}         # attribute -> folded value -> set of folded dns
+        self.stale=set()                            # (attribute, folded value) to ask the directory about
+        self.highwater=None                         # newest modifyTimestamp seen, as YYYYmmddHHMMSSZ
+        self.loaded=False
+        self.counters={'hits': 0, 'misses': 0, 'changes': 0, 'deletions': 0}
+
+    def load(self, conn, page_size=500):
+        '''replace the copy with every matching entry in the directory
+
+        Parameters:
+        conn(object): a ldap3 connection object
+        page_size(int): the number of entries to request per page
+
+        Returns:
+        the number of entries loaded
+        '''
+        started=_stamp(datetime.now(timezone.utc))
+        entries={}
+        index={a: {} for a in INDEXED}
+        highwater=None
+        for entry in iter_entries(conn, self.base, self.search_filter, self.attributes+['modifyTimestamp'], page_size):
+            entry=_compact(entry)
+            dn=_fold('dn', entry['dn'])
+            entries[dn]=entry
+            _index(index, dn, entry)
+            stamp=_stamp(entry['attributes'].get('modifyTimestamp'))
+            if(stamp != None and (highwater == None or stamp > highwater)):
+                highwater=stamp
+        with self.lock:
+            self.entries=entries
+            self.index=index
+            self.stale.clear()
+            self.highwater=highwater or started
+            self.loaded=True
+        return len(entries)
+
+    def poll(self, conn, reconcile=False, page_size=500):
+        '''apply the entries modified since the newest change already seen
+
+        Deleted entries do not show up in a modifyTimestamp search, so with
+        reconcile the dns of every matching entry are also fetched (no
+        attributes) and entries that are gone are dropped.
+
+        Parameters:
+        conn(object): a ldap3 connection object
+        reconcile(bool): also drop entries that no longer exist
+        page_size(int): the number of entries to request per page
+
+        Returns:
+        the number of entries added, changed or dropped
+        '''
+        if(not self.loaded):
+            return self.load(conn, page_size)
+
+        changed=0
+        search_filter='(&%s(modifyTimestamp>=%s))'%(_wrap(self.search_filter), self.highwater)
+        for entry in iter_entries(conn, self.base, search_filter, self.attributes+['modifyTimestamp'], page_size):
+            self.apply(entry)
+            changed+=1
+
+        if(reconcile):
+            present=set(_fold('dn', entry['dn']) for entry in iter_entries(conn, self.base, self.search_filter, ['1.1'], page_size))
+            with self.lock:
+                gone=[dn for dn in self.entries if dn not in present]
+            for dn in gone:
+                self.remove(dn)
+            changed+=len(gone)
+        return changed
+
+    def follow(self, conn, interval=30, reconcile_every=10, page_size=500):
+        '''poll the directory from a daemon thread every interval seconds
+
+        Parameters:
+        conn(object): a ldap3 connection object for the thread to use
+        interval(float): seconds between polls
+        reconcile_every(int): look for deleted entries on every nth poll
+        page_size(int): the number of entries to request per page
+
+        Returns:
+        a threading.Event, set it to stop following
+        '''
+        stop=Event()
+
+        def run():
+            polls=0
+            while(not stop.wait(interval)):
+                polls+=1
+                try:
+                    self.poll(conn, polls%reconcile_every == 0, page_size)
+                except Exception:
+                    # the next poll starts from the same highwater mark
+                    continue
+
+        Thread(target=run, daemon=True).start()
+        return stop
+
+    def watch(self, conn):
+        '''apply changes as the server announces them with a persistent search
+
+        The connection must use the ASYNC_STREAM strategy, and is used for
+        nothing else.  Load (or restore) the replica first; changes made
+        before the persistent search started are picked up by poll().
+
+        Parameters:
+        conn(object): a ldap3 connection object using ASYNC_STREAM
+
+        Returns:
+        the ldap3 PersistentSearch object (call stop() to end it)
+
+        Raises:
+        Exception if the server does not support persistent search
+        '''
+        if(conn.server.info != None and PERSISTENT_SEARCH not in [c[0] for c in conn.server.info.supported_controls]):
+            raise Exception('%s does not support persistent search'%conn.server.host)
+
+        def changed(change):
+            if(change.get('type') != 'searchResEntry'):
+                return
+            kind=change.get('changeType')
+            if(kind == 'delete'):
+                self.remove(change['dn'])
+                return
+            if(kind == 'modify dn' and change.get('previousDN') != None):
+                self.remove(str(change['previousDN']))
+            self.apply(change)
+
+        return conn.extend.standard.persistent_search(self.base, self.search_filter,
+                attributes=self.attributes+['modifyTimestamp'],
+                streaming=False,
+                callback=changed)
+
+    def apply(self, entry):
+        '''add or replace an entry as returned by a search'''
+        entry=_compact(entry)
+        dn=_fold('dn', entry['dn'])
+        stamp=_stamp(entry['attributes'].get('modifyTimestamp'))
+        with self.lock:
+            self._drop(dn)
+            self.entries[dn]=entry
+            _index(self.index, dn, entry)
+            self.stale.discard(('dn', dn))
+            for attribute, value in _keys(entry):
+                self.stale.discard((attribute, value))
+            if(stamp != None and (self.highwater == None or stamp > self.highwater)):
+                self.highwater=stamp
+            self.counters['changes']+=1
+
+    def remove(self, dn):
+        '''drop an entry that was deleted or renamed in the directory'''
+        with self.lock:
+            if(self._drop(_fold('dn', dn))):
+                self.counters['deletions']+=1
+
+    def find(self, attribute, value):
+        '''returns every entry whose dn, uid, uidNumber or gidNumber matches value'''
+        key=_fold(attribute, value)
+        with self.lock:
+            if(attribute == 'dn'):
+                return [self.entries[key]] if key in self.entries else []
+            return [self.entries[dn] for dn in self.index[attribute].get(key, ())]
+
+    def lookup(self, attribute, value):
+        '''look a user up by uid, uidNumber or dn, like UserCache.lookup
+
+        Returns two values in a tuple:
+        True if the replica knows the answer, False if the directory must be asked
+        the entry, or None if no entry matches
+
+        Raises:
+        ValueError if several entries match
+        '''
+        known, found = self.lookupall(attribute, value)
+        if(len(found) > 1):
+            raise ValueError('too many responses were found (duplicate uid?)')
+        return (known, found[0] if found else None)
+
+    def lookupall(self, attribute, value):
+        '''look up every entry with a uid, uidNumber or dn, duplicates included
+
+        isuidfree uses this, so a uidNumber several users share is reported
+        as taken with all of them, as the directory would answer.
+
+        Returns two values in a tuple:
+        True if the replica knows the answer, False if the directory must be asked
+        a list of the matching entries, empty if none match or the answer is not known
+        '''
+        with self.lock:
+            if(not self.loaded or (attribute, _fold(attribute, value)) in self.stale):
+                self.counters['misses']+=1
+                return (False, [])
+            found=self.find(attribute, value)
+            self.counters['hits']+=1
+        return (True, found)
+
+    def put(self, entry):
+        '''take an entry a helper fetched from the directory'''
+        self.apply(entry)
+
+    def putmissing(self, attribute, value):
+        '''take a "not found" answer a helper got from the directory'''
+        key=_fold(attribute, value)
+        with self.lock:
+            self.stale.discard((attribute, key))
+            if(attribute == 'dn'):
+                self._drop(key)
+
+    def invalidate(self, uid=None, uidNumber=None, dn=None):
+        '''ask the directory about these keys until the change reaches the replica'''
+        with self.lock:
+            for attribute, value in (('uid', uid), ('uidNumber', uidNumber), ('dn', dn)):
+                if(value != None):
+                    self.stale.add((attribute, _fold(attribute, value)))
+
+    def useduids(self, uidmin, uidmax):
+        '''returns a map of the uids in use, like bin/genuid.useduids'''
+        used=bytearray(max(uidmax-uidmin, 0))
+        with self.lock:
+            for uid in self.index['uidNumber']:
+                if(uidmin <= uid < uidmax):
+                    used[uid-uidmin]=1
+            for attribute, uid in self.stale:
+                if(attribute == 'uidNumber' and uidmin <= uid < uidmax):
+                    used[uid-uidmin]=1
+        return used
+
+    def save(self, filename):
+        '''write a snapshot of the replica to a file, replacing it atomically'''
+        with self.lock:
+            snapshot={
+                'base': self.base,
+                'filter': self.search_filter,
+                'highwater': self.highwater,
+                'entries': list(self.entries.values()),
+                }
+            data=dumps(snapshot, default=str)
+        with open(filename+'.tmp', 'w') as handle:
+            handle.write(data)
+        replace(filename+'.tmp', filename)
+
+    def restore(self, filename):
+        '''load a snapshot written by save()
+
+        Follow up with poll(conn, reconcile=True) to catch up with the
+        changes and deletions made since the snapshot.
+
+        Raises:
+        ValueError if the snapshot is of a different base or filter
+        '''
+        with open(filename) as handle:
+            snapshot=loads(handle.read())
+        if(snapshot['base'] != self.base or snapshot['filter'] != self.search_filter):
+            raise ValueError('%s is a snapshot of %s %s'%(filename, snapshot['base'], snapshot['filter']))
+        entries={}
+        index={a: {} for a in INDEXED}
+        for entry in snapshot['entries']:
+            dn=_fold('dn', entry['dn'])
+            entries[dn]=entry
+            _index(index, dn, entry)
+        with self.lock:
+            self.entries=entries
+            self.index=index
+            self.stale.clear()
+            self.highwater=snapshot['highwater']
+            self.loaded=True
+        return len(entries)
+
+    def stats(self):
+        '''returns the hit, miss and size counters as a dict'''
+        with self.lock:
+            stats=dict(self.counters)
+            stats['size']=len(self.entries)
+            stats['stale']=len(self.stale)
+            stats['highwater']=self.highwater
+        return stats
+
+    def _drop(self, dn):
+        '''remove an entry and its index keys (lock must be held)'''
+        entry=self.entries.pop(dn, None)
+        if(entry == None):
+            return False
+        for attribute, value in _keys(entry):
+            dns=self.index[attribute].get(value)
+            if(dns != None):
+                dns.discard(dn)
+                if(not dns):
+                    del self.index[attribute][value]
+        return True
+
+def _compact(entry):
+    '''keep only the dn and the decoded attributes of a search result entry'''
+    return {'dn': entry['dn'], 'attributes': dict(entry['attributes']), 'type': 'searchResEntry'}
+
+def _index(index, dn, entry):
+    for attribute, value in _keys(entry):
+        index[attribute].setdefault(value, set()).add(dn)
+
+def _keys(entry):
+    '''the (attribute, folded value) pairs an entry is indexed under'''
+    keys=[]
+    for attribute in INDEXED:
+        value=entry['attributes'].get(attribute)
+        for v in (value if isinstance(value, list) else [value]):
+            if(v == None):
+                continue
+            try:
+                keys.append((attribute, _fold(attribute, v)))
+            except ValueError:
+                continue
+    return keys
+
+def _fold(attribute, value):
+    '''fold a value the way the directory matches it'''
+    if(attribute in ('uidNumber', 'gidNumber')):
+        return int(value)
+    return str(value).lower()
+
+def _stamp(value):
+    '''a modifyTimestamp (string or datetime) as a YYYYmmddHHMMSSZ string'''
+    if(isinstance(value, list)):
+        value=value[0] if value else None
+    if(value == None):
+        return None
+    if(isinstance(value, datetime)):
+        return value.astimezone(timezone.utc).strftime('%Y%m%d%H%M%SZ')
+    return str(value)[:14]+'Z'
+
+def _wrap(search_filter):
+    return search_filter if search_filter.startswith('(') else '(%s)'%search_filter
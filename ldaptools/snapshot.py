@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+'''ldaptools.snapshot - an offline directory loaded from an export
+
+connect(snapshot='people.ldif') (or --snapshot on any script) returns a
+connection to an in-memory copy of the entries in a file written by
+bin/export.py, as LDIF or JSON lines, instead of connecting to a server.
+Scripts run against it unchanged, so a provisioning run can be tried at
+full size without touching the directory:
+
+    ./bin/export.py -s ldap.company.com --base dc=company,dc=com > company.ldif
+    ./bin/mkaccounts.py --snapshot company.ldif --from-file new.csv
+
+The copy lives on ldap3's MOCK_SYNC strategy.  Every connect() with the
+same file shares it, so changes made on one connection are seen by the
+others until the process exits, and nothing is ever written back.  The
+mock reads every entry to answer a search, so uid and uidNumber are
+indexed: a filter that an equality on them narrows down (alone, or/and-ed
+together, or and-ed with anything else) only looks at the entries the
+index gives.  Connections bind anonymously and no access controls apply.
+'''
+
+from functools import lru_cache
+from threading import RLock
+from pathlib import Path
+from json import loads
+from re import sub
+
+# the attributes searched on often enough to index
+INDEXED=('uid', 'uidNumber')
+
+@lru_cache(maxsize=None)
+def snapshotserver(snapshot, indexed=INDEXED):
+    '''load a snapshot into a mock server, once per file and process
+
+    Parameters:
+    snapshot(string): the path of an LDIF or JSON lines export (see bin/export.py)
+    indexed(tuple): the attributes to index for equality searches
+
+    Returns:
+    a ldap3 Server object holding the entries (connect to it with mockconnection)
+    '''
+    from ldap3 import Server, Connection, MOCK_SYNC, NONE
+    from ldap3.protocol.rfc4512 import DsaInfo
+    from ldap3.protocol.schemas.slapd24 import slapd_2_4_dsa_info
+
+    # no schema, like connect() before serverinfo() is called, but the
+    # rootDSE lists the extended operations the mock can answer (whoami)
+    server=Server(sub(r'[^A-Za-z0-9.-]', '_', 'snapshot-%s'%Path(snapshot).name), get_info=NONE)
+    server.attach_dsa_info(DsaInfo.from_json(slapd_2_4_dsa_info))
+    conn=Connection(server, client_strategy=MOCK_SYNC)
+    for dn, attributes in readsnapshot(snapshot):
+        conn.strategy.add_entry(dn, attributes, validate=False)
+    server.index=Index(indexed)
+    for dn, entry in server.dit.items():
+        server.index.add(dn, entry)
+    return server
+
+def readsnapshot(snapshot):
+    '''yield the (dn, attributes) of every entry in an LDIF or JSON lines export'''
+    with open(snapshot, 'rb') as handle:
+        first=handle.read(1)
+        while(first.isspace()):
+            first=handle.read(1)
+        handle.seek(0)
+        if(first == b'{'):
+            for line in handle:
+                if(line.strip()):
+                    entry=loads(line)
+                    yield (entry['dn'], entry['attributes'])
+            return
+        from bin.ldifload import readldif
+        for record in readldif(handle):
+            if(record['changetype'] != 'add'):
+                raise ValueError('record %s (%s) is a %s, a snapshot only holds entries'%(record['number'], record['dn'], record['changetype']))
+            yield (record['dn'], record['attributes'])
+
+def mockconnection(server, client_strategy=None):
+    '''returns a bound connection to a mock server, indexed if it has an Index
+
+    Parameters:
+    server(object): a ldap3 Server from snapshotserver (or benchmarks/mockdir.py)
+    client_strategy: SAFE_SYNC (default) or MOCK_SYNC for a synchronous
+        connection, ASYNC or MOCK_ASYNC for an asynchronous one
+
+    MOCK_SYNC connections are switched to return SAFE_SYNC style
+    (status, result, response, request) tuples, like connect() does.
+    '''
+    from ldap3 import Connection, MOCK_SYNC, MOCK_ASYNC, ASYNC
+    client_strategy=MOCK_ASYNC if client_strategy in (ASYNC, MOCK_ASYNC) else MOCK_SYNC
+    conn=Connection(server, client_strategy=client_strategy, collect_usage=True)
+    conn.bind()
+    if(client_strategy == MOCK_SYNC):
+        conn.strategy.thread_safe=True
+    index=getattr(server, 'index', None)
+    if(index != None):
+        index.attach(conn)
+    atomic(conn, server)
+    return conn
+
+def atomic(conn, server):
+    '''apply each operation on a mock connection atomically, like a real server
+
+    ldap3's mock modify edits the shared entries in place without a lock,
+    so two threads modifying one entry can interleave, and a modify that
+    fails part way keeps the changes made before and after the failure.
+    The operations of every connection to server are serialized on one
+    lock, and a failed modify puts the entry back as it was.
+    '''
+    from ldap3.operation.modify import modify_request_to_dict
+    from ldap3.utils.dn import safe_dn
+    lock=vars(server).setdefault('operation_lock', RLock())
+    for name in ('mock_add', 'mock_delete', 'mock_modify_dn', 'mock_compare', 'mock_search'):
+        method=getattr(conn.strategy, name)
+        def locked(*args, _method=method, **kw):
+            with lock:
+                return _method(*args, **kw)
+        setattr(conn.strategy, name, locked)
+
+    modify=conn.strategy.mock_modify
+    def modified(request_message, controls):
+        with lock:
+            dn=safe_dn(modify_request_to_dict(request_message)['entry'])
+            entry=server.dit.get(dn)
+            saved=None if entry == None else {k: list(v) for k, v in entry.items()}
+            result=modify(request_message, controls)
+            if(result['resultCode'] and saved != None):
+                entry=server.dit[dn]
+                entry.clear()
+                entry.update(saved)
+            return result
+    conn.strategy.mock_modify=modified
+
+class Index:
+    '''equality indexes over the entries of a mock server
+
+    Values are only ever added.  A dn found through the index is checked
+    against the whole filter before it is returned, so values that have
+    since been changed or deleted cost a lookup and nothing else.
+
+    Parameters:
+    attributes(tuple): the attributes to index
+    '''
+
+    def __init__(self, attributes):
+        self.values={attribute.lower(): {} for attribute in attributes}
+
+    def add(self, dn, entry):
+        '''index the values an entry holds now'''
+        for attribute, values in entry.items():
+            index=self.values.get(attribute.lower())
+            if(index != None):
+                for value in values:
+                    index.setdefault(_fold(value), set()).add(dn)
+
+    def candidates(self, node):
+        '''the dns that can match a parsed filter node, or None if the index can not tell'''
+        from ldap3.operation.search import ROOT, AND, OR, MATCH_EQUAL
+        if(node.tag == ROOT):
+            return self.candidates(node.elements[0])
+        if(node.tag == MATCH_EQUAL):
+            index=self.values.get(node.assertion['attr'].lower())
+            value=node.assertion['value']
+            if(index == None or b'\\' in _raw(value)):
+                return None
+            return index.get(_fold(value), set())
+        if(node.tag == OR):
+            found=set()
+            for element in node.elements:
+                dns=self.candidates(element)
+                if(dns == None):
+                    return None
+                found|=dns
+            return found
+        if(node.tag == AND):
+            found=None
+            for element in node.elements:
+                dns=self.candidates(element)
+                if(dns != None):
+                    found=set(dns) if found == None else found & dns
+            return found
+        return None
+
+    def attach(self, conn):
+        '''answer a mock connection's searches from the index, and keep it up to date'''
+        from ldap3.operation.add import add_request_to_dict
+        from ldap3.operation.modify import modify_request_to_dict
+        from ldap3.operation.modifyDn import modify_dn_request_to_dict
+        from ldap3.utils.dn import safe_dn, to_dn
+        strategy=conn.strategy
+        dit=conn.server.dit
+
+        def renamed(request):
+            superior=request['newSuperior'] or ','.join(to_dn(request['entry'])[1:])
+            return '%s,%s'%(request['newRdn'], superior)
+
+        for name, dn in (
+                ('mock_add', lambda message: add_request_to_dict(message)['entry']),
+                ('mock_modify', lambda message: modify_request_to_dict(message)['entry']),
+                ('mock_modify_dn', lambda message: renamed(modify_dn_request_to_dict(message)))):
+            method=getattr(strategy, name)
+            def indexed(request_message, controls, _method=method, _dn=dn):
+                result=_method(request_message, controls)
+                if(result['resultCode'] == 0):
+                    changed=safe_dn(_dn(request_message))
+                    if(changed in dit):
+                        self.add(changed, dit[changed])
+                return result
+            setattr(strategy, name, indexed)
+
+        search=strategy._execute_search
+        def execute(request):
+            found=_search(strategy, request, self)
+            return search(request) if found == None else found
+        strategy._execute_search=execute
+
+def _search(strategy, request, index):
+    '''ldap3's mock _execute_search over the candidates from index, None if it has none'''
+    from ldap3 import ALL_ATTRIBUTES
+    from ldap3.core.results import RESULT_SUCCESS, RESULT_SIZE_LIMIT_EXCEEDED
+    from ldap3.operation.search import parse_filter
+    from ldap3.utils.dn import safe_dn
+    server=strategy.connection.server
+    base=safe_dn(request['base'])
+    if(request['scope'] not in (1, 2) or base not in server.dit):
+        return None
+    filter_root=parse_filter(request['filter'], server.schema,
+            auto_escape=True,
+            auto_encode=False,
+            validator=server.custom_validator,
+            check_names=strategy.connection.check_names)
+    dns=index.candidates(filter_root)
+    if(dns == None):
+        return None
+
+    suffix=','+base.lower()
+    candidates=[]
+    for dn in sorted(dns):
+        if(dn not in server.dit):
+            continue
+        # a subtree search includes the base entry itself
+        if(not dn.lower().endswith(suffix) and not (request['scope'] == 2 and dn.lower() == base.lower())):
+            continue
+        # single level keeps the children of base only
+        if(request['scope'] == 1 and ',' in dn[:-len(suffix)]):
+            continue
+        candidates.append(dn)
+    matched=strategy.evaluate_filter_node(filter_root, candidates) if candidates else set()
+
+    if('+' in request['attributes']):
+        request['attributes'].extend(strategy.operational_attributes)
+        request['attributes'].remove('+')
+    attributes=[attribute.lower() for attribute in request['attributes']]
+    result={'resultCode': RESULT_SUCCESS, 'matchedDN': '', 'diagnosticMessage': '', 'referral': None}
+    if(strategy.connection.raise_exceptions and 0 < request['sizeLimit'] < len(matched)):
+        return ([], dict(result, resultCode=RESULT_SIZE_LIMIT_EXCEEDED, diagnosticMessage='size limit exceeded'))
+
+    responses=[]
+    operational=[name for name in strategy.operational_attributes if name.lower() not in attributes]
+    for dn in sorted(matched):
+        entry=server.dit[dn]
+        responses.append({
+            'object': dn,
+            'attributes': [{'type': attribute, 'vals': [] if request['typesOnly'] else entry[attribute]}
+                for attribute in entry
+                if (attribute.lower() in attributes or ALL_ATTRIBUTES in attributes) and attribute not in operational],
+            })
+    if(request['sizeLimit'] > 0):
+        responses=responses[:request['sizeLimit']]
+    return (responses, result)
+
+def _raw(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+def _fold(value):
+    '''fold a value the way the mock compares them, numbers by their value'''
+    value=_raw(value).decode('utf-8', 'replace').strip().lower()
+    return str(int(value)) if value.isdigit() else value
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''ldaptools.throttle - adapt the writes in flight to what the servers can take
+
+A Throttle caps the adds, modifies, deletes and renames in flight on every
+connection it is attached to (connect(throttle=...), or attach()), and
+moves that cap the way TCP moves its congestion window (AIMD): up by one
+each time a cap's worth of writes succeed quickly, and halved when a write
+comes back busy (51) or unavailable (52), takes longer than the target
+latency, or a LagProbe says the consumers have fallen too far behind.
+Writes answered busy or unavailable are retried after a backoff.
+
+    throttle = Throttle(maximum=32, target=0.5, lag=LagProbe(['ldap1', 'ldap2', 'ldap3']).start(), max_lag=30)
+    with ConnectionPool(max_size=32, write=True, args=args, throttle=throttle) as pool:
+        mkaccounts(pool, records, ou, workers=32)
+    print(throttle.stats())     # limit, in flight, writes/s, latency, lag
+
+Only a cut caused by writes sent after the previous cut counts, so one
+slow spell halves the cap once rather than once per write in flight.
+
+A LagProbe reads the contextCSN of a suffix on every server in the
+background.  For each serverID the newest CSN any server holds is the
+reference, and a server's lag is how far its own CSN for that serverID is
+behind it, so the probe works the same with one provider or several.
+contextCSN is OpenLDAP's; on other servers the probe reports no lag.
+'''
+
+from threading import Condition, Event, Lock, Thread
+from collections import deque
+from datetime import datetime, timezone
+from functools import wraps
+from random import random
+from time import monotonic, sleep
+
+# the result codes that mean the server wants less load
+RESULT_BUSY=51
+RESULT_UNAVAILABLE=52
+OVERLOADED=(RESULT_BUSY, RESULT_UNAVAILABLE)
+
+# the connection methods that write
+WRITES=('add', 'modify', 'delete', 'modify_dn')
+
+class Throttle:
+    '''an AIMD limit on the writes in flight, shared by any number of connections
+
+    Parameters:
+    initial(int): the limit to start at
+    minimum(int): the limit never goes below this
+    maximum(int): the limit never goes above this (no more than the threads writing)
+    target(float): seconds a write may take before it counts as overload, None to ignore latency
+    lag(object): a LagProbe, or anything with a lag attribute in seconds (None if unknown)
+    max_lag(float): seconds of replication lag that count as overload
+    backoff(float): what the limit is multiplied by on overload
+    retries(int): times a busy or unavailable write is retried
+    window(float): seconds the reported rate is averaged over
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=64, target=None, lag=None, max_lag=None, backoff=0.5, retries=5, window=10):
+        self.minimum=minimum
+        self.maximum=maximum
+        self.limit=float(max(minimum, min(initial, maximum)))
+        self.target=target
+        self.lag=lag
+        self.max_lag=max_lag
+        self.backoff=backoff
+        self.retries=retries
+        self.window=window
+        self.condition=Condition()
+        self.inflight=0
+        self.cut=monotonic()    # when the limit was last cut
+        self.latency=None       # moving average of the write latency, seconds
+        self.done=deque()       # when each recent write finished
+        self.started=monotonic()
+        self.counts={'writes': 0, 'overloaded': 0, 'retries': 0, 'cuts': 0}
+
+    def attach(self, conn):
+        '''throttle the writes of a connection, returns the connection'''
+        for operation in WRITES:
+            method=getattr(conn, operation)
+            def throttled(*args, _method=method, **kw):
+                return self.call(_method, *args, **kw)
+            setattr(conn, operation, wraps(method)(throttled))
+        return conn
+
+    def call(self, function, *args, **kw):
+        '''run a write once the limit allows, retrying it while the server is busy
+
+        Returns:
+        whatever function returns, the last attempt's if every retry was busy
+        '''
+        for attempt in range(self.retries+1):
+            started=self.acquire()
+            code=None
+            try:
+                value=function(*args, **kw)
+                code=_resultcode(value)
+            except Exception:
+                code=RESULT_UNAVAILABLE
+                raise
+            finally:
+                self.release(started, code)
+            if(code not in OVERLOADED or attempt == self.retries):
+                return value
+            with self.condition:
+                self.counts['retries']+=1
+            # exponential backoff with jitter, so retries do not arrive together
+            sleep(min(0.05*2**attempt, 5.0)*(0.5+random()))
+        return value
+
+    def acquire(self):
+        '''wait for room under the limit, returns the start time to pass to release'''
+        with self.condition:
+            while(self.inflight >= int(self.limit)):
+                self.condition.wait()
+            self.inflight+=1
+            return monotonic()
+
+    def release(self, started, code=None):
+        '''record a finished write and move the limit
+
+        Parameters:
+        started(float): what acquire returned
+        code(int): the ldap result code, None if there was none
+        '''
+        now=monotonic()
+        seconds=now-started
+        lag=self._lag()
+        with self.condition:
+            self.inflight-=1
+            self.counts['writes']+=1
+            self.done.append(now)
+            self.latency=seconds if self.latency == None else 0.8*self.latency+0.2*seconds
+            lagging=lag != None and self.max_lag != None and lag > self.max_lag
+            if(code in OVERLOADED or lagging or (self.target != None and seconds > self.target)):
+                self.counts['overloaded']+=1
+                # writes sent before the last cut saw the old limit, do not cut for them again
+                if(started >= self.cut):
+                    self.limit=max(float(self.minimum), self.limit*self.backoff)
+                    self.cut=now
+                    self.counts['cuts']+=1
+            elif(code in (None, 0)):
+                self.limit=min(float(self.maximum), self.limit+1/self.limit)
+            self.condition.notify_all()
+
+    def rate(self):
+        '''writes finished per second over the last window seconds'''
+        now=monotonic()
+        with self.condition:
+            while(self.done and self.done[0] < now-self.window):
+                self.done.popleft()
+            return len(self.done)/max(min(self.window, now-self.started), 0.001)
+
+    def stats(self):
+        '''returns the current limit, writes in flight, rate, latency and lag'''
+        rate=self.rate()
+        lag=self._lag()
+        with self.condition:
+            return dict(self.counts,
+                    limit=int(self.limit),
+                    inflight=self.inflight,
+                    rate=rate,
+                    latency_ms=None if self.latency == None else self.latency*1000,
+                    lag=lag)
+
+    def _lag(self):
+        return None if self.lag == None else self.lag.lag
+
+class LagProbe:
+    '''measure replication lag from the contextCSN of every server
+
+    Parameters:
+    servers(list): the servers to compare (providers and consumers)
+    suffix(string): the entry holding contextCSN (default the first namingContext)
+    interval(float): seconds between measurements
+    **kw: keywords passed to ldaptools.connect for every server (credentials)
+    '''
+
+    def __init__(self, servers, suffix=None, interval=5, **kw):
+        self.servers=list(servers)
+        self.suffix=suffix
+        self.interval=interval
+        self.kw=kw
+        self.lag=None       # seconds the furthest behind server lags, None until measured
+        self.lags={}        # server -> seconds behind, None if it could not be read
+        self.conns={}
+        self.stopped=Event()
+        self.lock=Lock()
+
+    def start(self):
+        '''measure every interval seconds in the background, returns the probe'''
+        Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def measure(self):
+        '''read every server's contextCSN now, returns the lag in seconds (None if unknown)'''
+        csns={}
+        for server in self.servers:
+            try:
+                csns[server]=self._csns(server)
+            except Exception:
+                self.conns.pop(server, None)
+                csns[server]=None
+
+        newest={}
+        for values in csns.values():
+            for sid, stamp in (values or {}).items():
+                newest[sid]=max(newest.get(sid, stamp), stamp)
+        lags={}
+        for server, values in csns.items():
+            if(values == None):
+                lags[server]=None
+                continue
+            # serverIDs the server holds no CSN for tell nothing about it
+            lags[server]=max([(stamp-values[sid]).total_seconds() for sid, stamp in newest.items() if sid in values] or [0.0])
+        known=[lag for lag in lags.values() if lag != None]
+        with self.lock:
+            self.lags=lags
+            self.lag=max(known) if known else None
+        return self.lag
+
+    def _run(self):
+        while(not self.stopped.is_set()):
+            self.measure()
+            self.stopped.wait(self.interval)
+
+    def _csns(self, server):
+        '''returns serverID -> time of the newest change from it, as seen by server'''
+        from ldap3 import BASE
+        conn=self.conns.get(server)
+        if(conn == None):
+            from ldaptools import connect
+            conn=self.conns[server]=connect(server=server, **self.kw)
+        suffix=self.suffix
+        if(suffix == None):
+            _, _, response, _ = conn.search('', '(objectClass=*)', search_scope=BASE, attributes=['namingContexts'])
+            contexts=response[0]['attributes'].get('namingContexts') if response else None
+            suffix=self.suffix=(contexts or [''])[0]
+        _, _, response, _ = conn.search(suffix, '(objectClass=*)', search_scope=BASE, attributes=['contextCSN'])
+        values=response[0]['attributes'].get('contextCSN', []) if response else []
+        csns={}
+        for value in (values if isinstance(values, list) else [values]):
+            sid, stamp = parsecsn(str(value))
+            csns[sid]=max(csns.get(sid, stamp), stamp)
+        return csns
+
+def throttleargs(parser):
+    '''add the options getthrottle reads to a script's argparser'''
+    parser.add_argument('--adaptive',
+            action='store_true',
+            help='adapt the writes in flight to the server load, up to the maximum given')
+    parser.add_argument('--target-latency',
+            type=float,
+            default=None,
+            help='with --adaptive, milliseconds a write may take before the writes in flight are cut')
+    parser.add_argument('--max-lag',
+            type=float,
+            default=None,
+            help='with --adaptive, seconds of replication lag (contextCSN) before the writes in flight are cut')
+    parser.add_argument('--lag-servers',
+            default=None,
+            help='comma separated servers to compare contextCSN on (default the -s servers)')
+    return parser
+
+def getthrottle(args, maximum):
+    '''build the Throttle asked for by the options from throttleargs, or None
+
+    With -v the throttle's state is printed to stderr every 10 seconds.
+
+    Parameters:
+    args(object): parsed args from a parser passed through throttleargs
+    maximum(int): the most writes the script can have in flight
+
+    Returns:
+    a Throttle, or None without --adaptive
+    '''
+    if(not args.adaptive):
+        return None
+    probe=None
+    if(args.max_lag != None and not getattr(args, 'snapshot', None)):
+        from ldaptools import connparams
+        from ldaptools.topology import expand
+        server, auth_user, auth_pass, auth_key, auth_cert = connparams(args=args)
+        servers=args.lag_servers.split(',') if args.lag_servers else (server if isinstance(server, tuple) else (server,))
+        probe=LagProbe(expand([s.strip() for s in servers if s.strip()]),
+                auth_user=auth_user,
+                auth_pass=auth_pass,
+                auth_key=auth_key,
+                auth_cert=auth_cert,
+                ca_certs=getattr(args, 'ca_certs', None),
+                tls13=getattr(args, 'tls13', False)).start()
+    throttle=Throttle(maximum=maximum,
+            target=None if args.target_latency == None else args.target_latency/1000,
+            lag=probe,
+            max_lag=args.max_lag)
+    if(args.verbose):
+        watch(throttle)
+    return throttle
+
+def watch(throttle, interval=10, file=None):
+    '''print a throttle's state every interval seconds from a daemon thread'''
+    from sys import stderr
+    def run():
+        while(True):
+            sleep(interval)
+            print('throttle: %s'%describe(throttle.stats()), file=file or stderr)
+    Thread(target=run, daemon=True).start()
+
+def describe(stats):
+    '''a one line summary of Throttle.stats()'''
+    return 'limit %s, %s in flight, %.0f writes/s, latency %s, lag %s, %s cuts, %s retries'%(
+            stats['limit'],
+            stats['inflight'],
+            stats['rate'],
+            '-' if stats['latency_ms'] == None else '%.1fms'%stats['latency_ms'],
+            '-' if stats['lag'] == None else '%.1fs'%stats['lag'],
+            stats['cuts'],
+            stats['retries'])
+
+def parsecsn(csn):
+    '''split a CSN (20240101120000.123456Z#000000#001#000000) into its serverID and time'''
+    parts=csn.split('#')
+    stamp=datetime.strptime(parts[0], '%Y%m%d%H%M%S.%fZ').replace(tzinfo=timezone.utc)
+    return (parts[2] if len(parts) > 2 else '000', stamp)
+
+def _resultcode(value):
+    '''the result code of a SAFE_SYNC style return value, None if it has none'''
+    if(isinstance(value, tuple) and len(value) == 4 and isinstance(value[1], dict)):
+        return value[1].get('result')
+    return None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''ldaptools.tls - one SSLContext per client identity, with session resumption
+
+ldap3 builds a new SSLContext every time it wraps a socket, loading the
+client key and certificate and the CA bundle from disk again, and every
+START_TLS is then a full handshake.  connect() uses a SessionTls instead.
+Its context is built once per key, cert, CA and TLS version, and the TLS
+session of the last connection to each server is offered on the next one,
+so the server can resume it (from a session ticket or ID) without the
+certificate exchange.
+
+The socket is also given TCP_NODELAY.  The client speaks last in a resumed
+TLS 1.2 or any TLS 1.3 handshake, and without it the bind that follows the
+client's Finished message waits for the server's delayed ACK (40ms on Linux).
+
+    conn = connect(args=args, tls13=True)
+    conn.server.tls.resumed(conn)   # True if the handshake was resumed
+'''
+
+from socket import IPPROTO_TCP, TCP_NODELAY
+from ssl import SSLContext, PROTOCOL_TLS_CLIENT, CERT_REQUIRED, TLSVersion
+from functools import lru_cache
+from threading import Lock
+from ldap3 import Tls
+from ldap3.core.tls import check_hostname
+
+@lru_cache(maxsize=None)
+def sslcontext(auth_key=None, auth_cert=None, ca_certs=None, tls13=False):
+    '''returns the client SSLContext for a key, cert and CA, built once per tuple
+
+    Parameters:
+    auth_key(string): a path to a client private key in PEM format
+    auth_cert(string): a path to a client signed certificate in PEM format
+    ca_certs(string): a path to the CA certificates to trust (default the OS bundle)
+    tls13(bool): allow TLS 1.3 as well as TLS 1.2
+
+    Returns:
+    a ssl.SSLContext object
+    '''
+    context=SSLContext(PROTOCOL_TLS_CLIENT)
+    # ldap3 matches the certificate against the server name itself
+    context.check_hostname=False
+    context.verify_mode=CERT_REQUIRED
+    context.minimum_version=TLSVersion.TLSv1_2
+    if(not tls13):
+        context.maximum_version=TLSVersion.TLSv1_2
+    if(ca_certs):
+        context.load_verify_locations(ca_certs)
+    else:
+        context.load_default_certs()
+    if(auth_cert):
+        context.load_cert_chain(auth_cert, keyfile=auth_key)
+    return context
+
+class SessionTls(Tls):
+    '''ldap3 Tls settings that reuse one SSLContext and resume TLS sessions
+
+    Sessions are kept per server host and port.  A session is remembered
+    when the handshake finishes, and again by remember() once the bind has
+    been answered, as TLS 1.3 servers only send their session tickets after
+    the handshake.
+
+    Parameters:
+    auth_key(string): a path to a client private key in PEM format
+    auth_cert(string): a path to a client signed certificate in PEM format
+    ca_certs(string): a path to the CA certificates to trust (default the OS bundle)
+    tls13(bool): allow TLS 1.3 as well as TLS 1.2
+    '''
+
+    def __init__(self, auth_key=None, auth_cert=None, ca_certs=None, tls13=False):
+        super().__init__(
+                local_private_key_file=auth_key,
+                local_certificate_file=auth_cert,
+                ca_certs_file=ca_certs,
+                validate=CERT_REQUIRED,
+                version=None)
+        self.context=sslcontext(auth_key, auth_cert, ca_certs, tls13)
+        self.sessions={}    # (host, port) -> the last ssl.SSLSession
+        self.lock=Lock()
+
+    def wrap_socket(self, connection, do_handshake=False):
+        '''wrap the connection's socket with the shared context, resuming if possible'''
+        server=connection.server
+        try:
+            connection.socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        except OSError:
+            pass
+        with self.lock:
+            session=self.sessions.get((server.host, server.port))
+        wrapped=self.context.wrap_socket(connection.socket,
+                server_side=False,
+                do_handshake_on_connect=do_handshake,
+                server_hostname=self.sni,
+                session=session)
+        if(do_handshake):
+            check_hostname(wrapped, server.host, self.valid_names)
+        connection.socket=wrapped
+        if(do_handshake):
+            self.remember(connection)
+
+    def remember(self, conn):
+        '''keep the TLS session of a connection to offer on the next one'''
+        session=getattr(conn.socket, 'session', None)
+        if(session == None):
+            return
+        with self.lock:
+            self.sessions[(conn.server.host, conn.server.port)]=session
+
+    def forget(self):
+        '''drop every remembered session, so the next handshakes are full ones'''
+        with self.lock:
+            self.sessions.clear()
+
+    @staticmethod
+    def resumed(conn):
+        '''True if the connection's TLS handshake resumed an earlier session'''
+        return getattr(conn.socket, 'session_reused', False) == True
+
+@lru_cache(maxsize=None)
+def gettls(auth_key=None, auth_cert=None, ca_certs=None, tls13=False):
+    '''return the shared SessionTls for a key, cert, CA and TLS version'''
+    return SessionTls(auth_key, auth_cert, ca_certs, tls13)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+'''ldaptools.topology - pick a server out of a set of providers and consumers
+
+connect() hands a list of servers (server=['a','b'], -s a,b, or
+srv:company.com for the _ldap._tcp SRV records) to a Topology.  The
+topology probes every server with pingstate, then serves reads from active
+consumers, in the local site first and fastest first, and writes from
+active providers.  A server that fails to connect or answer is quarantined
+for a while and the next candidate is tried.  A connection from a topology
+remembers the candidate it was made to, so a ConnectionPool that loses it
+to a communication error quarantines that server (see failed) and opens
+the next connection elsewhere.
+
+    conn = connect(server='ldap1.company.com,ldap2.company.com', site='bed')
+    conn = connect(args=args, write=True)   # a provider, for mkaccount
+'''
+
+# pingstate lives with the other helpers in bin/
+from pathlib import Path
+from sys import path
+project = str(Path(__file__).resolve().parents[1])
+if(project not in path):
+    path.insert(0, project)
+
+from threading import Lock
+from time import monotonic, perf_counter
+
+class NoServerAvailable(Exception):
+    '''raised when every candidate server failed or is quarantined'''
+
+class Topology:
+    '''the probed state of a set of ldap servers
+
+    Parameters:
+    servers(list): hostnames, and srv:domain entries to expand from DNS
+    site(string): the local dsaSite, preferred for reads
+    quarantine(float): seconds a failed server is skipped for
+    probe_interval(float): seconds a probe result is trusted for
+    **kw: keywords passed to ldaptools.connect for every server (credentials)
+    '''
+
+    def __init__(self, servers, site=None, quarantine=60, probe_interval=300, **kw):
+        self.servers=expand(servers)
+        self.site=site
+        self.quarantine_for=quarantine
+        self.probe_interval=probe_interval
+        self.kw=kw
+        self.lock=Lock()
+        self.state={}       # server -> pingstate dict, or None if the probe failed
+        self.latency={}     # server -> seconds the last pingstate took
+        self.quarantined={} # server -> time the quarantine ends
+        self.probed=None
+
+    def probe(self, force=False):
+        '''probe every server with pingstate, unless the last probe is recent
+
+        Parameters:
+        force(bool): probe even if the last probe is recent
+        '''
+        with self.lock:
+            if(not force and self.probed != None and monotonic()-self.probed < self.probe_interval):
+                return
+            self.probed=monotonic()
+
+        for server in self.servers:
+            if(not self._isquarantined(server)):
+                self._probe(server)
+
+    def _probe(self, server):
+        '''probe one server with pingstate, quarantining it if that fails'''
+        from ldaptools import connect
+        from bin.pingstate import pingstate
+        conn=None
+        try:
+            conn=connect(server=server, **self.kw)
+            started=perf_counter()
+            state=pingstate(conn)
+            latency=perf_counter()-started
+        except Exception:
+            self.quarantine(server)
+            return
+        finally:
+            if(conn != None):
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+        with self.lock:
+            self.state[server]=state
+            self.latency[server]=latency
+
+    def candidates(self, write=False):
+        '''returns the servers to try, best first
+
+        Reads go to active consumers in the local site, then other active
+        consumers, then active providers.  Writes go to active providers.
+        Within each group the fastest server comes first.  Servers that could
+        not be probed are tried last for reads, and quarantined servers not at
+        all.  A write only goes to a server known to be a provider, so servers
+        whose quarantine has ended since the last probe are probed again first.
+
+        Parameters:
+        write(bool): True to pick servers that accept writes
+        '''
+        self.probe()
+        if(write):
+            with self.lock:
+                unprobed=[server for server in self.servers if server not in self.state and not self._isquarantined(server, locked=True)]
+            for server in unprobed:
+                self._probe(server)
+        ranked=[]
+        unknown=[]
+        with self.lock:
+            for server in self.servers:
+                if(self._isquarantined(server, locked=True)):
+                    continue
+                state=self.state.get(server)
+                if(state == None):
+                    unknown.append(server)
+                    continue
+                if(not state.get('dsaIsActive')):
+                    continue
+                role=state.get('dsaRole')
+                if(write):
+                    if(role != 'provider'):
+                        continue
+                    rank=0
+                elif(role == 'consumer'):
+                    rank=0 if self.site == None or state.get('dsaSite') == self.site else 1
+                else:
+                    rank=2
+                ranked.append((rank, self.latency.get(server, 0), server))
+        # a server of unknown role may be a read only consumer
+        return [server for _, _, server in sorted(ranked)]+([] if write else unknown)
+
+    def connect(self, write=False, **kw):
+        '''connect to the best available server, failing over on error
+
+        Parameters:
+        write(bool): True to connect to a provider
+        **kw: extra keywords for ldaptools.connect (client_strategy, ...)
+
+        Returns:
+        ldap3 connection object, with the topology and the candidate it was
+        made to (as listed, host:port for SRV records) as its topology and
+        candidate attributes
+
+        Raises:
+        NoServerAvailable if no candidate could be connected to
+        '''
+        from ldaptools import connect
+        errors=[]
+        for server in self.candidates(write):
+            try:
+                conn=connect(server=server, **dict(self.kw, **kw))
+            except Exception as e:
+                errors.append('%s: %s'%(server, e))
+                self.quarantine(server)
+                continue
+            conn.topology=self
+            conn.candidate=server
+            return conn
+        raise NoServerAvailable('no %s server available (%s)'%('writable' if write else 'readable', '; '.join(errors) or ('no provider known' if write else 'all quarantined')))
+
+    def failover(self, function, write=False, attempts=3, **kw):
+        '''run function(conn), retrying on the next server if the connection fails
+
+        Parameters:
+        function(callable): called with a connection, its result is returned
+        write(bool): True to run against a provider
+        attempts(int): the maximum number of servers to try
+
+        Returns:
+        whatever function returns
+        '''
+        from ldap3.core.exceptions import LDAPCommunicationError, LDAPSessionTerminatedByServerError
+        for attempt in range(attempts):
+            conn=self.connect(write, **kw)
+            try:
+                return function(conn)
+            except (LDAPCommunicationError, LDAPSessionTerminatedByServerError):
+                self.quarantine(conn.candidate)
+                if(attempt == attempts-1):
+                    raise
+            finally:
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+
+    def quarantine(self, server):
+        '''skip a server for the quarantine period'''
+        with self.lock:
+            self.quarantined[server]=monotonic()+self.quarantine_for
+
+    def _isquarantined(self, server, locked=False):
+        if(not locked):
+            with self.lock:
+                return self._isquarantined(server, True)
+        until=self.quarantined.get(server)
+        if(until == None):
+            return False
+        if(until <= monotonic()):
+            del self.quarantined[server]
+            # probe it again before trusting it
+            self.state.pop(server, None)
+            return False
+        return True
+
+def failed(conn):
+    '''quarantine the server a connection from a topology was made to
+
+    Call it when the connection fails with a communication error, so the
+    next connect() fails over to another server.  Connections that did
+    not come from a topology are left alone.
+    '''
+    topology=getattr(conn, 'topology', None)
+    if(topology != None):
+        topology.quarantine(conn.candidate)
+
+def expand(servers):
+    '''expand srv:domain entries into the hosts of the domain's _ldap._tcp SRV records
+
+    SRV lookups need the optional dnspython package.  Records are ordered by
+    priority, then weight.
+    '''
+    expanded=[]
+    for server in servers:
+        if(not server.startswith('srv:')):
+            expanded.append(server)
+            continue
+        try:
+            from dns.resolver import resolve
+        except ImportError:
+            raise ImportError('dnspython is required to look up %s'%server)
+        records=resolve('_ldap._tcp.%s'%server[4:], 'SRV')
+        for record in sorted(records, key=lambda r: (r.priority, -r.weight)):
+            host=str(record.target).rstrip('.')
+            expanded.append(host if record.port == 389 else '%s:%s'%(host, record.port))
+    return expanded
+
+_topologies={}
+_topologieslock=Lock()
+
+def gettopology(servers, site=None, **kw):
+    '''return the shared Topology for a set of servers, site and credentials
+
+    Sharing the topology means the probe results and quarantines carry
+    over between connect() calls in the same process.
+    '''
+    key=(tuple(servers), site, tuple(sorted((k, str(v)) for k, v in kw.items())))
+    with _topologieslock:
+        topology=_topologies.get(key)
+        if(topology == None):
+            topology=_topologies[key]=Topology(servers, site, **kw)
+    return topology